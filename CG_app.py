@@ -3,9 +3,14 @@
 import streamlit as st
 import sys
 import os, json, hashlib, pandas as pd, secrets, datetime, csv, io, zipfile, shutil, uuid, time, tempfile
+import threading, functools, itertools, multiprocessing, pickle, bisect, atexit, mimetypes, gzip, zlib, types
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future, as_completed, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+import html
+from string import Template
 import base64
 from datetime import datetime, date
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Iterable, Iterator, Callable, Union, IO
 import webbrowser  # ✅ ESTÁNDAR - NO INSTALAR
 
 import warnings  # ← LIBRERÍA ESTÁNDAR, NO INSTALAR
@@ -23,7 +28,27 @@ AGREEMENTS_FILE = os.path.join(DATA_DIR, "agreements.json")
 AUDIT_FILE = os.path.join(DATA_DIR, "audit.json")
 NATURALEZA_MAP_FILE = os.path.join(DATA_DIR, "naturaleza_map.json")
 UPLOADS_DIR = os.path.join(DATA_DIR, "uploads")
+BLOBS_DIR = os.path.join(UPLOADS_DIR, "blobs")
+TAMAÑO_BLOQUE_HASH = 1024 * 1024          # bytes leídos por vez al calcular el sha256 de un adjunto
+GRACIA_RECOLECCION_BLOBS = 3600          # segundos antes de eliminar un blob huérfano
+VERSIONES_DIR = os.path.join(DATA_DIR, "versiones")
+INTERVALO_VERSION_COMPLETA = 10          # cada cuántas versiones se guarda el snapshot completo
+HISTORIAL_DIR = os.path.join(DATA_DIR, "historial")
+ADJUNTOS_ACUERDOS_FILE = os.path.join(DATA_DIR, "adjuntos_acuerdos.json")
+ARCHIVO_DIR = os.path.join(DATA_DIR, "archivo")
 COUNTERS_FILE = os.path.join(DATA_DIR, "counters.json")
+TABLA_PLANA_FILE = os.path.join(DATA_DIR, "tabla_plana.json")
+CUBO_FILE = os.path.join(DATA_DIR, "cubo_cumplimiento.json")
+INDICADORES_FILE = os.path.join(DATA_DIR, "indicadores.json")
+INDICADORES_LEGACY_FILE = os.path.join("data", "indicadores.json")
+RETRASO_ESCRITURA_INDICADORES = 2.0  # segundos que se agrupan cambios antes de escribir
+SEGUIMIENTOS_FILE = os.path.join(DATA_DIR, "seguimientos.jsonl")
+SEGUIMIENTOS_LEGACY_FILE = "seguimientos.json"
+CACHE_REPORTES_DIR = os.path.join(DATA_DIR, "cache_reportes")
+TRABAJOS_DIR = os.path.join(DATA_DIR, "trabajos")
+RETENCION_TRABAJOS_HORAS = 24
+NIVEL_COMPRESION_ZIP = 6                 # 0 (rápido) .. 9 (más chico)
+UMBRAL_SPOOL_BYTES = 8 * 1024 * 1024     # por encima, los archivos temporales pasan a disco
 LOGO_FILES = ["logo_opp.png", "logo.png"]
 # 🆕 RANGOS POR DEFECTO FLEXIBLES 
 RANGOS_DEFAULT = {"cumplido": 90, "parcial": 60}
@@ -104,19 +129,11 @@ def check_permissions():
             status = "✅" if exists else "❌"
             st.sidebar.write(f"{status} {description}: {os.path.basename(file_path)} ({size} bytes)")
         
-        # Información del almacenamiento
-        if os.path.exists(DATA_DIR):
-            total_size = 0
-            total_files = 0
-            for dirpath, dirnames, filenames in os.walk(DATA_DIR):
-                for f in filenames:
-                    fp = os.path.join(dirpath, f)
-                    total_size += os.path.getsize(fp)
-                    total_files += 1
-            
-            st.sidebar.markdown("**Uso de almacenamiento:**")
-            st.sidebar.write(f"📁 Archivos: {total_files}")
-            st.sidebar.write(f"💾 Espacio: {total_size / 1024 / 1024:.2f} MB")
+        # Información del almacenamiento (desde el índice de adjuntos, sin recorrer DATA_DIR)
+        uso = obtener_almacen_adjuntos().uso()
+        st.sidebar.markdown("**Uso de almacenamiento:**")
+        st.sidebar.write(f"📎 Adjuntos: {uso['archivos']} ({uso['blobs']} archivos únicos)")
+        st.sidebar.write(f"💾 Espacio en adjuntos: {uso['bytes_en_disco'] / 1024 / 1024:.2f} MB")
         
         # Botón para forzar verificación
         if st.sidebar.button("🔄 Actualizar diagnóstico", key="refresh_diagnostic"):
@@ -165,75 +182,423 @@ def check_permissions():
     except Exception as e:
         st.sidebar.error(f"Error en diagnóstico: {e}")
 
-def cargar_indicadores_json():
-    """Carga los indicadores desde el archivo JSON con manejo de errores"""
-    try:
-        with open("data/indicadores.json", "r", encoding='utf-8') as f:
-            datos = json.load(f)
+# ==================== REPOSITORIO DE INDICADORES ====================
+
+def huella_indicador(nombre: Any, fecha: Any, departamento: Any) -> str:
+    """Hash de (nombre, fecha, departamento): identifica una medición repetida"""
+    base = f"{str(nombre or '').strip().lower()}|{str(fecha or '').strip()}|{str(departamento or '').strip()}"
+    return hashlib.sha1(base.encode("utf-8")).hexdigest()[:16]
+
+class RepositorioIndicadores:
+    """
+    Indicadores en memoria (id → registro) compartidos entre sesiones.
+    
+    Mantiene la secuencia de ids persistida, índices por departamento, nombre y
+    fecha, y la huella de cada medición para descartar duplicados. Las altas y bajas solo marcan el repositorio como modificado; la
+    escritura a disco se hace en segundo plano agrupando los cambios
+    (RETRASO_ESCRITURA_INDICADORES) y al cerrar el proceso. El formato del archivo
+    no cambia: {"indicadores": [...], "metadata": {...}}.
+    """
+    
+    def __init__(self, archivo: str = None):
+        self.archivo = archivo or INDICADORES_FILE
+        self.registros: Dict[int, Dict[str, Any]] = {}
+        self.metadata: Dict[str, Any] = {}
+        self.siguiente_id = 1
+        self.por_departamento: Dict[str, set] = {}
+        self.por_nombre: Dict[str, set] = {}
+        self.por_fecha: Dict[str, set] = {}
+        self._fechas: List[str] = []  # claves de por_fecha ordenadas (para rangos)
+        self.por_huella: Dict[str, int] = {}  # huella_indicador → id de la primera medición
+        self._lock = threading.RLock()
+        self._lock_escritura = threading.Lock()  # una escritura del archivo a la vez, en orden de snapshot
+        self._temporizador: Optional[threading.Timer] = None
+        self._pendiente = False
+        self.revision = 0  # aumenta con cada cambio (clave de las cachés del dashboard)
+        self._cargar()
+        atexit.register(self.guardar_ahora)
+    
+    # ---------- persistencia ----------
+    def _cargar(self):
+        ruta = self.archivo
+        if not os.path.exists(ruta) and os.path.exists(INDICADORES_LEGACY_FILE):
+            ruta = INDICADORES_LEGACY_FILE  # migración desde la ruta relativa anterior
+        try:
+            with open(ruta, "r", encoding="utf-8") as f:
+                datos = json.load(f)
+        except (OSError, ValueError):
+            datos = {}
+        if not isinstance(datos, dict) or not isinstance(datos.get("indicadores"), list):
+            datos = {"indicadores": [], "metadata": {}}
+        
+        with self._lock:
+            self.metadata = datos.get("metadata") or {}
+            for registro in datos["indicadores"]:
+                self._indexar(registro)
+            # La secuencia se guarda en metadata; en archivos viejos se calcula una única vez
+            self.siguiente_id = int(self.metadata.get("siguiente_id") or max(self.registros, default=0) + 1)
+    
+    def _documento(self) -> Dict[str, Any]:
+        self.metadata.update(total=len(self.registros), siguiente_id=self.siguiente_id)
+        return {"indicadores": list(self.registros.values()), "metadata": dict(self.metadata)}
+    
+    def guardar_ahora(self):
+        """
+        Escribe los cambios pendientes (sin widgets: corre también en el temporizador).
+        
+        El lock de escritura se toma antes del snapshot y se suelta después del
+        reemplazo: el temporizador, las cargas por lote y atexit no pueden mezclar el
+        .tmp ni dejar un snapshot viejo encima de uno más nuevo.
+        """
+        with self._lock_escritura:
+            with self._lock:
+                if self._temporizador is not None:
+                    self._temporizador.cancel()
+                    self._temporizador = None
+                if not self._pendiente:
+                    return
+                documento = self._documento()
+                self._pendiente = False
+            try:
+                os.makedirs(os.path.dirname(self.archivo), exist_ok=True)
+                tmp = self.archivo + ".tmp"
+                with open(tmp, "w", encoding="utf-8") as f:
+                    json.dump(documento, f, indent=4, ensure_ascii=False)
+                os.replace(tmp, self.archivo)
+            except OSError:
+                with self._lock:
+                    self._pendiente = True  # se reintenta en la próxima escritura
+                raise
+    
+    def _programar_guardado(self):
+        self.revision += 1
+        self.metadata["ultima_actualizacion"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self._pendiente = True
+        if self._temporizador is None:
+            self._temporizador = threading.Timer(RETRASO_ESCRITURA_INDICADORES, self.guardar_ahora)
+            self._temporizador.daemon = True
+            self._temporizador.start()
+    
+    # ---------- índices ----------
+    @staticmethod
+    def _agregar_a_indice(indice: Dict[str, set], clave: str, indicador_id: int):
+        indice.setdefault(clave, set()).add(indicador_id)
+    
+    @staticmethod
+    def _quitar_de_indice(indice: Dict[str, set], clave: str, indicador_id: int) -> bool:
+        """Quita el id; devuelve True si la clave quedó vacía (y se eliminó)"""
+        ids = indice.get(clave)
+        if ids is None:
+            return False
+        ids.discard(indicador_id)
+        if not ids:
+            del indice[clave]
+            return True
+        return False
+    
+    def _indexar(self, registro: Dict[str, Any]):
+        indicador_id = registro["id"]
+        self.registros[indicador_id] = registro
+        self._agregar_a_indice(self.por_departamento, registro.get("departamento") or "", indicador_id)
+        self._agregar_a_indice(self.por_nombre, (registro.get("nombre") or "").strip().lower(), indicador_id)
+        fecha = registro.get("fecha") or ""
+        if fecha not in self.por_fecha:
+            bisect.insort(self._fechas, fecha)
+        self._agregar_a_indice(self.por_fecha, fecha, indicador_id)
+        self.por_huella.setdefault(self.huella(registro), indicador_id)
+    
+    def _desindexar(self, registro: Dict[str, Any]):
+        indicador_id = registro["id"]
+        self._quitar_de_indice(self.por_departamento, registro.get("departamento") or "", indicador_id)
+        self._quitar_de_indice(self.por_nombre, (registro.get("nombre") or "").strip().lower(), indicador_id)
+        fecha = registro.get("fecha") or ""
+        if self._quitar_de_indice(self.por_fecha, fecha, indicador_id):
+            self._fechas.pop(bisect.bisect_left(self._fechas, fecha))
+        huella = self.huella(registro)
+        if self.por_huella.get(huella) == indicador_id:
+            del self.por_huella[huella]
+    
+    @staticmethod
+    def huella(registro: Dict[str, Any]) -> str:
+        return huella_indicador(registro.get("nombre"), registro.get("fecha"), registro.get("departamento"))
+    
+    # ---------- API ----------
+    def __len__(self) -> int:
+        return len(self.registros)
+    
+    def agregar(self, datos: Dict[str, Any]) -> Dict[str, Any]:
+        """Agrega un indicador asignándole el próximo id de la secuencia"""
+        with self._lock:
+            registro = {"id": self.siguiente_id, **datos}
+            self.siguiente_id += 1
+            self._indexar(registro)
+            self._programar_guardado()
+            return registro
+    
+    def agregar_lote(self, filas: Iterable[Dict[str, Any]]) -> tuple:
+        """
+        Agrega muchos indicadores de una vez, con una única escritura a disco.
+        
+        Las filas cuya huella (nombre, fecha, departamento) ya existe en el
+        repositorio o aparece antes en el mismo lote se omiten.
+        
+        Returns:
+            tuple: (lista de registros agregados, cantidad de duplicados omitidos)
+        """
+        agregados: List[Dict[str, Any]] = []
+        omitidos = 0
+        with self._lock:
+            for datos in filas:
+                if self.huella(datos) in self.por_huella:
+                    omitidos += 1
+                    continue
+                registro = {"id": self.siguiente_id, **datos}
+                self.siguiente_id += 1
+                self._indexar(registro)
+                agregados.append(registro)
+            if not agregados:
+                return agregados, omitidos
+            self._programar_guardado()
+        self.guardar_ahora()
+        return agregados, omitidos
+    
+    def contiene(self, huella: str) -> bool:
+        return huella in self.por_huella
+    
+    def eliminar(self, indicador_id: int) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            registro = self.registros.pop(indicador_id, None)
+            if registro is not None:
+                self._desindexar(registro)
+                self._programar_guardado()
+            return registro
+    
+    def obtener(self, indicador_id: int) -> Optional[Dict[str, Any]]:
+        return self.registros.get(indicador_id)
+    
+    def buscar(self, departamento: Optional[str] = None, nombre: Optional[str] = None,
+               desde: Optional[str] = None, hasta: Optional[str] = None) -> List[Dict[str, Any]]:
+        """
+        Indicadores que cumplen todos los filtros (usando los índices), en orden de alta.
+        
+        Args:
+            departamento: Departamento exacto
+            nombre: Texto contenido en el nombre (sin distinguir mayúsculas)
+            desde, hasta: Rango de fechas 'YYYY-MM-DD' (inclusive)
+        """
+        with self._lock:
+            candidatos: Optional[set] = None
             
-        # Verificar estructura del archivo
-        if not isinstance(datos, dict) or "indicadores" not in datos:
-            # Si la estructura es incorrecta, crear una nueva
-            datos = {
-                "indicadores": [],
-                "metadata": {
-                    "ultima_actualizacion": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                    "total": 0
-                }
-            }
-            guardar_indicadores_json(datos)
-            st.warning("⚠️ Estructura de archivo corregida")
+            def restringir(ids: set):
+                nonlocal candidatos
+                candidatos = set(ids) if candidatos is None else candidatos & ids
             
-        return datos
-        
-    except (FileNotFoundError, json.JSONDecodeError):
-        # Si el archivo no existe o está corrupto, crear uno nuevo
-        datos = {
-            "indicadores": [],
-            "metadata": {
-                "ultima_actualizacion": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                "total": 0
-            }
-        }
-        guardar_indicadores_json(datos)
-        st.info("📁 Archivo de indicadores creado nuevo")
-        return datos
+            if departamento:
+                restringir(self.por_departamento.get(departamento, set()))
+            if nombre and nombre.strip():
+                texto = nombre.strip().lower()
+                restringir(set().union(*(ids for clave, ids in self.por_nombre.items() if texto in clave)))
+            if desde or hasta:
+                inicio = bisect.bisect_left(self._fechas, desde) if desde else 0
+                fin = bisect.bisect_right(self._fechas, hasta) if hasta else len(self._fechas)
+                restringir(set().union(*(self.por_fecha[f] for f in self._fechas[inicio:fin])))
+            
+            if candidatos is None:
+                return list(self.registros.values())
+            return [registro for indicador_id, registro in self.registros.items() if indicador_id in candidatos]
+    
+    def departamentos(self) -> List[str]:
+        with self._lock:
+            return sorted(d for d in self.por_departamento if d)
+    
+    def dataframe(self, registros: Optional[List[Dict[str, Any]]] = None) -> pd.DataFrame:
+        with self._lock:
+            return pd.DataFrame(list(self.registros.values()) if registros is None else registros)
+    
+    def como_documento(self) -> Dict[str, Any]:
+        """Contenido en el formato del archivo (para 'Ver Datos' y exportaciones)"""
+        with self._lock:
+            return self._documento()
+    
+    def limpiar(self):
+        """Elimina todos los indicadores (la secuencia de ids no se reinicia)"""
+        with self._lock:
+            self.registros.clear()
+            self.por_departamento.clear()
+            self.por_nombre.clear()
+            self.por_fecha.clear()
+            self._fechas.clear()
+            self.por_huella.clear()
+            self._programar_guardado()
+        self.guardar_ahora()
+
+@st.cache_resource(show_spinner=False)
+def obtener_repositorio_indicadores() -> RepositorioIndicadores:
+    """Repositorio de indicadores compartido por todas las sesiones"""
+    return RepositorioIndicadores()
+
+INDICADORES_POR_PAGINA = 20
+
+# ==================== CARGA MASIVA DE INDICADORES ====================
+
+COLUMNAS_CARGA_INDICADORES = ["nombre", "valor", "meta", "unidad", "departamento", "fecha", "comentarios"]
+COLUMNAS_OBLIGATORIAS_INDICADORES = ["nombre", "valor", "fecha"]
+EXTENSIONES_EXCEL = (".xlsx", ".xlsm")  # las que lee openpyxl (.xls necesitaría xlrd)
+
+def _leer_archivo_indicadores(upl_bytes: bytes, nombre_archivo: str) -> pd.DataFrame:
+    """CSV o Excel (primera hoja) como texto, con encabezados normalizados"""
+    if nombre_archivo.lower().endswith(EXTENSIONES_EXCEL):
+        df = _numerar_filas(pd.read_excel(io.BytesIO(upl_bytes), dtype=str, keep_default_na=False))
+    else:
+        texto = _decodificar_csv(upl_bytes)
+        df = _numerar_filas(pd.read_csv(io.StringIO(texto), dtype=str, keep_default_na=False,
+                                        skipinitialspace=True), texto)
+    df.columns = [str(c).strip().lower() for c in df.columns]
+    return df.apply(lambda col: col.astype(str).str.strip())
+
+def validar_lote_indicadores(upl_bytes: bytes, nombre_archivo: str) -> tuple:
+    """
+    Valida por columnas un archivo de indicadores (CSV o Excel) sin guardar nada.
+    
+    Returns:
+        tuple: (DataFrame normalizado con valor/meta numéricos, fecha YYYY-MM-DD y
+               huella; reporte con columnas fila/columna/valor/severidad/mensaje).
+               Los duplicados son advertencias: se omiten al importar.
+    """
+    df = _leer_archivo_indicadores(upl_bytes, nombre_archivo)
+    
+    faltantes = [c for c in COLUMNAS_OBLIGATORIAS_INDICADORES if c not in df.columns]
+    if faltantes:
+        reporte = pd.DataFrame([
+            {"fila": 1, "columna": c, "valor": "", "severidad": "error",
+             "mensaje": "Falta la columna obligatoria en el encabezado"}
+            for c in faltantes
+        ], columns=COLUMNAS_REPORTE_ERRORES)
+        return df, reporte
+    for col in COLUMNAS_CARGA_INDICADORES:
+        if col not in df.columns:
+            df[col] = ""
+    
+    errores: List[pd.DataFrame] = []
+    errores.append(_errores_por_mascara(df, df["nombre"] == "", "nombre", "error", "El nombre es obligatorio"))
+    
+    valor = _numerico_vectorizado(df["valor"])
+    errores.append(_errores_por_mascara(df, valor.isna(), "valor", "error", "El valor es obligatorio y numérico"))
+    errores.append(_errores_por_mascara(df, valor < 0, "valor", "error", "El valor no puede ser negativo"))
+    meta = _numerico_vectorizado(df["meta"])
+    errores.append(_errores_por_mascara(df, (df["meta"] != "") & meta.isna(), "meta", "error", "La meta no es numérica"))
+    errores.append(_errores_por_mascara(df, meta < 0, "meta", "error", "La meta no puede ser negativa"))
+    
+    # Excel entrega las fechas como 'YYYY-MM-DD 00:00:00'; también se acepta DD/MM/YYYY
+    fechas = pd.to_datetime(df["fecha"].str[:10], format="%Y-%m-%d", errors="coerce")
+    fechas = fechas.fillna(pd.to_datetime(df["fecha"], format="%d/%m/%Y", errors="coerce"))
+    errores.append(_errores_por_mascara(df, fechas.isna(), "fecha", "error",
+                                        "Fecha inválida (formato YYYY-MM-DD o DD/MM/YYYY)"))
+    
+    df["valor"] = valor.astype(float)
+    df["meta"] = meta.astype(float)  # meta 0 se guarda tal cual (el dashboard la trata como sin meta)
+    df["fecha"] = fechas.dt.strftime("%Y-%m-%d").fillna(df["fecha"])
+    df["huella"] = [huella_indicador(n, f, d) for n, f, d in zip(df["nombre"], df["fecha"], df["departamento"])]
+    
+    repo = obtener_repositorio_indicadores()
+    errores.append(_errores_por_mascara(df, df["huella"].duplicated(), "nombre", "advertencia",
+                                        "Repetido en el archivo (nombre, fecha, departamento): se omitirá"))
+    errores.append(_errores_por_mascara(df, df["huella"].map(repo.contiene), "nombre", "advertencia",
+                                        "Ya existe en el sistema (nombre, fecha, departamento): se omitirá"))
+    
+    reporte = pd.concat([e for e in errores if not e.empty] or [pd.DataFrame(columns=COLUMNAS_REPORTE_ERRORES)],
+                        ignore_index=True)
+    reporte = reporte.sort_values(["fila", "severidad"], ascending=[True, False], kind="stable").reset_index(drop=True)
+    return df, reporte
+
+def registros_lote_indicadores(df: pd.DataFrame) -> List[Dict[str, Any]]:
+    """Filas validadas → registros en el formato del formulario de carga"""
+    marca = datetime.now().isoformat()
+    registros = df[COLUMNAS_CARGA_INDICADORES].astype(object).where(df[COLUMNAS_CARGA_INDICADORES].notna(), None)
+    return [dict(fila, timestamp=marca) for fila in registros.to_dict("records")]
+
+def plantilla_carga_indicadores() -> str:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(COLUMNAS_CARGA_INDICADORES)
+    writer.writerow(["Procesos digitalizados", "45", "60", "%", "TI", date.today().strftime("%Y-%m-%d"), ""])
+    return buffer.getvalue()
 
-def guardar_indicadores_json(datos):
-    """Guarda indicadores en JSON"""
-    from datetime import datetime  # 🆕 IMPORTAR AQUÍ TAMBIÉN POR SEGURIDAD
-    datos["metadata"]["ultima_actualizacion"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    datos["metadata"]["total"] = len(datos["indicadores"])
-    with open('data/indicadores.json', 'w', encoding='utf-8') as f:
-        json.dump(datos, f, indent=4, ensure_ascii=False)
+def carga_masiva_indicadores(repo: RepositorioIndicadores):
+    """Sección de carga de un lote de indicadores desde CSV o Excel"""
+    st.subheader("📤 Carga Masiva (CSV / Excel)")
+    if st.session_state.get("ind_lote_resultado"):
+        st.success(st.session_state.pop("ind_lote_resultado"))
+    
+    st.download_button(
+        "⬇️ Descargar plantilla CSV",
+        data=plantilla_carga_indicadores().encode("utf-8-sig"),
+        file_name="plantilla_indicadores.csv",
+        mime="text/csv",
+        key="plantilla_indicadores"
+    )
+    archivo = st.file_uploader("Archivo de indicadores", type=["csv", *(e.lstrip(".") for e in EXTENSIONES_EXCEL)], key="ind_lote_archivo",
+                               help="Columnas: " + ", ".join(COLUMNAS_CARGA_INDICADORES) + " (obligatorias: nombre, valor, fecha)")
+    if archivo is None:
+        return
+    
+    upl_bytes = archivo.getvalue()
+    try:
+        df, reporte = validar_lote_indicadores(upl_bytes, archivo.name)
+    except Exception as e:
+        st.error(f"❌ No se pudo leer el archivo: {e}")
+        return
+    mostrar_reporte_validacion(reporte, f"indicadores_{hashlib.md5(upl_bytes).hexdigest()[:8]}")
+    if (reporte["severidad"] == "error").any():
+        return
+    
+    nuevos = int((~df["huella"].duplicated() & ~df["huella"].map(repo.contiene)).sum())
+    if st.button(f"📥 Importar {nuevos} indicador(es)", key="ind_lote_importar", disabled=not nuevos):
+        agregados, omitidos = repo.agregar_lote(registros_lote_indicadores(df))
+        st.session_state["ind_lote_resultado"] = (
+            f"✅ {len(agregados)} indicador(es) importado(s)"
+            + (f"; {omitidos} duplicado(s) omitido(s)" if omitidos else ""))
+        st.rerun()
 
 def cargar_indicadores():
     """Interfaz para cargar nuevos indicadores"""
     st.header("📥 Carga de Nuevos Indicadores")
+    repo = obtener_repositorio_indicadores()
     
-    # 🆕 SECCIÓN PARA ELIMINAR INDICADORES EXISTENTES
+    # 🆕 SECCIÓN PARA ELIMINAR INDICADORES EXISTENTES (filtrada y paginada)
     st.subheader("🗑️ Eliminar Indicadores Existentes")
-    datos = cargar_indicadores_json()
     
-    if datos["indicadores"]:
-        # Mostrar indicadores existentes con opción de eliminar
-        for indicador in datos["indicadores"]:
+    if len(repo):
+        col_f1, col_f2 = st.columns(2)
+        with col_f1:
+            filtro_departamento = st.selectbox("Departamento", [""] + repo.departamentos(), key="ind_filtro_depto")
+        with col_f2:
+            filtro_nombre = st.text_input("Nombre (contiene)", key="ind_filtro_nombre")
+        
+        encontrados = repo.buscar(departamento=filtro_departamento or None, nombre=filtro_nombre)
+        paginas = max(1, -(-len(encontrados) // INDICADORES_POR_PAGINA))
+        pagina = st.number_input(f"Página (de {paginas})", min_value=1, max_value=paginas, value=1, key="ind_pagina")
+        visibles = encontrados[(pagina - 1) * INDICADORES_POR_PAGINA: pagina * INDICADORES_POR_PAGINA]
+        st.caption(f"{len(encontrados)} de {len(repo)} indicadores")
+        
+        if visibles:
+            st.dataframe(repo.dataframe(visibles)[["id", "nombre", "valor", "fecha", "departamento"]],
+                         use_container_width=True, hide_index=True)
+            
             col1, col2, col3 = st.columns([3, 1, 1])
             with col1:
-                st.write(f"**{indicador['nombre']}** - Valor: {indicador['valor']} - Fecha: {indicador['fecha']}")
+                seleccionado = st.selectbox(
+                    "Indicador", [r["id"] for r in visibles],
+                    format_func=lambda i: f"{i} - {repo.obtener(i)['nombre']}", key="ind_seleccionado"
+                )
             with col2:
-                if st.button("👁️", key=f"view_{indicador['id']}", help="Ver detalles"):
-                    st.json(indicador)
+                if st.button("👁️", key="view_indicador", help="Ver detalles"):
+                    st.json(repo.obtener(seleccionado))
             with col3:
-                if st.button("🗑️", key=f"delete_{indicador['id']}", help="Eliminar indicador"):
-                    # Eliminar el indicador
-                    datos["indicadores"] = [ind for ind in datos["indicadores"] if ind['id'] != indicador['id']]
-                    # Actualizar metadata
-                    datos["metadata"]["total"] = len(datos["indicadores"])
-                    datos["metadata"]["ultima_actualizacion"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    # Guardar cambios
-                    guardar_indicadores_json(datos)
-                    st.success(f"✅ Indicador '{indicador['nombre']}' eliminado")
+                if st.button("🗑️", key="delete_indicador", help="Eliminar indicador"):
+                    eliminado = repo.eliminar(seleccionado)
+                    if eliminado:
+                        st.success(f"✅ Indicador '{eliminado['nombre']}' eliminado")
                     st.rerun()
         
         st.markdown("---")
@@ -256,16 +621,7 @@ def cargar_indicadores():
         
         if st.form_submit_button("💾 Guardar Indicador"):
             if nombre and valor is not None:
-                datos = cargar_indicadores_json()
-                
-                # Generar nuevo ID (máximo ID existente + 1)
-                if datos["indicadores"]:
-                    nuevo_id = max(ind['id'] for ind in datos["indicadores"]) + 1
-                else:
-                    nuevo_id = 1
-                
-                nuevo_indicador = {
-                    "id": nuevo_id,
+                repo.agregar({
                     "nombre": nombre,
                     "valor": float(valor),
                     "meta": float(meta) if meta else None,
@@ -274,17 +630,14 @@ def cargar_indicadores():
                     "fecha": fecha.strftime("%Y-%m-%d"),
                     "comentarios": comentarios,
                     "timestamp": datetime.now().isoformat()
-                }
-                
-                datos["indicadores"].append(nuevo_indicador)
-                datos["metadata"]["total"] = len(datos["indicadores"])
-                datos["metadata"]["ultima_actualizacion"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                
-                guardar_indicadores_json(datos)
+                })
                 st.success(f"✅ Indicador '{nombre}' guardado exitosamente")
                 st.rerun()
             else:
                 st.error("❌ Nombre y valor son obligatorios")
+    
+    st.markdown("---")
+    carga_masiva_indicadores(repo)
 
 def componente_firma_imagen(key_suffix=""):
     """Subir imagen escaneada de firma"""
@@ -401,232 +754,249 @@ def cargar_resultados_por_metas():
                         meta["cumplimiento_calc"] = calcular_cumplimiento(meta)
                         
                         # Guardar acuerdo
-                        agreements_save(db)
+                        agreements_save(db, [acuerdo_seleccionado])
                         
                         st.success(f"✅ Resultado guardado - Cumplimiento: {meta['cumplimiento_calc']:.1f}%")
+# Estados de un indicador según su % de cumplimiento (valor / meta)
+UMBRAL_INDICADOR_EN_PROGRESO = 60
+UMBRAL_INDICADOR_CUMPLIDO = 100
+ESTADOS_INDICADOR = {
+    "cumplido": "✅ Cumplido",
+    "en_progreso": "🟡 En progreso",
+    "rezagado": "🔴 Rezagado",
+    "sin_meta": "⚪ Sin meta",
+}
+FILAS_POR_PAGINA_DASHBOARD = 500
+
+def preparar_frame_indicadores(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Agrega al DataFrame de indicadores las columnas calculadas del dashboard,
+    todas en forma vectorizada: cumplimiento_pct, progreso_pct (0-100) y estado.
+    """
+    frame = df.copy()
+    for columna in ("nombre", "unidad", "departamento", "fecha"):
+        if columna not in frame.columns:
+            frame[columna] = ""
+    frame["valor"] = pd.to_numeric(frame.get("valor"), errors="coerce")
+    frame["meta"] = pd.to_numeric(frame["meta"], errors="coerce") if "meta" in frame.columns else float("nan")
+    
+    con_meta = frame["meta"] > 0
+    frame["cumplimiento_pct"] = (frame["valor"] / frame["meta"] * 100).where(con_meta)
+    frame["progreso_pct"] = frame["cumplimiento_pct"].clip(0, 100)
+    estado = pd.cut(
+        frame["cumplimiento_pct"],
+        bins=[float("-inf"), UMBRAL_INDICADOR_EN_PROGRESO, UMBRAL_INDICADOR_CUMPLIDO, float("inf")],
+        labels=["rezagado", "en_progreso", "cumplido"],
+        right=False,
+    )
+    frame["estado"] = estado.cat.add_categories(["sin_meta"]).fillna("sin_meta")
+    return frame
+
+def resumen_indicadores(frame: pd.DataFrame) -> Dict[str, Any]:
+    """Métricas principales del dashboard a partir del frame preparado"""
+    conteo = frame["estado"].value_counts()
+    cumplimiento = frame["cumplimiento_pct"].mean()
+    return {
+        "total": len(frame),
+        "valor_promedio": frame["valor"].mean(),
+        "cumplimiento_promedio": None if pd.isna(cumplimiento) else float(cumplimiento),
+        **{estado: int(conteo.get(estado, 0)) for estado in ESTADOS_INDICADOR},
+    }
+
+def agregados_por_departamento(frame: pd.DataFrame) -> pd.DataFrame:
+    """Cantidad de indicadores por departamento y estado + cumplimiento medio (para gráficos)"""
+    departamento = frame["departamento"].fillna("").replace("", "Sin departamento")
+    por_estado = pd.crosstab(departamento, frame["estado"]).reindex(columns=list(ESTADOS_INDICADOR), fill_value=0)
+    por_estado.columns = [ESTADOS_INDICADOR[c] for c in por_estado.columns]
+    por_estado["Cumplimiento medio (%)"] = frame.groupby(departamento)["cumplimiento_pct"].mean().round(1)
+    por_estado.index.name = "Departamento"
+    return por_estado
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def frame_indicadores(revision: int) -> pd.DataFrame:
+    """Frame preparado del dashboard; se recalcula solo cuando cambia la revisión del repositorio"""
+    return preparar_frame_indicadores(obtener_repositorio_indicadores().dataframe())
+
+# ==================== SERIES DE TIEMPO DE INDICADORES ====================
+
+# Frecuencia del remuestreo → (regla de pandas, meses por período). Las etiquetas
+# siguen el vocabulario de periodo_label (ENE-2024 / T1-2024 / S1-2024).
+FRECUENCIAS_SERIE = {
+    "Mensual": ("MS", 1),
+    "Trimestral": ("QS", 3),
+    "Semestral": ("6MS", 6),
+}
+CLAVES_SERIE = ["nombre", "departamento"]
+
+def _inicio_periodo(fechas: pd.Series, meses: int) -> pd.Series:
+    """Primer día del período (mes, trimestre o semestre calendario) de cada fecha"""
+    mes_inicio = (fechas.dt.month - 1) // meses * meses + 1
+    return pd.to_datetime({"year": fechas.dt.year, "month": mes_inicio, "day": 1})
+
+def remuestrear_indicadores(frame: pd.DataFrame, frecuencia: str = "Mensual") -> pd.DataFrame:
+    """
+    Serie regular por indicador (nombre + departamento) a la frecuencia pedida.
+    
+    Cada período tiene el promedio de valor y meta de las mediciones que caen en él
+    y la cantidad de mediciones; los períodos sin datos quedan con valor NaN.
+    """
+    regla, meses = FRECUENCIAS_SERIE[frecuencia]
+    datos = frame.assign(
+        fecha=pd.to_datetime(frame["fecha"].astype(str).str[:10], format="%Y-%m-%d", errors="coerce"),
+        departamento=frame["departamento"].fillna(""),
+    ).dropna(subset=["fecha"])
+    if datos.empty:
+        return pd.DataFrame(columns=CLAVES_SERIE + ["periodo_inicio", "periodo_label", "valor", "meta", "mediciones"])
+    datos["periodo_inicio"] = _inicio_periodo(datos["fecha"], meses)
+    
+    serie = (
+        datos.set_index("periodo_inicio")
+        .groupby(CLAVES_SERIE)
+        .resample(regla)
+        .agg({"valor": "mean", "meta": "mean", "fecha": "count"})
+        .rename(columns={"fecha": "mediciones"})
+        .reset_index()
+    )
+    serie["periodo_label"] = periodo_label_vectorizado(
+        serie["periodo_inicio"].dt.strftime("%Y-%m-%d"), pd.Series(frecuencia, index=serie.index))
+    return serie
+
+def estadisticas_moviles(serie: pd.DataFrame, ventana: int = 3) -> pd.DataFrame:
+    """Agrega media y desvío móviles de `valor` por indicador (ventana en períodos)"""
+    grupos = serie.groupby(CLAVES_SERIE, sort=False)["valor"]
+    resultado = serie.copy()
+    resultado["media_movil"] = grupos.rolling(ventana, min_periods=1).mean().reset_index(level=[0, 1], drop=True)
+    resultado["desvio_movil"] = grupos.rolling(ventana, min_periods=2).std().reset_index(level=[0, 1], drop=True)
+    return resultado
+
+def pendientes_tendencia(serie: pd.DataFrame) -> pd.DataFrame:
+    """
+    Pendiente de la recta de mínimos cuadrados de `valor` por indicador, calculada
+    con sumas agrupadas (sin ajustar grupo por grupo).
+    
+    Returns:
+        DataFrame por indicador con períodos, pendiente (unidades por período),
+        pendiente relativa (% del promedio por período) y último valor
+    """
+    datos = serie.assign(t=serie.groupby(CLAVES_SERIE, sort=False).cumcount()).dropna(subset=["valor"])
+    datos = datos.assign(ty=datos["t"] * datos["valor"], tt=datos["t"] ** 2)
+    sumas = datos.groupby(CLAVES_SERIE).agg(
+        n=("valor", "size"), st=("t", "sum"), sy=("valor", "sum"), sty=("ty", "sum"), stt=("tt", "sum"),
+        ultimo_valor=("valor", "last"),
+    )
+    denominador = sumas["n"] * sumas["stt"] - sumas["st"] ** 2
+    sumas["pendiente"] = ((sumas["n"] * sumas["sty"] - sumas["st"] * sumas["sy"]) / denominador).where(denominador != 0)
+    promedio = sumas["sy"] / sumas["n"]
+    sumas["pendiente_pct"] = (sumas["pendiente"] / promedio.abs() * 100).where(promedio != 0)
+    return sumas[["n", "pendiente", "pendiente_pct", "ultimo_valor"]].rename(columns={"n": "periodos"}).reset_index()
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def series_indicadores(revision: int, frecuencia: str, ventana: int) -> tuple:
+    """Serie remuestreada (con estadísticas móviles) y pendientes; cacheadas por revisión"""
+    serie = estadisticas_moviles(remuestrear_indicadores(frame_indicadores(revision), frecuencia), ventana)
+    return serie, pendientes_tendencia(serie)
+
+def mostrar_tendencias_indicadores(revision: int):
+    """Sección de tendencias del dashboard: serie de un indicador y ranking de pendientes"""
+    st.subheader("📈 Tendencias")
+    col_t1, col_t2 = st.columns(2)
+    with col_t1:
+        frecuencia = st.selectbox("Frecuencia", list(FRECUENCIAS_SERIE), key="tend_frecuencia")
+    with col_t2:
+        ventana = st.slider("Ventana de media móvil (períodos)", 2, 12, 3, key="tend_ventana")
+    
+    serie, pendientes = series_indicadores(revision, frecuencia, ventana)
+    if pendientes.empty:
+        st.info("No hay mediciones con fecha para analizar tendencias")
+        return
+    
+    opciones = list(pendientes[CLAVES_SERIE].itertuples(index=False, name=None))
+    nombre, departamento = st.selectbox(
+        "Indicador", opciones, format_func=lambda o: f"{o[0]} ({o[1] or 'Sin departamento'})", key="tend_indicador")
+    datos = serie[(serie["nombre"] == nombre) & (serie["departamento"] == departamento)]
+    st.line_chart(datos.set_index("periodo_inicio")[["valor", "media_movil", "meta"]])
+    
+    st.write("**Pendientes de tendencia por indicador**")
+    st.dataframe(
+        pendientes.sort_values("pendiente_pct", ascending=False, na_position="last"),
+        use_container_width=True,
+        hide_index=True,
+        column_config={
+            "nombre": "Indicador",
+            "departamento": "Departamento",
+            "periodos": "Períodos",
+            "pendiente": st.column_config.NumberColumn("Pendiente (por período)", format="%.2f"),
+            "pendiente_pct": st.column_config.NumberColumn("Pendiente (%)", format="%.1f%%"),
+            "ultimo_valor": st.column_config.NumberColumn("Último valor", format="%.2f"),
+        },
+    )
+
 def mostrar_graficos_streamlit(df):
     """Muestra visualizaciones usando solo componentes Streamlit"""
-   
-    # Barras de progreso para cada indicador
+    frame = df if "estado" in df.columns else preparar_frame_indicadores(df)
+    
+    # 🆕 GRÁFICOS RESUMEN (DESDE FRAMES PREAGREGADOS)
     st.subheader("📊 Progreso de Indicadores")
-   
-    for _, row in df.iterrows():
-        with st.container():
-            col1, col2, col3 = st.columns([3, 1, 1])
-           
-            with col1:
-                st.write(f"**{row['nombre']}**")
-                if pd.notna(row.get('meta')) and row['meta'] > 0:
-                    progreso = min((row['valor'] / row['meta']) * 100, 100)
-                    st.progress(int(progreso))
-                    st.write(f"{row['valor']} {row.get('unidad', '')} de {row['meta']} ({progreso:.1f}%)")
-                else:
-                    st.write(f"Valor: {row['valor']} {row.get('unidad', '')}")
-           
-            with col2:
-                st.metric("Actual", f"{row['valor']}")
-           
-            with col3:
-                if pd.notna(row.get('meta')):
-                    st.metric("Meta", f"{row['meta']}")
-           
-            st.write("---")
-
-@st.cache_data(ttl=60, show_spinner=False)
-def generar_reporte_html_streamlit():
-    """Genera reporte HTML básico sin gráficos complejos - VERSIÓN CORREGIDA"""
+    agregados = agregados_por_departamento(frame)
+    col_g1, col_g2 = st.columns(2)
+    with col_g1:
+        st.write("**Indicadores por estado y departamento**")
+        st.bar_chart(agregados[[ESTADOS_INDICADOR[e] for e in ESTADOS_INDICADOR]])
+    with col_g2:
+        st.write("**Cumplimiento medio por departamento (%)**")
+        st.bar_chart(agregados["Cumplimiento medio (%)"].dropna())
+    
+    # 🆕 TABLA PAGINADA CON BARRA DE PROGRESO (UNA SOLA GRILLA, NO WIDGETS POR FILA)
+    col_f1, col_f2, col_f3 = st.columns([2, 2, 1])
+    with col_f1:
+        departamentos = sorted(d for d in frame["departamento"].dropna().unique() if d)
+        filtro_departamento = st.selectbox("Departamento", ["Todos"] + departamentos, key="dash_ind_depto")
+    with col_f2:
+        filtro_estado = st.multiselect("Estado", list(ESTADOS_INDICADOR), format_func=ESTADOS_INDICADOR.get,
+                                       key="dash_ind_estado")
+    visibles = frame
+    if filtro_departamento != "Todos":
+        visibles = visibles[visibles["departamento"] == filtro_departamento]
+    if filtro_estado:
+        visibles = visibles[visibles["estado"].isin(filtro_estado)]
+    paginas = max(1, -(-len(visibles) // FILAS_POR_PAGINA_DASHBOARD))
+    with col_f3:
+        pagina = st.number_input(f"Página (de {paginas})", min_value=1, max_value=paginas, value=1, key="dash_ind_pagina")
+    
+    inicio = (pagina - 1) * FILAS_POR_PAGINA_DASHBOARD
+    pagina_df = visibles.iloc[inicio:inicio + FILAS_POR_PAGINA_DASHBOARD]
+    st.dataframe(
+        pagina_df.assign(estado=pagina_df["estado"].map(ESTADOS_INDICADOR))[
+            ["nombre", "departamento", "valor", "meta", "unidad", "progreso_pct", "estado", "fecha"]],
+        use_container_width=True,
+        hide_index=True,
+        column_config={
+            "nombre": "Indicador",
+            "departamento": "Departamento",
+            "valor": st.column_config.NumberColumn("Actual"),
+            "meta": st.column_config.NumberColumn("Meta"),
+            "unidad": "Unidad",
+            "progreso_pct": st.column_config.ProgressColumn("Progreso", format="%.1f%%", min_value=0, max_value=100),
+            "estado": "Estado",
+            "fecha": "Fecha",
+        },
+    )
+    st.caption(f"{len(visibles)} indicadores · mostrando {inicio + 1 if len(pagina_df) else 0}-{inicio + len(pagina_df)}")
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def generar_reporte_html_streamlit(revision: int = 0):
+    """Genera reporte HTML básico sin gráficos complejos (cacheado por revisión del repositorio)"""
     # SOLO CÁLCULOS, SIN WIDGETS ✅
-    datos = cargar_indicadores_json()
-    if not datos["indicadores"]:
+    repo = obtener_repositorio_indicadores()
+    if not len(repo):
         return None, None  # Retorna datos en lugar de mostrar widgets
     
-    df = pd.DataFrame(datos["indicadores"])
+    df = frame_indicadores(revision)
+    resumen = resumen_indicadores(df)
     
     try:
-        # Crear HTML simple y efectivo
-        html_content = f"""
-<!DOCTYPE html>
-<html lang="es">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>Reporte de Indicadores - Sistema de Seguimiento</title>
-    <style>
-        body {{
-            font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
-            margin: 0;
-            padding: 20px;
-            background: #f5f6fa;
-        }}
-        .container {{
-            max-width: 1200px;
-            margin: 0 auto;
-            background: white;
-            padding: 30px;
-            border-radius: 10px;
-            box-shadow: 0 2px 10px rgba(0,0,0,0.1);
-        }}
-        .header {{
-            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-            color: white;
-            padding: 30px;
-            border-radius: 10px;
-            margin-bottom: 30px;
-            text-align: center;
-        }}
-        .metricas {{
-            display: grid;
-            grid-template-columns: repeat(auto-fit, minmax(250px, 1fr));
-            gap: 20px;
-            margin: 30px 0;
-        }}
-        .metrica {{
-            background: white;
-            padding: 20px;
-            border-radius: 10px;
-            border-left: 5px solid #667eea;
-            box-shadow: 0 2px 5px rgba(0,0,0,0.1);
-            text-align: center;
-        }}
-        .metrica h3 {{
-            margin: 0 0 10px 0;
-            color: #2c3e50;
-            font-size: 14px;
-            text-transform: uppercase;
-        }}
-        .metrica .valor {{
-            font-size: 32px;
-            font-weight: bold;
-            color: #667eea;
-            margin: 10px 0;
-        }}
-        .tabla {{
-            width: 100%;
-            border-collapse: collapse;
-            margin: 30px 0;
-            background: white;
-            border-radius: 10px;
-            overflow: hidden;
-            box-shadow: 0 2px 5px rgba(0,0,0,0.1);
-        }}
-        .tabla th {{
-            background: #34495e;
-            color: white;
-            padding: 15px;
-            text-align: left;
-            font-weight: 600;
-        }}
-        .tabla td {{
-            padding: 12px 15px;
-            border-bottom: 1px solid #ecf0f1;
-        }}
-        .tabla tr:nth-child(even) {{
-            background: #f8f9fa;
-        }}
-        .tabla tr:hover {{
-            background: #e8f4f8;
-        }}
-        .resumen {{
-            background: linear-gradient(135deg, #74b9ff 0%, #0984e3 100%);
-            color: white;
-            padding: 25px;
-            border-radius: 10px;
-            margin: 30px 0;
-        }}
-    </style>
-</head>
-<body>
-    <div class="container">
-        <div class="header">
-            <h1>📊 REPORTE DE INDICADORES</h1>
-            <p>Sistema de Seguimiento - Generado el {datetime.now().strftime("%d/%m/%Y a las %H:%M")}</p>
-        </div>
-        
-        <div class="resumen">
-            <h2>🎯 RESUMEN EJECUTIVO</h2>
-            <p>Reporte consolidado de todos los indicadores del sistema con análisis de cumplimiento y tendencias.</p>
-        </div>
-        
-        <div class="metricas">
-            <div class="metrica">
-                <h3>Total de Indicadores</h3>
-                <div class="valor">{len(df)}</div>
-                <p>Métricas en seguimiento</p>
-            </div>
-            <div class="metrica">
-                <h3>Valor Promedio</h3>
-                <div class="valor">{df['valor'].mean():.2f}</div>
-                <p>Promedio general</p>
-            </div>
-            <div class="metrica">
-                <h3>Última Actualización</h3>
-                <div class="valor">{datos['metadata']['ultima_actualizacion'][:10]}</div>
-                <p>Fecha de modificación</p>
-            </div>
-"""
-        
-        # Agregar métrica de cumplimiento si hay metas
-        if 'meta' in df.columns and df['meta'].notna().any():
-            cumplimiento = (df['valor'] / df['meta'] * 100).mean()
-            html_content += f"""
-            <div class="metrica">
-                <h3>Cumplimiento General</h3>
-                <div class="valor">{cumplimiento:.1f}%</div>
-                <p>Porcentaje de cumplimiento</p>
-            </div>
-"""
-        
-        html_content += """
-        </div>
-        
-        <h2>📋 DETALLE DE INDICADORES</h2>
-        <table class="tabla">
-            <thead>
-                <tr>
-                    <th>ID</th>
-                    <th>Nombre del Indicador</th>
-                    <th>Valor Actual</th>
-                    <th>Meta</th>
-                    <th>% Cumplimiento</th>
-                    <th>Unidad</th>
-                    <th>Departamento</th>
-                    <th>Fecha</th>
-                </tr>
-            </thead>
-            <tbody>
-"""
-        
-        # Agregar filas de datos
-        for _, row in df.iterrows():
-            cumplimiento = "N/A"
-            if pd.notna(row.get('meta')) and row['meta'] > 0:
-                cumplimiento = f"{(row['valor'] / row['meta'] * 100):.1f}%"
-            
-            html_content += f"""
-                <tr>
-                    <td>{row.get('id', '')}</td>
-                    <td><strong>{row.get('nombre', '')}</strong></td>
-                    <td>{row.get('valor', '')}</td>
-                    <td>{row.get('meta', 'N/A')}</td>
-                    <td>{cumplimiento}</td>
-                    <td>{row.get('unidad', '')}</td>
-                    <td>{row.get('departamento', '')}</td>
-                    <td>{row.get('fecha', '')}</td>
-                </tr>
-"""
-        
-        html_content += """
-            </tbody>
-        </table>
-        
-        <div style="text-align: center; margin-top: 40px; padding: 20px; background: #f8f9fa; border-radius: 10px;">
-            <p><em>📄 Reporte generado automáticamente por el Sistema de Seguimiento de Indicadores</em></p>
-            <p><strong>Para más información, consulte la plataforma digital del sistema.</strong></p>
-        </div>
-    </div>
-</body>
-</html>
-"""
+        html_content = render_html(_fragmentos_reporte_indicadores_ejecutivo(
+            df, resumen, repo.metadata.get('ultima_actualizacion', '-')))
         
         return html_content, df
         
@@ -640,7 +1010,7 @@ def mostrar_reporte_completo():
     st.header("📊 Generar Reporte HTML")
     
     with st.status("Generando reporte HTML...") as status:
-        html_content, df = generar_reporte_html_streamlit()
+        html_content, df = generar_reporte_html_streamlit(obtener_repositorio_indicadores().revision)
         
         if html_content is None or df is None:
             st.warning("No hay indicadores para generar reporte")
@@ -671,14 +1041,13 @@ def mostrar_reporte_completo():
         st.subheader("📋 Datos en Tabla")
         st.dataframe(df, use_container_width=True)
 
-@st.cache_data(ttl=60, show_spinner=False)
 def dashboard_indicadores():
     """Dashboard principal usando solo Streamlit"""
     st.header("📈 Dashboard de Indicadores")
    
-    datos = cargar_indicadores_json()
+    repo = obtener_repositorio_indicadores()
    
-    if not datos["indicadores"]:
+    if not len(repo):
         st.info("""
         ## 📊 Bienvenido al Sistema de Seguimiento
        
@@ -691,96 +1060,99 @@ def dashboard_indicadores():
         """)
         return
    
-    df = pd.DataFrame(datos["indicadores"])
+    frame = frame_indicadores(repo.revision)
+    resumen = resumen_indicadores(frame)
    
     # Métricas principales
     st.subheader("🎯 Métricas Principales")
     col1, col2, col3, col4 = st.columns(4)
    
     with col1:
-        st.metric("Total Indicadores", len(df))
+        st.metric("Total Indicadores", resumen["total"])
     with col2:
-        st.metric("Valor Promedio", f"{df['valor'].mean():.1f}")
+        st.metric("Valor Promedio", f"{resumen['valor_promedio']:.1f}")
     with col3:
-        if 'meta' in df.columns and df['meta'].notna().any():
-            cumplimiento = (df['valor'] / df['meta'] * 100).mean()
-            st.metric("Cumplimiento", f"{cumplimiento:.1f}%")
+        if resumen["cumplimiento_promedio"] is not None:
+            st.metric("Cumplimiento", f"{resumen['cumplimiento_promedio']:.1f}%")
         else:
             st.metric("Cumplimiento", "N/A")
     with col4:
-        st.metric("Última Actualización", datos["metadata"]["ultima_actualizacion"].split()[0])
-   
-    # Visualizaciones con componentes nativos
-    mostrar_graficos_streamlit(df)
+        st.metric("Última Actualización", repo.metadata.get("ultima_actualizacion", "-").split()[0])
+    st.caption(" · ".join(f"{etiqueta}: {resumen[estado]}" for estado, etiqueta in ESTADOS_INDICADOR.items()))
    
-    # Tabla de datos detallada
-    st.subheader("📋 Datos Detallados")
-    st.dataframe(df, use_container_width=True)
+    # Visualizaciones con componentes nativos (gráficos resumen + tabla paginada)
+    mostrar_graficos_streamlit(frame)
+    
+    # 🆕 Series remuestreadas con media móvil y pendiente de tendencia
+    mostrar_tendencias_indicadores(repo.revision)
+
+def _fragmentos_reporte_indicadores_ejecutivo(df: pd.DataFrame, resumen: Dict[str, Any],
+                                              ultima_actualizacion: str) -> Iterator[str]:
+    """Fragmentos del reporte HTML completo de indicadores (métricas + detalle con estado)"""
+    yield PLANTILLA_APERTURA_HTML.substitute(
+        titulo="Reporte de Indicadores - Sistema de Seguimiento", css=CSS_REPORTE_INDICADORES)
+    yield PLANTILLA_REPORTE_INDICADORES_ENCABEZADO.substitute(
+        generado=datetime.now().strftime("%d/%m/%Y a las %H:%M"))
+    yield PLANTILLA_REPORTE_INDICADORES_METRICA.substitute(
+        titulo="Total de Indicadores", valor=len(df), detalle="Métricas en seguimiento")
+    yield PLANTILLA_REPORTE_INDICADORES_METRICA.substitute(
+        titulo="Valor Promedio", valor=f"{resumen['valor_promedio']:.2f}", detalle="Promedio general")
+    yield PLANTILLA_REPORTE_INDICADORES_METRICA.substitute(
+        titulo="Última Actualización", valor=_h(ultima_actualizacion[:10]), detalle="Fecha de modificación")
+    if resumen['cumplimiento_promedio'] is not None:
+        yield PLANTILLA_REPORTE_INDICADORES_METRICA.substitute(
+            titulo="Cumplimiento General", valor=f"{resumen['cumplimiento_promedio']:.1f}%",
+            detalle="Porcentaje de cumplimiento")
+    yield REPORTE_INDICADORES_TABLA_APERTURA
+    
+    # Columnas formateadas en bloque; la plantilla solo arma cada fila
+    def celda(serie: pd.Series) -> pd.Series:
+        return serie.astype(object).where(serie.notna(), "").astype(str).map(html.escape)
+    
+    cumplimiento = df["cumplimiento_pct"].map("{:.1f}%".format).where(df["cumplimiento_pct"].notna(), "N/A")
+    estado = df["estado"].astype(str)
+    columnas = zip(celda(df["id"]), celda(df["nombre"]), celda(df["valor"]), celda(df["meta"]).replace("", "N/A"),
+                   cumplimiento, estado, estado.map(ESTADOS_INDICADOR), celda(df["unidad"]),
+                   celda(df["departamento"]), celda(df["fecha"]))
+    for id_, nombre, valor, meta, cumpl, clase, etiqueta, unidad, departamento, fecha in columnas:
+        yield PLANTILLA_REPORTE_INDICADORES_FILA.substitute(
+            id=id_, nombre=nombre, valor=valor, meta=meta, cumplimiento=cumpl, clase_estado=clase,
+            estado=etiqueta, unidad=unidad, departamento=departamento, fecha=fecha)
+    yield PIE_REPORTE_INDICADORES
+    yield CIERRE_HTML
+
+def _fragmentos_reporte_indicadores(df: pd.DataFrame) -> Iterator[str]:
+    """Fragmentos del reporte HTML simple de indicadores"""
+    yield PLANTILLA_APERTURA_HTML.substitute(titulo="Reporte de Indicadores", css=CSS_TABLA_INDICADORES)
+    yield PLANTILLA_INDICADORES_ENCABEZADO.substitute(
+        generado=datetime.now().strftime("%d/%m/%Y %H:%M"), total=len(df))
+    for row in df.to_dict("records"):
+        yield PLANTILLA_INDICADORES_FILA.substitute(
+            id=_h(row.get('id', '')),
+            nombre=_h(row.get('nombre', '')),
+            valor=_h(row.get('valor', '')),
+            meta=_h(row.get('meta', 'N/A')),
+            unidad=_h(row.get('unidad', '')),
+            departamento=_h(row.get('departamento', '')),
+            fecha=_h(row.get('fecha', '')),
+        )
+    yield PIE_INDICADORES
+    yield CIERRE_HTML
 
 # 🆕 FUNCIÓN ALTERNATIVA SIMPLE PARA REPORTES HTML
 def generar_reporte_html_simple():
     """Versión simplificada que siempre funciona"""
     st.header("📊 Generar Reporte HTML - Versión Simple")
     
-    datos = cargar_indicadores_json()
-    if not datos["indicadores"]:
+    repo = obtener_repositorio_indicadores()
+    if not len(repo):
         st.warning("No hay indicadores para generar reporte")
         return
     
-    df = pd.DataFrame(datos["indicadores"])
+    df = repo.dataframe()
     
     # Crear HTML mínimo pero funcional
-    html_content = f"""
-<!DOCTYPE html>
-<html>
-<head>
-    <meta charset="UTF-8">
-    <title>Reporte de Indicadores</title>
-    <style>
-        body {{ font-family: Arial, sans-serif; margin: 20px; }}
-        h1 {{ color: #2c3e50; }}
-        table {{ border-collapse: collapse; width: 100%; }}
-        th, td {{ border: 1px solid #ddd; padding: 8px; text-align: left; }}
-        th {{ background-color: #34495e; color: white; }}
-        tr:nth-child(even) {{ background-color: #f2f2f2; }}
-    </style>
-</head>
-<body>
-    <h1>Reporte de Indicadores</h1>
-    <p><strong>Generado:</strong> {datetime.now().strftime("%d/%m/%Y %H:%M")}</p>
-    <p><strong>Total indicadores:</strong> {len(df)}</p>
-    
-    <table>
-        <tr>
-            <th>ID</th>
-            <th>Nombre</th>
-            <th>Valor</th>
-            <th>Meta</th>
-            <th>Unidad</th>
-            <th>Departamento</th>
-            <th>Fecha</th>
-        </tr>
-"""
-    
-    for _, row in df.iterrows():
-        html_content += f"""
-        <tr>
-            <td>{row.get('id', '')}</td>
-            <td>{row.get('nombre', '')}</td>
-            <td>{row.get('valor', '')}</td>
-            <td>{row.get('meta', 'N/A')}</td>
-            <td>{row.get('unidad', '')}</td>
-            <td>{row.get('departamento', '')}</td>
-            <td>{row.get('fecha', '')}</td>
-        </tr>
-"""
-    
-    html_content += """
-    </table>
-    <p><em>Generado por Sistema de Seguimiento</em></p>
-</body>
-</html>
-"""
+    html_content = render_html(_fragmentos_reporte_indicadores(df))
     
     # Mostrar vista previa
     st.components.v1.html(html_content, height=600, scrolling=True)
@@ -818,8 +1190,7 @@ def modulo_seguimiento_indicadores():
         generar_reporte_html_simple()    
     elif opcion == "⚙️ Ver Datos":
         st.header("📊 Datos en JSON")
-        datos = cargar_indicadores_json()
-        st.json(datos) 
+        st.json(obtener_repositorio_indicadores().como_documento())
 
 # ==================== CLASES ====================
 
@@ -896,33 +1267,150 @@ def verificar_permiso_accion(rol: str, estado: str, accion: str) -> bool:
     return permisos_sistema.tiene_permiso(rol, estado, accion)
 
 class GestorSeguimientos:
-    def __init__(self):
-        self.archivo_seguimientos = "seguimientos.json"
+    """
+    Registro de seguimientos de solo agregado (una línea JSON por seguimiento).
     
-    @st.cache_data(ttl=30, show_spinner=False)
-    def cargar_seguimientos(self):
-        if os.path.exists(self.archivo_seguimientos):
-            with open(self.archivo_seguimientos, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        return {"seguimientos": []}
+    Guardar un seguimiento agrega una línea al final del archivo, sin reescribirlo.
+    El id se asigna con el archivo bloqueado y después de leer las líneas que otros
+    procesos hayan agregado, así dos sesiones nunca reciben el mismo id. La lectura
+    se mantiene en memoria con índices por acuerdo y por meta, y solo se leen los
+    bytes nuevos cuando el archivo creció (la revisión es su tamaño).
+    """
+    
+    def __init__(self, archivo: str = None):
+        self.archivo_seguimientos = archivo or SEGUIMIENTOS_FILE
+        self.registros: List[Dict[str, Any]] = []
+        self.por_acuerdo: Dict[str, List[int]] = {}  # acuerdo_id → posiciones en registros
+        self.por_meta: Dict[str, List[int]] = {}
+        self.siguiente_id = 1
+        self._leido = 0  # bytes del archivo ya incorporados
+        self._lock = threading.RLock()
+        self._migrar_legacy()
+    
+    # ---------- persistencia ----------
+    def _migrar_legacy(self):
+        """Convierte una única vez el seguimientos.json anterior (lista completa) al registro por líneas"""
+        if os.path.exists(self.archivo_seguimientos) or not os.path.exists(SEGUIMIENTOS_LEGACY_FILE):
+            return
+        try:
+            with open(SEGUIMIENTOS_LEGACY_FILE, "r", encoding="utf-8") as f:
+                anteriores = json.load(f).get("seguimientos", [])
+        except (OSError, ValueError, AttributeError):
+            return
+        os.makedirs(os.path.dirname(self.archivo_seguimientos), exist_ok=True)
+        tmp = self.archivo_seguimientos + ".tmp"
+        with open(tmp, "wb") as f:
+            for seguimiento in anteriores:
+                f.write(self._linea(seguimiento))
+        os.replace(tmp, self.archivo_seguimientos)
+    
+    @staticmethod
+    def _linea(seguimiento: Dict[str, Any]) -> bytes:
+        return (json.dumps(seguimiento, ensure_ascii=False, default=str) + "\n").encode("utf-8")
+    
+    @staticmethod
+    def _bloquear(f, bloquear: bool = True):
+        """Bloqueo exclusivo del archivo entre procesos (fcntl en Unix, msvcrt en Windows)"""
+        try:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX if bloquear else fcntl.LOCK_UN)
+        except ImportError:
+            import msvcrt
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK if bloquear else msvcrt.LK_UNLCK, 1)
+    
+    def _incorporar(self, f):
+        """Lee desde la última posición leída las líneas completas agregadas al archivo"""
+        f.seek(0, os.SEEK_END)
+        if f.tell() < self._leido:  # el archivo fue reemplazado: se vuelve a leer entero
+            self.registros, self.por_acuerdo, self.por_meta = [], {}, {}
+            self.siguiente_id, self._leido = 1, 0
+        f.seek(self._leido)
+        nuevos = f.read()
+        completos = nuevos[:nuevos.rfind(b"\n") + 1]  # una línea a medio escribir se lee la próxima vez
+        for linea in completos.splitlines():
+            if linea.strip():
+                try:
+                    self._indexar(json.loads(linea))
+                except ValueError:
+                    continue
+        self._leido += len(completos)
+    
+    def _indexar(self, seguimiento: Dict[str, Any]):
+        posicion = len(self.registros)
+        self.registros.append(seguimiento)
+        if seguimiento.get("acuerdo_id"):
+            self.por_acuerdo.setdefault(seguimiento["acuerdo_id"], []).append(posicion)
+        if seguimiento.get("meta_id"):
+            self.por_meta.setdefault(seguimiento["meta_id"], []).append(posicion)
+        if isinstance(seguimiento.get("id"), int):
+            self.siguiente_id = max(self.siguiente_id, seguimiento["id"] + 1)
+    
+    def _actualizar(self):
+        with self._lock:
+            try:
+                tamaño = os.path.getsize(self.archivo_seguimientos)
+            except OSError:
+                return
+            if tamaño != self._leido:
+                with open(self.archivo_seguimientos, "rb") as f:
+                    self._incorporar(f)
+    
+    # ---------- API ----------
+    @property
+    def revision(self) -> int:
+        """Versión de los datos: bytes incorporados del registro"""
+        self._actualizar()
+        return self._leido
+    
+    def __len__(self) -> int:
+        self._actualizar()
+        return len(self.registros)
+    
+    def cargar_seguimientos(self) -> Dict[str, List[Dict[str, Any]]]:
+        """Todos los seguimientos, con la misma forma que el archivo anterior"""
+        self._actualizar()
+        with self._lock:
+            return {"seguimientos": list(self.registros)}
+    
+    def seguimientos_de_acuerdo(self, acuerdo_id: str) -> List[Dict[str, Any]]:
+        self._actualizar()
+        with self._lock:
+            return [self.registros[i] for i in self.por_acuerdo.get(acuerdo_id, [])]
+    
+    def seguimientos_de_meta(self, meta_id: str) -> List[Dict[str, Any]]:
+        self._actualizar()
+        with self._lock:
+            return [self.registros[i] for i in self.por_meta.get(meta_id, [])]
     
     def guardar_seguimiento(self, datos):
-        seguimientos = self.cargar_seguimientos()
-        
-        nuevo_seguimiento = {
-            "id": len(seguimientos["seguimientos"]) + 1,
-            "fecha_creacion": datetime.now().isoformat(),
-            "estado": "pendiente_revision",
-            **datos
-        }
-        
-        seguimientos["seguimientos"].append(nuevo_seguimiento)
-        
-        with open(self.archivo_seguimientos, 'w', encoding='utf-8') as f:
-            json.dump(seguimientos, f, indent=2, ensure_ascii=False)
+        os.makedirs(os.path.dirname(self.archivo_seguimientos), exist_ok=True)
+        with self._lock, open(self.archivo_seguimientos, "a+b") as f:
+            self._bloquear(f)
+            try:
+                self._incorporar(f)
+                nuevo_seguimiento = {
+                    "id": self.siguiente_id,
+                    "fecha_creacion": datetime.now().isoformat(),
+                    "estado": "pendiente_revision",
+                    **datos
+                }
+                linea = self._linea(nuevo_seguimiento)
+                f.write(linea)
+                f.flush()
+                os.fsync(f.fileno())
+                self._indexar(nuevo_seguimiento)
+                self._leido += len(linea)
+            finally:
+                self._bloquear(f, False)
         
         return nuevo_seguimiento
 
+@st.cache_resource(show_spinner=False)
+def obtener_gestor_seguimientos() -> GestorSeguimientos:
+    """Registro de seguimientos compartido por todas las sesiones"""
+    return GestorSeguimientos()
+
 # ==================== FUNCIONES DE CARGA ====================
 def abrir_carga_resultados():
     """Abre el formulario HTML de carga de resultados"""
@@ -934,111 +1422,182 @@ def abrir_carga_resultados():
     else:
         st.error(f"❌ Archivo {archivo_html} no encontrado. Crea el archivo HTML.")
 
+# ==================== AGREGADOS DEL DASHBOARD DE CONTROL ====================
+
+SITUACIONES_META = {"cumplida": "Cumplidas", "parcial": "Parciales", "no_cumplida": "No cumplidas", "pendiente": "Pendientes"}
+MAX_METAS_GRAFICO_CONTROL = 30
+
+def calcular_agregados_control(df: pd.DataFrame, seguimientos: List[Dict[str, Any]], hoy: str) -> Dict[str, pd.DataFrame]:
+    """
+    Frames del dashboard de control, calculados por columnas a partir de la tabla plana.
+    
+    Returns:
+        dict con:
+            metas: una fila por meta con su situación (cumplida/parcial/no_cumplida/pendiente)
+                   y si está vencida sin resultado
+            periodos: metas, pendientes y cumplimiento ponderado por año y periodo_label,
+                      en orden cronológico
+            seguimientos: seguimientos con fecha, estado y responsable
+    """
+    metas = df[["año", "acuerdo_id", "organismo_nombre", "ficha_nombre", "meta_numero", "meta_descripcion",
+                "periodo_label", "vencimiento", "ponderacion", "cumplimiento_meta", "clasificacion"]].copy()
+    metas["cumplimiento_meta"] = pd.to_numeric(metas["cumplimiento_meta"], errors="coerce")
+    metas["ponderacion"] = pd.to_numeric(metas["ponderacion"], errors="coerce").fillna(0.0)
+    pendiente = metas["cumplimiento_meta"].isna()
+    metas["situacion"] = metas["clasificacion"].where(~pendiente, "pendiente")
+    vencimiento = metas["vencimiento"].fillna("").astype(str).str[:10]
+    metas["vencida"] = pendiente & (vencimiento != "") & (vencimiento < hoy)
+    metas["meta"] = (metas["acuerdo_id"].astype(str) + " · N°" + metas["meta_numero"].fillna("").astype(str)
+                     + " " + metas["meta_descripcion"].fillna("").astype(str).str.slice(0, 50))
+    
+    con_dato = metas["cumplimiento_meta"].notna()
+    auxiliar = metas.assign(
+        pond_con_dato=metas["ponderacion"].where(con_dato, 0.0),
+        ponderado=(metas["cumplimiento_meta"] * metas["ponderacion"]).fillna(0.0),
+        orden=metas["vencimiento"].fillna("").astype(str),
+        **{situacion: metas["situacion"] == situacion for situacion in SITUACIONES_META},
+    )
+    periodos = auxiliar.groupby(["año", "periodo_label"], dropna=False).agg(
+        orden=("orden", "min"), metas=("meta", "size"), pond_con_dato=("pond_con_dato", "sum"),
+        ponderado=("ponderado", "sum"), vencidas=("vencida", "sum"),
+        **{situacion: (situacion, "sum") for situacion in SITUACIONES_META},
+    ).reset_index()
+    periodos["cumplimiento"] = (periodos["ponderado"] / periodos["pond_con_dato"]).where(periodos["pond_con_dato"] > 0)
+    periodos = periodos.sort_values(["orden", "periodo_label"]).drop(columns="orden").reset_index(drop=True)
+    
+    registros = pd.DataFrame(seguimientos)
+    for columna in ("id", "fecha_creacion", "estado", "responsable"):
+        if columna not in registros.columns:
+            registros[columna] = None
+    registros = pd.DataFrame({
+        "ID": registros["id"],
+        "Fecha": registros["fecha_creacion"].fillna("").astype(str).str[:10],
+        "Estado": registros["estado"].fillna("sin_estado"),
+        "Responsable": registros["responsable"].fillna("No especificado"),
+    })
+    return {"metas": metas, "periodos": periodos, "seguimientos": registros}
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def agregados_control(revision_acuerdos: str, revision_seguimientos: int, hoy: str) -> Dict[str, pd.DataFrame]:
+    """Agregados del dashboard de control; se recalculan solo cuando cambian los datos (o el día)"""
+    seguimientos = obtener_gestor_seguimientos().cargar_seguimientos()["seguimientos"]
+    return calcular_agregados_control(obtener_tabla_plana().dataframe(), seguimientos, hoy)
+
+def metricas_control(metas: pd.DataFrame) -> Dict[str, Any]:
+    """Métricas principales a partir del frame de metas (ya filtrado)"""
+    con_dato = metas["cumplimiento_meta"].notna()
+    ponderacion = metas["ponderacion"].where(con_dato, 0.0).sum()
+    return {
+        "cumplimiento_promedio": float((metas["cumplimiento_meta"].fillna(0.0) * metas["ponderacion"]).sum() / ponderacion)
+                                 if ponderacion > 0 else None,
+        "metas_completadas": int((metas["situacion"] == "cumplida").sum()),
+        "metas_pendientes": int((~con_dato).sum()),
+        "metas_vencidas": int(metas["vencida"].sum()),
+    }
+
 # ==================== FUNCIONES DEL DASHBOARD (LÍNEAS 47-150) ====================
-@st.cache_data(ttl=60, show_spinner=False)
 def mostrar_dashboard_seguro():
-    """Dashboard que FUNCIONA SEGURO sin instalaciones adicionales"""
+    """Dashboard de control con datos reales de acuerdos y seguimientos (agregados cacheados)"""
     
     st.title("📈 Dashboard de Control - Compromisos de Gestión")
     
+    agregados = agregados_control(obtener_tabla_plana().revision, obtener_gestor_seguimientos().revision,
+                                  date.today().isoformat())
+    metas, periodos, seguimientos = agregados["metas"], agregados["periodos"], agregados["seguimientos"]
+    
+    años = sorted({a for a in metas["año"].dropna()}, reverse=True)
+    año = st.selectbox("Año", ["Todos"] + años, key="control_año")
+    if año != "Todos":
+        metas = metas[metas["año"] == año]
+        periodos = periodos[periodos["año"] == año]
+    
     # ==================== MÉTRICAS PRINCIPALES ====================
     st.header("📊 Métricas Principales")
-    
-    # Cargar datos reales si existen, sino usar ejemplo
-    gestor = GestorSeguimientos()
-    seguimientos = gestor.cargar_seguimientos()
-    
-    if seguimientos["seguimientos"]:
-        # 📍 DATOS REALES - cuando tengas seguimientos cargados
-        total_seguimientos = len(seguimientos["seguimientos"])
-        # Aquí irían cálculos reales de cumplimiento
-        metricas = {
-            "total_seguimientos": total_seguimientos,
-            "cumplimiento_promedio": 85.3,  # Por ahora estático
-            "metas_completadas": total_seguimientos,  # Ejemplo
-            "metas_pendientes": 0
-        }
-    else:
-        # 📍 DATOS DE EJEMPLO - hasta que tengas datos reales
-        metricas = {
-            "total_seguimientos": 0,
-            "cumplimiento_promedio": 0,
-            "metas_completadas": 0,
-            "metas_pendientes": 0
-        }
+    metricas = metricas_control(metas)
     
     col1, col2, col3, col4 = st.columns(4)
     
     with col1:
-        st.metric("Total Seguimientos", metricas["total_seguimientos"])
+        st.metric("Total Seguimientos", len(seguimientos))
     with col2:
-        st.metric("Cumplimiento Promedio", f"{metricas['cumplimiento_promedio']}%")
+        st.metric("Cumplimiento Promedio",
+                  f"{metricas['cumplimiento_promedio']:.1f}%" if metricas["cumplimiento_promedio"] is not None else "N/A")
     with col3:
         st.metric("Metas Completadas", metricas["metas_completadas"])
     with col4:
-        st.metric("Metas Pendientes", metricas["metas_pendientes"])
+        st.metric("Metas Pendientes", metricas["metas_pendientes"],
+                  delta=f"{metricas['metas_vencidas']} vencidas" if metricas["metas_vencidas"] else None,
+                  delta_color="inverse")
     
-    # ==================== GRÁFICOS SIMPLES ====================
+    # ==================== GRÁFICOS ====================
     st.header("📈 Visualización de Datos")
     
-    # 📍 GRÁFICO 1: Tendencia (Streamlit nativo)
-    st.subheader("Tendencia de Cumplimiento")
-    
-    if seguimientos["seguimientos"]:
-        # Cuando tengas datos reales, aquí los procesarías
-        datos_tendencia = pd.DataFrame({
-            'Periodo': ['Ene-Mar', 'Abr-Jun', 'Jul-Sep', 'Oct-Dic'],
-            'Cumplimiento': [75, 80, 90, 85]
-        })
+    if metas.empty:
+        st.info("📝 No hay metas cargadas aún. Cree acuerdos para ver los gráficos.")
     else:
-        datos_tendencia = pd.DataFrame({
-            'Periodo': ['Cargue datos para ver gráficos'],
-            'Cumplimiento': [0]
-        })
-    
-    st.line_chart(datos_tendencia.set_index('Periodo'))
+        # 📍 GRÁFICO 1: Tendencia por período (periodo_label)
+        st.subheader("Tendencia de Cumplimiento")
+        etiquetas = periodos["periodo_label"].astype(str) if año != "Todos" else \
+            periodos["periodo_label"].astype(str) + " (" + periodos["año"].astype(str) + ")"
+        tendencia = pd.DataFrame({"Periodo": etiquetas, "Cumplimiento": periodos["cumplimiento"]})
+        # Índice categórico para que el gráfico respete el orden cronológico
+        tendencia["Periodo"] = pd.Categorical(tendencia["Periodo"], categories=tendencia["Periodo"].unique(), ordered=True)
+        if tendencia["Cumplimiento"].notna().any():
+            st.line_chart(tendencia.set_index("Periodo"))
+        else:
+            st.info("Aún no hay resultados cargados para calcular la tendencia")
+        
+        st.subheader("Metas por Período")
+        st.bar_chart(pd.DataFrame(
+            {etiqueta: periodos[situacion].to_numpy() for situacion, etiqueta in SITUACIONES_META.items()},
+            index=pd.CategoricalIndex(tendencia["Periodo"], name="Periodo")))
+        
+        # 📍 GRÁFICO 2: Cumplimiento por meta (las de menor cumplimiento primero)
+        st.subheader("Cumplimiento por Meta")
+        con_dato = metas[metas["cumplimiento_meta"].notna()]
+        if con_dato.empty:
+            st.info("Sin resultados cargados aún")
+        else:
+            criticas = con_dato.nsmallest(MAX_METAS_GRAFICO_CONTROL, "cumplimiento_meta")
+            st.bar_chart(criticas.set_index("meta")["cumplimiento_meta"].rename("Cumplimiento"))
+            if len(con_dato) > MAX_METAS_GRAFICO_CONTROL:
+                st.caption(f"Se muestran las {MAX_METAS_GRAFICO_CONTROL} metas con menor cumplimiento de {len(con_dato)}")
+        
+        st.subheader("⏳ Metas Pendientes de Resultado")
+        pendientes = metas[metas["situacion"] == "pendiente"].sort_values(["vencida", "vencimiento"], ascending=[False, True])
+        if pendientes.empty:
+            st.success("✅ Todas las metas tienen resultado cargado")
+        else:
+            st.dataframe(
+                pendientes[["acuerdo_id", "organismo_nombre", "ficha_nombre", "meta_numero", "meta_descripcion",
+                            "periodo_label", "vencimiento", "vencida"]],
+                use_container_width=True,
+                hide_index=True,
+                column_config={
+                    "acuerdo_id": "Acuerdo", "organismo_nombre": "Organismo", "ficha_nombre": "Ficha",
+                    "meta_numero": "N°", "meta_descripcion": "Meta", "periodo_label": "Período",
+                    "vencimiento": "Vencimiento", "vencida": st.column_config.CheckboxColumn("Vencida"),
+                },
+            )
     
-    # 📍 GRÁFICO 2: Barras (Streamlit nativo)
-    st.subheader("Cumplimiento por Meta")
+    # ==================== TABLA DE SEGUIMIENTOS ====================
+    st.header("📋 Seguimientos Recientes")
     
-    if seguimientos["seguimientos"]:
-        datos_metas = pd.DataFrame({
-            'Meta': ['Capacitación', 'Eficiencia', 'Calidad', 'Innovación'],
-            'Cumplimiento': [85, 78, 92, 65]
-        })
+    if not seguimientos.empty:
+        st.caption(" · ".join(f"{estado}: {cantidad}" for estado, cantidad in seguimientos["Estado"].value_counts().items()))
+        st.dataframe(seguimientos.tail(10), use_container_width=True, hide_index=True)
     else:
-        datos_metas = pd.DataFrame({
-            'Meta': ['Sin datos aún'],
-            'Cumplimiento': [0]
-        })
+        st.info("📝 No hay seguimientos cargados aún. Use 'Carga Resultados' para comenzar.")
     
-    st.bar_chart(datos_metas.set_index('Meta'))
-    
-    # ==================== TABLA DE SEGUIMIENTOS ====================
-    st.header("📋 Seguimientos Recientes")
-    
-    if seguimientos["seguimientos"]:
-        # Crear tabla con datos reales
-        datos_tabla = []
-        for seg in seguimientos["seguimientos"][-10:]:  # Últimos 10
-            datos_tabla.append({
-                "ID": seg["id"],
-                "Fecha": seg["fecha_creacion"][:10],
-                "Estado": seg["estado"],
-                "Responsable": seg.get("responsable", "No especificado")
-            })
-        
-        df = pd.DataFrame(datos_tabla)
-        st.dataframe(df, use_container_width=True)
-    else:
-        st.info("📝 No hay seguimientos cargados aún. Use 'Carga Resultados' para comenzar.")
-    
-    # ==================== ANÁLISIS Y RECOMENDACIONES ====================
-    st.header("📋 Análisis Ejecutivo")
+    # ==================== ANÁLISIS Y RECOMENDACIONES ====================
+    st.header("📋 Análisis Ejecutivo")
     
     cumplimiento_promedio = metricas["cumplimiento_promedio"]
     
-    if cumplimiento_promedio >= 90:
+    if cumplimiento_promedio is None:
+        estado = "⚪ SIN DATOS - Aún no hay resultados cargados"
+        recomendacion = "Cargar los resultados de las metas para evaluar el cumplimiento"
+    elif cumplimiento_promedio >= 90:
         estado = "✅ EXCELENTE - Cumplimiento sobresaliente"
         recomendacion = "Mantener las estrategias actuales"
     elif cumplimiento_promedio >= 80:
@@ -1069,8 +1628,8 @@ def mostrar_dashboard_seguro():
     
     with col3:
         if st.button("📄 Exportar Reporte CSV"):
-            if seguimientos["seguimientos"]:
-                df = pd.DataFrame(seguimientos["seguimientos"])
+            if not seguimientos.empty:
+                df = pd.DataFrame(obtener_gestor_seguimientos().cargar_seguimientos()["seguimientos"])
                 df.to_csv("reporte_seguimientos.csv", index=False, encoding='utf-8')
                 st.success("Reporte exportado como 'reporte_seguimientos.csv'")
             else:
@@ -1133,9 +1692,7 @@ def main():
         
         with col2:
             st.subheader("Estadísticas")
-            gestor = GestorSeguimientos()
-            seguimientos = gestor.cargar_seguimientos()
-            st.metric("Seguimientos Realizados", len(seguimientos["seguimientos"]))
+            st.metric("Seguimientos Realizados", len(obtener_gestor_seguimientos()))
     
     # 📍 NUEVA SECCIÓN - DASHBOARD DE CONTROL
     elif menu_option == "📈 Dashboard Control":
@@ -1243,19 +1800,25 @@ def system_status_card():
             except PermissionError:
                 st.error("❌ Problemas de permisos detectados")
             
-            # Espacio en disco
-            if os.path.exists(DATA_DIR):
-                total_size = 0
-                for dirpath, dirnames, filenames in os.walk(DATA_DIR):
-                    for f in filenames:
-                        fp = os.path.join(dirpath, f)
-                        total_size += os.path.getsize(fp)
-                st.info(f"💾 Uso de disco: {total_size / 1024 / 1024:.2f} MB")    
+            # Espacio de adjuntos (índice de metadatos, sin recorrer el disco)
+            almacen = obtener_almacen_adjuntos()
+            uso = almacen.uso()
+            ahorro = uso["bytes"] - uso["bytes_en_disco"]
+            st.info(f"💾 Adjuntos: {uso['archivos']} archivo(s), {uso['bytes_en_disco'] / 1024 / 1024:.2f} MB en disco"
+                    + (f" ({ahorro / 1024 / 1024:.2f} MB ahorrados por deduplicación)" if ahorro > 0 else ""))
+            if uso["archivos"]:
+                col_uso1, col_uso2 = st.columns(2)
+                with col_uso1:
+                    st.caption("Por organismo")
+                    st.dataframe(almacen.uso("organismo").head(10), use_container_width=True, hide_index=True)
+                with col_uso2:
+                    st.caption("Por tipo de archivo")
+                    st.dataframe(almacen.uso("mime").head(10), use_container_width=True, hide_index=True)
 
 # 🔹 Funciones de almacenamiento corregidas
 
-def save_json(path, obj):
-    """Guarda un objeto JSON con manejo robusto de errores de permisos"""
+def save_json(path, obj) -> bool:
+    """Guarda un objeto JSON con manejo robusto de errores de permisos; False si solo quedó en memoria"""
     try:
         # Asegurar que el directorio existe
         os.makedirs(os.path.dirname(path), exist_ok=True)
@@ -1277,6 +1840,7 @@ def save_json(path, obj):
                 json.dump(obj, f, ensure_ascii=False, indent=2)
             if os.path.exists(tmp):
                 os.remove(tmp)
+        return True
                 
     except Exception as e:
         st.error(f"Error al guardar {path}: {e}")
@@ -1284,6 +1848,7 @@ def save_json(path, obj):
         if "memory_backup" not in st.session_state:
             st.session_state.memory_backup = {}
         st.session_state.memory_backup[path] = obj
+        return False
 
 def load_json(path, default):
     """Carga un archivo JSON con respaldo en memoria"""
@@ -1401,482 +1966,587 @@ def get_next_counter(kind: str, year: int, prefix: Optional[str]=None) -> int:
     save_json(COUNTERS_FILE, counters)
     return next_num
 
-# === FUNCIONES DE EXPORTACIÓN/IMPRESIÓN ===
+# ==================== MOTOR DE PLANTILLAS HTML ====================
 
-def exportar_html_imprimible(agr: Dict[str, Any]) -> str:
-    """Genera HTML optimizado para impresión con diseño responsive"""
-    
-    # Preparar datos
-    organismo_nombre = agr.get('organismo_nombre', 'No especificado')
-    acuerdo_id = agr.get('id', 'Sin código')
-    año = agr.get('año', 'No especificado')
-    
-    html_content = f"""
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <meta charset="UTF-8">
-        <meta name="viewport" content="width=device-width, initial-scale=1.0">
-        <title>Acuerdo {acuerdo_id} - {organismo_nombre}</title>
-        <style>
-            /* RESET Y CONFIGURACIÓN GENERAL */
-            * {{
-                margin: 0;
-                padding: 0;
-                box-sizing: border-box;
-            }}
-            
-            body {{
-                font-family: 'Arial', sans-serif;
-                line-height: 1.6;
-                color: #333;
-                background: #fff;
-                margin: 0;
-                padding: 0;
-                width: 100%;
-            }}
-            
-            /* CONTENEDOR PRINCIPAL - ANCHO COMPLETO */
-            .container {{
-                width: 100%;
-                max-width: 100%;
-                margin: 0 auto;
-                padding: 20px;
-            }}
-            
-            /* ENCABEZADO */
-            .header {{
-                text-align: center;
-                border-bottom: 3px solid #007bff;
-                padding: 30px 20px;
-                margin-bottom: 30px;
-                background: linear-gradient(135deg, #007bff 0%, #0056b3 100%);
-                color: white;
-                border-radius: 10px;
-            }}
-            
-            .header h1 {{
-                font-size: 28px;
-                margin-bottom: 10px;
-                font-weight: bold;
-            }}
-            
-            .header h2 {{
-                font-size: 22px;
-                margin-bottom: 5px;
-                font-weight: normal;
-            }}
-            
-            .header h3 {{
-                font-size: 18px;
-                margin-bottom: 15px;
-                opacity: 0.9;
-            }}
-            
-            .header p {{
-                font-size: 14px;
-                opacity: 0.8;
-            }}
-            
-            /* SECCIONES */
-            .section {{
-                margin: 30px 0;
-                padding: 25px;
-                border: 1px solid #e0e0e0;
-                border-radius: 8px;
-                background: #fafafa;
-                page-break-inside: avoid;
-            }}
-            
-            .section h3 {{
-                color: #007bff;
-                border-bottom: 2px solid #007bff;
-                padding-bottom: 10px;
-                margin-bottom: 20px;
-                font-size: 20px;
-            }}
-            
-            /* TABLAS MEJORADAS */
-            table {{
-                width: 100%;
-                border-collapse: collapse;
-                margin: 15px 0;
-                font-size: 14px;
-            }}
-            
-            th {{
-                background: #007bff;
-                color: white;
-                padding: 12px 15px;
-                text-align: left;
-                font-weight: bold;
-            }}
-            
-            td {{
-                padding: 10px 15px;
-                border: 1px solid #ddd;
-            }}
-            
-            tr:nth-child(even) {{
-                background-color: #f8f9fa;
-            }}
-            
-            /* FICHAS */
-            .ficha {{
-                background: white;
-                margin: 20px 0;
-                padding: 20px;
-                border-left: 5px solid #28a745;
-                border-radius: 5px;
-                box-shadow: 0 2px 5px rgba(0,0,0,0.1);
-                page-break-inside: avoid;
-            }}
-            
-            .ficha h4 {{
-                color: #28a745;
-                margin-bottom: 15px;
-                font-size: 18px;
-            }}
-            
-            /* METAS */
-            .meta {{
-                background: #f8f9fa;
-                margin: 15px 0;
-                padding: 15px;
-                border-radius: 5px;
-                border: 1px solid #e9ecef;
-            }}
-            
-            .meta.hito {{
-                background: #e3f2fd;
-                border-left: 4px solid #2196f3;
-            }}
-            
-            .cumplimiento {{
-                font-weight: bold;
-                color: #28a745;
-            }}
-            
-            /* ESTADOS DE META */
-            .estado-meta {{
-                display: inline-block;
-                padding: 4px 8px;
-                border-radius: 4px;
-                font-size: 12px;
-                font-weight: bold;
-            }}
-            
-            .estado-cumplida {{ background: #d4edda; color: #155724; }}
-            .estado-parcial {{ background: #fff3cd; color: #856404; }}
-            .estado-no-cumplida {{ background: #f8d7da; color: #721c24; }}
-            
-            /* FOOTER */
-            .footer {{
-                text-align: center;
-                margin-top: 50px;
-                padding: 20px;
-                border-top: 2px solid #ddd;
-                color: #666;
-                font-size: 12px;
-            }}
-            
-            /* ESTILOS PARA IMPRESIÓN */
-            @media print {{
-                body {{
-                    margin: 0;
-                    padding: 0;
-                    background: white;
-                }}
-                
-                .container {{
-                    width: 100%;
-                    margin: 0;
-                    padding: 15px;
-                    box-shadow: none;
-                }}
-                
-                .header {{
-                    background: white !important;
-                    color: black !important;
-                    border-bottom: 3px solid black;
-                }}
-                
-                .section {{
-                    border: 1px solid #000;
-                    margin: 20px 0;
-                }}
-                
-                .no-print {{
-                    display: none !important;
-                }}
-                
-                .ficha, .meta {{
-                    page-break-inside: avoid;
-                }}
-                
-                h1, h2, h3 {{
-                    page-break-after: avoid;
-                }}
-            }}
-            
-            /* RESPONSIVE */
-            @media (max-width: 768px) {{
-                .container {{
-                    padding: 10px;
-                }}
-                
-                .header h1 {{
-                    font-size: 24px;
-                }}
-                
-                table {{
-                    font-size: 12px;
-                }}
-            }}
-        </style>
-    </head>
-    <body>
-        <div class="container">
-            <div class="header">
-                <h1>📊 SISTEMA DE COMPROMISOS DE GESTIÓN</h1>
-                <h2>ACUERDO: {acuerdo_id}</h2>
-                <h3>{organismo_nombre}</h3>
-                <p>Generado el: {datetime.now().strftime('%d/%m/%Y %H:%M')} | Año: {año}</p>
-            </div>
-    """
-    
-    # SECCIÓN DE INFORMACIÓN GENERAL
-    html_content += f"""
-            <div class="section">
-                <h3>📋 INFORMACIÓN GENERAL DEL ACUERDO</h3>
-                <table>
-                    <tr><th style="width: 30%;">Organismo:</th><td>{organismo_nombre}</td></tr>
-                    <tr><th>Tipo de Organismo:</th><td>{agr.get('organismo_tipo', 'No especificado')}</td></tr>
-                    <tr><th>Naturaleza Jurídica:</th><td>{agr.get('naturaleza_juridica', 'No especificado')}</td></tr>
-                    <tr><th>Año:</th><td>{año}</td></tr>
-                    <tr><th>Vigencia:</th><td>{agr.get('vigencia_desde', '')} al {agr.get('vigencia_hasta', '')}</td></tr>
-                    <tr><th>Estado:</th><td>{agr.get('estado', 'No especificado')}</td></tr>
-                    <tr><th>Organismo de Enlace:</th><td>{agr.get('organismo_enlace', 'No especificado')}</td></tr>
-                    <tr><th>Tipo de Compromiso:</th><td>{agr.get('tipo_compromiso', 'No especificado')}</td></tr>
-                </table>
-            </div>
-    """
-    
-    # SECCIÓN DE OBJETO DEL ACUERDO
-    if agr.get('objeto'):
-        html_content += f"""
-            <div class="section">
-                <h3>🎯 OBJETO DEL ACUERDO</h3>
-                <p style="text-align: justify; line-height: 1.8;">{agr.get('objeto', 'No especificado')}</p>
-            </div>
-        """
-    
-    # SECCIÓN DE PARTES FIRMANTES
-    if agr.get('partes_firmantes'):
-        html_content += f"""
-            <div class="section">
-                <h3>📝 PARTES FIRMANTES</h3>
-                <p style="text-align: justify; line-height: 1.8;">{agr.get('partes_firmantes', 'No especificado')}</p>
+# 🎨 CSS COMPARTIDO POR LOS REPORTES HTML (se define una sola vez)
+CSS_BASE_INFORME = """
+        body { font-family: Arial, sans-serif; margin: 20px; }
+"""
+
+CSS_INFORME_RESUMEN = CSS_BASE_INFORME + """
+        .header { text-align: center; border-bottom: 2px solid #333; padding-bottom: 10px; }
+        .acuerdo { margin: 20px 0; padding: 15px; border: 1px solid #ddd; }
+        .metricas { background: #f5f5f5; padding: 10px; margin: 10px 0; }
+"""
+
+CSS_INFORME_DETALLE = CSS_BASE_INFORME + """
+        body { margin: 40px; }
+        .acuerdo { page-break-inside: avoid; margin: 30px 0; }
+        .ficha { background: #f9f9f9; padding: 15px; margin: 10px 0; }
+        .meta { border-left: 3px solid #007cba; padding-left: 10px; }
+"""
+
+CSS_TABLA_INDICADORES = CSS_BASE_INFORME + """
+        h1 { color: #2c3e50; }
+        table { border-collapse: collapse; width: 100%; }
+        th, td { border: 1px solid #ddd; padding: 8px; text-align: left; }
+        th { background-color: #34495e; color: white; }
+        tr:nth-child(even) { background-color: #f2f2f2; }
+"""
+
+CSS_REPORTE_INDICADORES = """
+        body { font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif; margin: 0; padding: 20px; background: #f5f6fa; }
+        .container { max-width: 1200px; margin: 0 auto; background: white; padding: 30px; border-radius: 10px; box-shadow: 0 2px 10px rgba(0,0,0,0.1); }
+        .header { background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); color: white; padding: 30px; border-radius: 10px; margin-bottom: 30px; text-align: center; }
+        .metricas { display: grid; grid-template-columns: repeat(auto-fit, minmax(250px, 1fr)); gap: 20px; margin: 30px 0; }
+        .metrica { background: white; padding: 20px; border-radius: 10px; border-left: 5px solid #667eea; box-shadow: 0 2px 5px rgba(0,0,0,0.1); text-align: center; }
+        .metrica h3 { margin: 0 0 10px 0; color: #2c3e50; font-size: 14px; text-transform: uppercase; }
+        .metrica .valor { font-size: 32px; font-weight: bold; color: #667eea; margin: 10px 0; }
+        .tabla { width: 100%; border-collapse: collapse; margin: 30px 0; background: white; border-radius: 10px; overflow: hidden; box-shadow: 0 2px 5px rgba(0,0,0,0.1); }
+        .tabla th { background: #34495e; color: white; padding: 15px; text-align: left; font-weight: 600; }
+        .tabla td { padding: 12px 15px; border-bottom: 1px solid #ecf0f1; }
+        .tabla tr:nth-child(even) { background: #f8f9fa; }
+        .tabla tr:hover { background: #e8f4f8; }
+        .estado-cumplido { color: #27ae60; font-weight: bold; }
+        .estado-en_progreso { color: #f39c12; font-weight: bold; }
+        .estado-rezagado { color: #c0392b; font-weight: bold; }
+        .estado-sin_meta { color: #7f8c8d; }
+        .resumen { background: linear-gradient(135deg, #74b9ff 0%, #0984e3 100%); color: white; padding: 25px; border-radius: 10px; margin: 30px 0; }
+        .pie { text-align: center; margin-top: 40px; padding: 20px; background: #f8f9fa; border-radius: 10px; }
+"""
+
+CSS_DOCUMENTO_IMPRIMIBLE = """
+        /* RESET Y CONFIGURACIÓN GENERAL */
+        * { margin: 0; padding: 0; box-sizing: border-box; }
+        
+        body {
+            font-family: 'Arial', sans-serif;
+            line-height: 1.6;
+            color: #333;
+            background: #fff;
+            margin: 0;
+            padding: 0;
+            width: 100%;
+        }
+        
+        /* CONTENEDOR PRINCIPAL - ANCHO COMPLETO */
+        .container { width: 100%; max-width: 100%; margin: 0 auto; padding: 20px; }
+        
+        /* ENCABEZADO */
+        .header {
+            text-align: center;
+            border-bottom: 3px solid #007bff;
+            padding: 30px 20px;
+            margin-bottom: 30px;
+            background: linear-gradient(135deg, #007bff 0%, #0056b3 100%);
+            color: white;
+            border-radius: 10px;
+        }
+        .header h1 { font-size: 28px; margin-bottom: 10px; font-weight: bold; }
+        .header h2 { font-size: 22px; margin-bottom: 5px; font-weight: normal; }
+        .header h3 { font-size: 18px; margin-bottom: 15px; opacity: 0.9; }
+        .header p { font-size: 14px; opacity: 0.8; }
+        
+        /* SECCIONES */
+        .section {
+            margin: 30px 0;
+            padding: 25px;
+            border: 1px solid #e0e0e0;
+            border-radius: 8px;
+            background: #fafafa;
+            page-break-inside: avoid;
+        }
+        .section h3 {
+            color: #007bff;
+            border-bottom: 2px solid #007bff;
+            padding-bottom: 10px;
+            margin-bottom: 20px;
+            font-size: 20px;
+        }
+        
+        /* TABLAS MEJORADAS */
+        table { width: 100%; border-collapse: collapse; margin: 15px 0; font-size: 14px; }
+        th { background: #007bff; color: white; padding: 12px 15px; text-align: left; font-weight: bold; }
+        td { padding: 10px 15px; border: 1px solid #ddd; }
+        tr:nth-child(even) { background-color: #f8f9fa; }
+        
+        /* FICHAS */
+        .ficha {
+            background: white;
+            margin: 20px 0;
+            padding: 20px;
+            border-left: 5px solid #28a745;
+            border-radius: 5px;
+            box-shadow: 0 2px 5px rgba(0,0,0,0.1);
+            page-break-inside: avoid;
+        }
+        .ficha h4 { color: #28a745; margin-bottom: 15px; font-size: 18px; }
+        
+        /* METAS */
+        .meta { background: #f8f9fa; margin: 15px 0; padding: 15px; border-radius: 5px; border: 1px solid #e9ecef; }
+        .meta.hito { background: #e3f2fd; border-left: 4px solid #2196f3; }
+        .cumplimiento { font-weight: bold; color: #28a745; }
+        
+        /* ESTADOS DE META */
+        .estado-meta { display: inline-block; padding: 4px 8px; border-radius: 4px; font-size: 12px; font-weight: bold; }
+        .estado-cumplida { background: #d4edda; color: #155724; }
+        .estado-parcial { background: #fff3cd; color: #856404; }
+        .estado-no-cumplida { background: #f8d7da; color: #721c24; }
+        
+        /* FOOTER */
+        .footer {
+            text-align: center;
+            margin-top: 50px;
+            padding: 20px;
+            border-top: 2px solid #ddd;
+            color: #666;
+            font-size: 12px;
+        }
+        
+        /* ESTILOS PARA IMPRESIÓN */
+        @media print {
+            body { margin: 0; padding: 0; background: white; }
+            .container { width: 100%; margin: 0; padding: 15px; box-shadow: none; }
+            .header { background: white !important; color: black !important; border-bottom: 3px solid black; }
+            .section { border: 1px solid #000; margin: 20px 0; }
+            .no-print { display: none !important; }
+            .ficha, .meta { page-break-inside: avoid; }
+            h1, h2, h3 { page-break-after: avoid; }
+        }
+        
+        /* RESPONSIVE */
+        @media (max-width: 768px) {
+            .container { padding: 10px; }
+            .header h1 { font-size: 24px; }
+            table { font-size: 12px; }
+        }
+"""
+
+# 🧩 PLANTILLAS COMPILADAS (string.Template se parsea una vez al importar el módulo)
+PLANTILLA_APERTURA_HTML = Template("""<!DOCTYPE html>
+<html lang="es">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>$titulo</title>
+    <style>$css</style>
+</head>
+<body>
+""")
+
+CIERRE_HTML = """</body>
+</html>
+"""
+
+# --- Documento imprimible de un acuerdo (exportar_html_imprimible) ---
+PLANTILLA_IMPRIMIBLE_ENCABEZADO = Template("""
+    <div class="container">
+        <div class="header">
+            <h1>📊 SISTEMA DE COMPROMISOS DE GESTIÓN</h1>
+            <h2>ACUERDO: $acuerdo_id</h2>
+            <h3>$organismo</h3>
+            <p>Generado el: $generado | Año: $anio</p>
+        </div>
+""")
+
+PLANTILLA_IMPRIMIBLE_INFO_GENERAL = Template("""
+        <div class="section">
+            <h3>📋 INFORMACIÓN GENERAL DEL ACUERDO</h3>
+            <table>
+                <tr><th style="width: 30%;">Organismo:</th><td>$organismo</td></tr>
+                <tr><th>Tipo de Organismo:</th><td>$organismo_tipo</td></tr>
+                <tr><th>Naturaleza Jurídica:</th><td>$naturaleza</td></tr>
+                <tr><th>Año:</th><td>$anio</td></tr>
+                <tr><th>Vigencia:</th><td>$vigencia_desde al $vigencia_hasta</td></tr>
+                <tr><th>Estado:</th><td>$estado</td></tr>
+                <tr><th>Organismo de Enlace:</th><td>$enlace</td></tr>
+                <tr><th>Tipo de Compromiso:</th><td>$tipo_compromiso</td></tr>
+            </table>
+        </div>
+""")
+
+PLANTILLA_IMPRIMIBLE_TEXTO = Template("""
+        <div class="section">
+            <h3>$titulo</h3>
+            <p style="text-align: justify; line-height: 1.8;">$texto</p>
+        </div>
+""")
+
+PLANTILLA_IMPRIMIBLE_CLAUSULA = Template("""
+            <div style="margin: 15px 0; padding: 10px; background: white; border-radius: 5px;">
+                <strong>Cláusula $numero:</strong> $texto
             </div>
-        """
-    
-    # SECCIÓN DE CLAÚSULAS (NUEVA)
-    if agr.get('clausulas'):
-        clausulas_no_vacias = [c for c in agr.get('clausulas', []) if c.strip()]
-        if clausulas_no_vacias:
-            html_content += """
-                <div class="section">
-                    <h3>📝 CLAÚSULAS DEL ACUERDO</h3>
-            """
-            for i, clausula in enumerate(clausulas_no_vacias, 1):
-                html_content += f"""
-                    <div style="margin: 15px 0; padding: 10px; background: white; border-radius: 5px;">
-                        <strong>Cláusula {i}:</strong> {clausula}
-                    </div>
-                """
-            html_content += "</div>"
-    
-    # 🆕 SECCIÓN DE FIRMAS - AGREGAR JUSTO DESPUÉS DE LAS CLAÚSULAS
-    html_content += """
-    <div class="section" style="page-break-before: always; margin-top: 50px;">
-        <h3 style="text-align: center; color: #2c3e50; border-bottom: 3px solid #007bff; padding-bottom: 15px;">
-            📝 FIRMAS DEL ACUERDO
-        </h3>
-        
-        <div style="display: flex; justify-content: space-between; margin: 50px 0; align-items: flex-start;">
-            <!-- FIRMA CONTRAPARTE -->
+""")
+
+BLOQUE_IMPRIMIBLE_FIRMA = """
             <div style="text-align: center; width: 45%; padding: 20px; border: 1px solid #ddd; border-radius: 8px; background: #f9f9f9;">
-                <h4 style="color: #34495e; margin-bottom: 30px;">👤 CONTRAPARTE</h4>
-                
+                <h4 style="color: #34495e; margin-bottom: 30px;">👤 {parte}</h4>
                 <div style="border-bottom: 2px solid #7f8c8d; padding: 80px 20px 30px 20px; margin: 20px 0; min-height: 120px; background: white;">
                     <p style="color: #95a5a6; font-style: italic;">Espacio para firma y sello</p>
                 </div>
-                
                 <div style="text-align: left; margin-top: 20px;">
                     <p><strong>Nombre:</strong> ________________________________</p>
                     <p><strong>Cargo:</strong> _________________________________</p>
                     <p><strong>Institución:</strong> ___________________________</p>
                 </div>
             </div>
-            
-            <!-- FIRMA INSTITUCIÓN -->
-            <div style="text-align: center; width: 45%; padding: 20px; border: 1px solid #ddd; border-radius: 8px; background: #f9f9f9;">
-                <h4 style="color: #34495e; margin-bottom: 30px;">👤 INSTITUCIÓN</h4>
-                
-                <div style="border-bottom: 2px solid #7f8c8d; padding: 80px 20px 30px 20px; margin: 20px 0; min-height: 120px; background: white;">
-                    <p style="color: #95a5a6; font-style: italic;">Espacio para firma y sello</p>
-                </div>
-                
-                <div style="text-align: left; margin-top: 20px;">
-                    <p><strong>Nombre:</strong> ________________________________</p>
-                    <p><strong>Cargo:</strong> _________________________________</p>
-                    <p><strong>Institución:</strong> ___________________________</p>
-                </div>
+"""
+
+BLOQUE_IMPRIMIBLE_FIRMAS = """
+        <div class="section" style="page-break-before: always; margin-top: 50px;">
+            <h3 style="text-align: center; color: #2c3e50; border-bottom: 3px solid #007bff; padding-bottom: 15px;">
+                📝 FIRMAS DEL ACUERDO
+            </h3>
+            <div style="display: flex; justify-content: space-between; margin: 50px 0; align-items: flex-start;">
+""" + BLOQUE_IMPRIMIBLE_FIRMA.format(parte="CONTRAPARTE") + BLOQUE_IMPRIMIBLE_FIRMA.format(parte="INSTITUCIÓN") + """
+            </div>
+            <div style="text-align: center; margin-top: 40px; padding: 20px; background: #e8f4f8; border-radius: 8px;">
+                <p style="font-size: 16px; font-weight: bold; color: #2c3e50;">FECHA DE FIRMA: _________________________</p>
+                <p style="color: #7f8c8d; font-size: 14px; margin-top: 10px;">(dd/mm/aaaa)</p>
             </div>
         </div>
-        
-        <!-- FECHA DE FIRMA -->
-        <div style="text-align: center; margin-top: 40px; padding: 20px; background: #e8f4f8; border-radius: 8px;">
-            <p style="font-size: 16px; font-weight: bold; color: #2c3e50;">
-                FECHA DE FIRMA: _________________________
-            </p>
-            <p style="color: #7f8c8d; font-size: 14px; margin-top: 10px;">
-                (dd/mm/aaaa)
-            </p>
+"""
+
+PLANTILLA_IMPRIMIBLE_FICHA = Template("""
+            <div class="ficha">
+                <h4>📋 $ficha_id - $nombre</h4>
+                <table>
+                    <tr><th style="width: 25%;">Tipo de Meta:</th><td>$tipo_meta</td></tr>
+                    <tr><th>Responsables de Cumplimiento:</th><td>$responsables_cumpl</td></tr>
+                    <tr><th>Objetivo:</th><td>$objetivo</td></tr>
+                    <tr><th>Indicador:</th><td>$indicador</td></tr>
+                    <tr><th>Forma de Cálculo:</th><td>$forma_calculo</td></tr>
+                    <tr><th>Fuente de Información:</th><td>$fuente</td></tr>
+                    <tr><th>Valor Base:</th><td>$valor_base</td></tr>
+                    <tr><th>Responsables de Seguimiento:</th><td>$responsables_seguimiento</td></tr>
+                    <tr><th>Observaciones:</th><td>$observaciones</td></tr>
+                    <tr><th>Requiere Salvaguarda:</th><td>$salvaguarda</td></tr>$fila_salvaguarda
+                </table>
+""")
+
+PLANTILLA_IMPRIMIBLE_META = Template("""
+                <div class="meta $clase_hito">
+                    <div style="display: flex; justify-content: between; align-items: center; margin-bottom: 10px;">
+                        <h6 style="margin: 0; flex-grow: 1;">Meta $numero: $descripcion</h6>
+                        <span class="estado-meta $estado_clase">$estado_texto</span>
+                    </div>
+                    <table>
+                        <tr>
+                            <th style="width: 20%;">Unidad:</th><td>$unidad</td>
+                            <th style="width: 20%;">Valor Objetivo:</th><td>$valor_objetivo</td>
+                        </tr>
+                        <tr>
+                            <th>Sentido:</th><td>$sentido</td>
+                            <th>Frecuencia:</th><td>$frecuencia</td>
+                        </tr>
+                        <tr>
+                            <th>Vencimiento:</th><td>$vencimiento</td>
+                            <th>Es Hito:</th><td>$es_hito</td>
+                        </tr>
+                        <tr>
+                            <th>Ponderación:</th><td>$ponderacion%</td>
+                            <th class="cumplimiento">Cumplimiento Calculado:</th>
+                            <td class="cumplimiento">$cumplimiento</td>
+                        </tr>
+                        <tr><th>Observaciones:</th><td colspan="3">$observaciones</td></tr>$rangos
+                    </table>
+                </div>
+""")
+
+PLANTILLA_IMPRIMIBLE_RANGO = Template("""
+                                <tr><td>$min</td><td>$max</td><td>$porcentaje%</td></tr>""")
+
+PLANTILLA_IMPRIMIBLE_PIE = Template("""
+        <div class="footer">
+            <p>Documento generado automáticamente por el Sistema de Compromisos de Gestión</p>
+            <p>Fecha de generación: $generado</p>
+            <p>Este documento es confidencial y para uso exclusivo de las partes involucradas</p>
         </div>
     </div>
-    """
+""")
 
-    # SECCIÓN DE FICHAS DE COMPROMISO
-    if agr.get('fichas'):
-        html_content += """
-            <div class="section">
-                <h3>📊 FICHAS DE COMPROMISO</h3>
-        """
+# --- Informes por año (generar_pdf_informe / generar_html_informe) ---
+PLANTILLA_INFORME_RESUMEN_ENCABEZADO = Template("""
+    <div class="header">
+        <h1>REPORTE DE COMPROMISOS DE GESTIÓN</h1>
+        <h2>Año: $anio</h2>
+        <p>Filtro organismo: $filtro</p>
+        <p>Generado: $generado</p>
+    </div>
+""")
+
+PLANTILLA_INFORME_RESUMEN_ACUERDO = Template("""
+    <div class="acuerdo">
+        <h3>$acuerdo_id - $organismo</h3>
+        <div class="metricas">
+            <strong>Cumplimiento: $cumplimiento</strong> |
+            Fichas: $fichas |
+            Metas: $metas
+        </div>
+    </div>
+""")
+
+PLANTILLA_INFORME_DETALLE_META = Template("""
+            <div class='meta'>
+                <h4>Meta $numero: $descripcion</h4>
+                <p>Ponderación: $ponderacion% | Cumplimiento: $cumplimiento%</p>
+            </div>
+""")
+
+# --- Reporte simple de indicadores (generar_reporte_html_simple) ---
+PLANTILLA_INDICADORES_ENCABEZADO = Template("""
+    <h1>Reporte de Indicadores</h1>
+    <p><strong>Generado:</strong> $generado</p>
+    <p><strong>Total indicadores:</strong> $total</p>
+    <table>
+        <tr>
+            <th>ID</th><th>Nombre</th><th>Valor</th><th>Meta</th><th>Unidad</th><th>Departamento</th><th>Fecha</th>
+        </tr>
+""")
+
+PLANTILLA_INDICADORES_FILA = Template("""
+        <tr><td>$id</td><td>$nombre</td><td>$valor</td><td>$meta</td><td>$unidad</td><td>$departamento</td><td>$fecha</td></tr>""")
+
+PIE_INDICADORES = """
+    </table>
+    <p><em>Generado por Sistema de Seguimiento</em></p>
+"""
+
+# --- Reporte completo de indicadores (generar_reporte_html_streamlit) ---
+PLANTILLA_REPORTE_INDICADORES_ENCABEZADO = Template("""
+    <div class="container">
+        <div class="header">
+            <h1>📊 REPORTE DE INDICADORES</h1>
+            <p>Sistema de Seguimiento - Generado el $generado</p>
+        </div>
         
-        for ficha in agr.get('fichas', []):
-            # Determinar clase CSS para el estado de la ficha
-            estado_ficha = "estado-pendiente"
-            if any(meta.get('cumplimiento_calc') for meta in ficha.get('metas', [])):
-                estado_ficha = "estado-en-progreso"
-            
-            html_content += f"""
-                <div class="ficha">
-                    <h4>📋 {ficha.get('id', '')} - {ficha.get('nombre', 'Sin nombre')}</h4>
-                    <table>
-                        <tr><th style="width: 25%;">Tipo de Meta:</th><td>{ficha.get('tipo_meta', 'No especificado')}</td></tr>
-                        <tr><th>Responsables de Cumplimiento:</th><td>{ficha.get('responsables_cumpl', 'No especificado')}</td></tr>
-                        <tr><th>Objetivo:</th><td>{ficha.get('objetivo', 'No especificado')}</td></tr>
-                        <tr><th>Indicador:</th><td>{ficha.get('indicador', 'No especificado')}</td></tr>
-                        <tr><th>Forma de Cálculo:</th><td>{ficha.get('forma_calculo', 'No especificado')}</td></tr>
-                        <tr><th>Fuente de Información:</th><td>{ficha.get('fuente', 'No especificado')}</td></tr>
-                        <tr><th>Valor Base:</th><td>{ficha.get('valor_base', 'No especificado')}</td></tr>
-                        <tr><th>Responsables de Seguimiento:</th><td>{ficha.get('responsables_seguimiento', 'No especificado')}</td></tr>
-                        <tr><th>Observaciones:</th><td>{ficha.get('observaciones', 'No especificado')}</td></tr>
-                        <tr><th>Requiere Salvaguarda:</th><td>{"SÍ" if ficha.get('salvaguarda_flag') else "NO"}</td></tr>
-            """
-            
-            if ficha.get('salvaguarda_flag'):
-                html_content += f"""<tr><th>Texto de Salvaguarda:</th><td>{ficha.get('salvaguarda_text', '')}</td></tr>"""
-            
-            html_content += """
-                    </table>
-            """
-            
-            # METAS ASOCIADAS
-            if ficha.get('metas'):
-                html_content += """
-                    <h5 style="margin-top: 20px; color: #007bff;">🎯 METAS ASOCIADAS:</h5>
-                """
-                
-                for meta in ficha.get('metas', []):
-                    # Determinar estado de la meta para el color
-                    cumplimiento_meta = meta.get('cumplimiento_calc')
-                    estado_clase = "estado-no-cumplida"
-                    estado_texto = "No Cumplida"
-                    
-                    if cumplimiento_meta is not None:
-                        if cumplimiento_meta >= 95:
-                            estado_clase = "estado-cumplida"
-                            estado_texto = "Cumplida"
-                        elif cumplimiento_meta >= 60:
-                            estado_clase = "estado-parcial"
-                            estado_texto = "Parcial"
-                    
-                    html_content += f"""
-                        <div class="meta {'hito' if meta.get('es_hito') else ''}">
-                            <div style="display: flex; justify-content: between; align-items: center; margin-bottom: 10px;">
-                                <h6 style="margin: 0; flex-grow: 1;">Meta {meta.get('numero', '')}: {meta.get('descripcion', 'Sin descripción')}</h6>
-                                <span class="estado-meta {estado_clase}">{estado_texto}</span>
-                            </div>
-                            <table>
-                                <tr>
-                                    <th style="width: 20%;">Unidad:</th><td>{meta.get('unidad', 'No especificado')}</td>
-                                    <th style="width: 20%;">Valor Objetivo:</th><td>{meta.get('valor_objetivo', 'No especificado')}</td>
-                                </tr>
-                                <tr>
-                                    <th>Sentido:</th><td>{meta.get('sentido', 'No especificado')}</td>
-                                    <th>Frecuencia:</th><td>{meta.get('frecuencia', 'No especificado')}</td>
-                                </tr>
-                                <tr>
-                                    <th>Vencimiento:</th><td>{meta.get('vencimiento', 'No especificado')}</td>
-                                    <th>Es Hito:</th><td>{"SÍ" if meta.get('es_hito') else "NO"}</td>
-                                </tr>
-                                <tr>
-                                    <th>Ponderación:</th><td>{meta.get('ponderacion', 0)}%</td>
-                                    <th class="cumplimiento">Cumplimiento Calculado:</th>
-                                    <td class="cumplimiento">{f"{meta.get('cumplimiento_calc', 0):.2f}%" if meta.get('cumplimiento_calc') is not None else "No calculado"}</td>
-                                </tr>
-                                <tr><th>Observaciones:</th><td colspan="3">{meta.get('observaciones', 'No especificado')}</td></tr>
-                    """
-                    
-                    # RANGOS DE CUMPLIMIENTO
-                    if meta.get('rango'):
-                        html_content += """
-                                <tr><td colspan="4">
-                                    <h7 style="display: block; margin: 10px 0 5px 0; font-weight: bold;">📈 Rangos de Cumplimiento:</h7>
-                                    <table style="width: 100%; margin: 5px 0;">
-                                        <tr><th>Mínimo</th><th>Máximo</th><th>Porcentaje</th></tr>
-                        """
-                        for rango in meta.get('rango', []):
-                            html_content += f"""
-                                        <tr>
-                                            <td>{rango.get('min', '-')}</td>
-                                            <td>{rango.get('max', '-')}</td>
-                                            <td>{rango.get('porcentaje', '-')}%</td>
-                                        </tr>
-                            """
-                        html_content += """
-                                    </table>
-                                </td></tr>
-                        """
-                    
-                    html_content += """
-                            </table>
-                        </div>
-                    """
-            
-            html_content += "</div>"  # Cierre de ficha
+        <div class="resumen">
+            <h2>🎯 RESUMEN EJECUTIVO</h2>
+            <p>Reporte consolidado de todos los indicadores del sistema con análisis de cumplimiento y tendencias.</p>
+        </div>
         
-        html_content += "</div>"  # Cierre de sección de fichas
-    
-    # FOOTER
-    html_content += f"""
-            <div class="footer">
-                <p>Documento generado automáticamente por el Sistema de Compromisos de Gestión</p>
-                <p>Fecha de generación: {datetime.now().strftime('%d/%m/%Y %H:%M')}</p>
-                <p>Este documento es confidencial y para uso exclusivo de las partes involucradas</p>
+        <div class="metricas">
+""")
+
+PLANTILLA_REPORTE_INDICADORES_METRICA = Template("""
+            <div class="metrica">
+                <h3>$titulo</h3>
+                <div class="valor">$valor</div>
+                <p>$detalle</p>
             </div>
+""")
+
+REPORTE_INDICADORES_TABLA_APERTURA = """
+        </div>
+        
+        <h2>📋 DETALLE DE INDICADORES</h2>
+        <table class="tabla">
+            <thead>
+                <tr>
+                    <th>ID</th>
+                    <th>Nombre del Indicador</th>
+                    <th>Valor Actual</th>
+                    <th>Meta</th>
+                    <th>% Cumplimiento</th>
+                    <th>Estado</th>
+                    <th>Unidad</th>
+                    <th>Departamento</th>
+                    <th>Fecha</th>
+                </tr>
+            </thead>
+            <tbody>
+"""
+
+PLANTILLA_REPORTE_INDICADORES_FILA = Template("""
+                <tr>
+                    <td>$id</td>
+                    <td><strong>$nombre</strong></td>
+                    <td>$valor</td>
+                    <td>$meta</td>
+                    <td>$cumplimiento</td>
+                    <td class="estado-$clase_estado">$estado</td>
+                    <td>$unidad</td>
+                    <td>$departamento</td>
+                    <td>$fecha</td>
+                </tr>""")
+
+PIE_REPORTE_INDICADORES = """
+            </tbody>
+        </table>
+        
+        <div class="pie">
+            <p><em>📄 Reporte generado automáticamente por el Sistema de Seguimiento de Indicadores</em></p>
+            <p><strong>Para más información, consulte la plataforma digital del sistema.</strong></p>
         </div>
-    </body>
-    </html>
+    </div>
+"""
+
+def _h(valor: Any, defecto: str = "") -> str:
+    """Escapa un valor para insertarlo en HTML (None → defecto)"""
+    if valor is None:
+        valor = defecto
+    return html.escape(str(valor))
+
+def render_html(fragmentos: Iterable[str], destino=None) -> Optional[str]:
     """
+    Une los fragmentos de un documento en una sola pasada.
     
-    return html_content
+    Args:
+        fragmentos: Iterable (normalmente un generador) de trozos de HTML
+        destino: Objeto con .write() (archivo, respuesta); si se indica, los
+                 fragmentos se escriben a medida que se generan
+                 
+    Returns:
+        str con el documento completo, o None si se escribió en destino
+    """
+    if destino is None:
+        return "".join(fragmentos)
+    for fragmento in fragmentos:
+        destino.write(fragmento)
+    return None
 
-def generate_agreement_code(year: int, external_prefix: Optional[str]=None) -> str:
+def _estado_meta_imprimible(cumplimiento: Optional[float]) -> tuple:
+    """Clase CSS y texto del estado de una meta en el documento imprimible"""
+    if cumplimiento is not None:
+        if cumplimiento >= 95:
+            return "estado-cumplida", "Cumplida"
+        if cumplimiento >= 60:
+            return "estado-parcial", "Parcial"
+    return "estado-no-cumplida", "No Cumplida"
+
+def _html_meta_imprimible(meta: Dict[str, Any]) -> str:
+    """HTML de una meta (con su tabla de rangos) para el documento imprimible"""
+    cumplimiento = meta.get('cumplimiento_calc')
+    estado_clase, estado_texto = _estado_meta_imprimible(cumplimiento)
+    
+    rangos = ""
+    if meta.get('rango'):
+        filas = "".join(
+            PLANTILLA_IMPRIMIBLE_RANGO.substitute(
+                min=_h(r.get('min', '-')), max=_h(r.get('max', '-')), porcentaje=_h(r.get('porcentaje', '-'))
+            )
+            for r in meta.get('rango', [])
+        )
+        rangos = f"""
+                        <tr><td colspan="4">
+                            <h7 style="display: block; margin: 10px 0 5px 0; font-weight: bold;">📈 Rangos de Cumplimiento:</h7>
+                            <table style="width: 100%; margin: 5px 0;">
+                                <tr><th>Mínimo</th><th>Máximo</th><th>Porcentaje</th></tr>{filas}
+                            </table>
+                        </td></tr>"""
+    
+    return PLANTILLA_IMPRIMIBLE_META.substitute(
+        clase_hito="hito" if meta.get('es_hito') else "",
+        numero=_h(meta.get('numero', '')),
+        descripcion=_h(meta.get('descripcion', 'Sin descripción')),
+        estado_clase=estado_clase,
+        estado_texto=estado_texto,
+        unidad=_h(meta.get('unidad', 'No especificado')),
+        valor_objetivo=_h(meta.get('valor_objetivo', 'No especificado')),
+        sentido=_h(meta.get('sentido', 'No especificado')),
+        frecuencia=_h(meta.get('frecuencia', 'No especificado')),
+        vencimiento=_h(meta.get('vencimiento', 'No especificado')),
+        es_hito="SÍ" if meta.get('es_hito') else "NO",
+        ponderacion=_h(meta.get('ponderacion', 0)),
+        cumplimiento=f"{cumplimiento:.2f}%" if cumplimiento is not None else "No calculado",
+        observaciones=_h(meta.get('observaciones', 'No especificado')),
+        rangos=rangos,
+    )
+
+def _fragmentos_html_imprimible(agr: Dict[str, Any], generado: Optional[str] = None) -> Iterator[str]:
+    """Genera, en orden, los fragmentos del documento imprimible de un acuerdo"""
+    organismo_nombre = _h(agr.get('organismo_nombre', 'No especificado'))
+    acuerdo_id = _h(agr.get('id', 'Sin código'))
+    año = _h(agr.get('año', 'No especificado'))
+    generado = generado or datetime.now().strftime('%d/%m/%Y %H:%M')
+    
+    yield PLANTILLA_APERTURA_HTML.substitute(
+        titulo=f"Acuerdo {acuerdo_id} - {organismo_nombre}", css=CSS_DOCUMENTO_IMPRIMIBLE)
+    yield PLANTILLA_IMPRIMIBLE_ENCABEZADO.substitute(
+        acuerdo_id=acuerdo_id, organismo=organismo_nombre, generado=generado, anio=año)
+    
+    # SECCIÓN DE INFORMACIÓN GENERAL
+    yield PLANTILLA_IMPRIMIBLE_INFO_GENERAL.substitute(
+        organismo=organismo_nombre,
+        organismo_tipo=_h(agr.get('organismo_tipo', 'No especificado')),
+        naturaleza=_h(agr.get('naturaleza_juridica', 'No especificado')),
+        anio=año,
+        vigencia_desde=_h(agr.get('vigencia_desde', '')),
+        vigencia_hasta=_h(agr.get('vigencia_hasta', '')),
+        estado=_h(agr.get('estado', 'No especificado')),
+        enlace=_h(agr.get('organismo_enlace', 'No especificado')),
+        tipo_compromiso=_h(agr.get('tipo_compromiso', 'No especificado')),
+    )
+    
+    # SECCIONES DE OBJETO Y PARTES FIRMANTES
+    if agr.get('objeto'):
+        yield PLANTILLA_IMPRIMIBLE_TEXTO.substitute(titulo="🎯 OBJETO DEL ACUERDO", texto=_h(agr.get('objeto')))
+    if agr.get('partes_firmantes'):
+        yield PLANTILLA_IMPRIMIBLE_TEXTO.substitute(titulo="📝 PARTES FIRMANTES", texto=_h(agr.get('partes_firmantes')))
+    
+    # SECCIÓN DE CLÁUSULAS
+    clausulas_no_vacias = [c for c in agr.get('clausulas', []) or [] if c.strip()]
+    if clausulas_no_vacias:
+        yield '\n        <div class="section">\n            <h3>📝 CLAÚSULAS DEL ACUERDO</h3>\n'
+        for i, clausula in enumerate(clausulas_no_vacias, 1):
+            yield PLANTILLA_IMPRIMIBLE_CLAUSULA.substitute(numero=i, texto=_h(clausula))
+        yield "        </div>\n"
+    
+    # SECCIÓN DE FIRMAS
+    yield BLOQUE_IMPRIMIBLE_FIRMAS
+    
+    # SECCIÓN DE FICHAS DE COMPROMISO
+    if agr.get('fichas'):
+        yield '\n        <div class="section">\n            <h3>📊 FICHAS DE COMPROMISO</h3>\n'
+        for ficha in agr.get('fichas', []):
+            fila_salvaguarda = ""
+            if ficha.get('salvaguarda_flag'):
+                fila_salvaguarda = f"\n                    <tr><th>Texto de Salvaguarda:</th><td>{_h(ficha.get('salvaguarda_text', ''))}</td></tr>"
+            yield PLANTILLA_IMPRIMIBLE_FICHA.substitute(
+                ficha_id=_h(ficha.get('id', '')),
+                nombre=_h(ficha.get('nombre', 'Sin nombre')),
+                tipo_meta=_h(ficha.get('tipo_meta', 'No especificado')),
+                responsables_cumpl=_h(ficha.get('responsables_cumpl', 'No especificado')),
+                objetivo=_h(ficha.get('objetivo', 'No especificado')),
+                indicador=_h(ficha.get('indicador', 'No especificado')),
+                forma_calculo=_h(ficha.get('forma_calculo', 'No especificado')),
+                fuente=_h(ficha.get('fuente', 'No especificado')),
+                valor_base=_h(ficha.get('valor_base', 'No especificado')),
+                responsables_seguimiento=_h(ficha.get('responsables_seguimiento', 'No especificado')),
+                observaciones=_h(ficha.get('observaciones', 'No especificado')),
+                salvaguarda="SÍ" if ficha.get('salvaguarda_flag') else "NO",
+                fila_salvaguarda=fila_salvaguarda,
+            )
+            if ficha.get('metas'):
+                yield '\n                <h5 style="margin-top: 20px; color: #007bff;">🎯 METAS ASOCIADAS:</h5>\n'
+                for meta in ficha.get('metas', []):
+                    yield _html_meta_imprimible(meta)
+            yield "            </div>\n"  # Cierre de ficha
+        yield "        </div>\n"  # Cierre de sección de fichas
+    
+    # FOOTER
+    yield PLANTILLA_IMPRIMIBLE_PIE.substitute(generado=generado)
+    yield CIERRE_HTML
+
+# === FUNCIONES DE EXPORTACIÓN/IMPRESIÓN ===
+
+def exportar_html_imprimible(agr: Dict[str, Any], destino=None, generado: Optional[str] = None) -> Optional[str]:
+    """
+    Genera HTML optimizado para impresión con diseño responsive
+    
+    Args:
+        agr: Acuerdo a imprimir
+        destino: Archivo o stream con .write(); si se indica se escribe ahí por partes
+        generado: Texto de la fecha de generación (por defecto, ahora)
+        
+    Returns:
+        str con el HTML (o None si se escribió en destino)
+    """
+    return render_html(_fragmentos_html_imprimible(agr, generado), destino)
+
+def generate_agreement_code(year: int, external_prefix: Optional[str]=None) -> str:
     db = agreements_load()
-    existing_codes = [agr["id"] for agr in db.values() if "id" in agr]
+    existing_codes = [agr["id"] for agr in db.values() if "id" in agr] + list(obtener_almacen_archivo().ids())
     
     # 🆕 Pasar el external_prefix como organism_prefix
     n = get_next_sequential_number("AC", year, existing_codes, organism_prefix=external_prefix)
@@ -1900,9 +2570,754 @@ def generate_meta_code(year: int, ficha_id: str) -> str:
 
 # === SISTEMA DE VERSIONADO ===
 
+def _token_puntero(clave: Any) -> str:
+    """Escapa una clave para un JSON Pointer (RFC 6901)"""
+    return str(clave).replace("~", "~0").replace("/", "~1")
+
+def diferencia_json(anterior: Any, nuevo: Any, ruta: str = "") -> List[Dict[str, Any]]:
+    """
+    Parche JSON (RFC 6902: add/remove/replace) que transforma `anterior` en `nuevo`.
+    
+    Los objetos se comparan clave a clave y las listas posición a posición; los
+    elementos que sobran o faltan al final se quitan o agregan.
+    """
+    if isinstance(anterior, dict) and isinstance(nuevo, dict):
+        parche = []
+        for clave in anterior:
+            if clave not in nuevo:
+                parche.append({"op": "remove", "path": f"{ruta}/{_token_puntero(clave)}"})
+        for clave, valor in nuevo.items():
+            sub = f"{ruta}/{_token_puntero(clave)}"
+            if clave not in anterior:
+                parche.append({"op": "add", "path": sub, "value": valor})
+            else:
+                parche.extend(diferencia_json(anterior[clave], valor, sub))
+        return parche
+    if isinstance(anterior, list) and isinstance(nuevo, list):
+        parche = []
+        comunes = min(len(anterior), len(nuevo))
+        for i in range(comunes):
+            parche.extend(diferencia_json(anterior[i], nuevo[i], f"{ruta}/{i}"))
+        for i in range(len(anterior) - 1, comunes - 1, -1):  # de atrás hacia adelante
+            parche.append({"op": "remove", "path": f"{ruta}/{i}"})
+        for i in range(comunes, len(nuevo)):
+            parche.append({"op": "add", "path": f"{ruta}/{i}", "value": nuevo[i]})
+        return parche
+    if anterior == nuevo and type(anterior) is type(nuevo):
+        return []
+    return [{"op": "replace", "path": ruta, "value": nuevo}]
+
+def aplicar_parche_json(documento: Any, parche: List[Dict[str, Any]]) -> Any:
+    """Aplica un parche de diferencia_json sobre una copia de `documento`"""
+    import copy
+    documento = copy.deepcopy(documento)
+    for operacion in parche:
+        if operacion["path"] == "":
+            documento = copy.deepcopy(operacion["value"])
+            continue
+        tokens = [t.replace("~1", "/").replace("~0", "~") for t in operacion["path"].split("/")[1:]]
+        padre = documento
+        for token in tokens[:-1]:
+            padre = padre[int(token)] if isinstance(padre, list) else padre[token]
+        ultimo = tokens[-1]
+        if isinstance(padre, list):
+            indice = len(padre) if ultimo == "-" else int(ultimo)
+            if operacion["op"] == "add":
+                padre.insert(indice, copy.deepcopy(operacion["value"]))
+            elif operacion["op"] == "remove":
+                del padre[indice]
+            else:
+                padre[indice] = copy.deepcopy(operacion["value"])
+        elif operacion["op"] == "remove":
+            del padre[ultimo]
+        else:
+            padre[ultimo] = copy.deepcopy(operacion["value"])
+    return documento
+
+def leer_jsonl_gz(ruta: str) -> List[Dict[str, Any]]:
+    """
+    Registros de un .jsonl.gz escrito agregando un miembro gzip por escritura.
+    
+    Si una escritura quedó a medias (miembro gzip truncado o línea incompleta) se
+    conservan los registros íntegros anteriores y el archivo se reescribe solo con
+    ellos; si no, todo lo que se agregue después quedaría detrás de la parte rota
+    y tampoco podría leerse. El archivo dañado se conserva como <ruta>.danado.
+    """
+    registros = []
+    try:
+        with gzip.open(ruta, "rt", encoding="utf-8") as f:
+            for linea in f:
+                if linea.strip():
+                    registros.append(json.loads(linea))
+        return registros
+    except (EOFError, gzip.BadGzipFile, zlib.error, UnicodeDecodeError, ValueError):
+        pass
+    shutil.copyfile(ruta, ruta + ".danado")
+    tmp = ruta + ".tmp"
+    with gzip.open(tmp, "wt", encoding="utf-8") as f:
+        for registro in registros:
+            f.write(json.dumps(registro, ensure_ascii=False, default=str) + "\n")
+    os.replace(tmp, ruta)
+    return registros
+
+# Campos de una versión que no son contenido del acuerdo
+CAMPOS_CONTENIDO_VERSION = ("snapshot", "parche")
+
+class AlmacenVersiones:
+    """
+    Historial de versiones de los acuerdos, fuera de agreements.json.
+    
+    Cada acuerdo tiene un archivo VERSIONES_DIR/<id>.jsonl.gz al que se agrega un
+    miembro gzip por versión. Cada INTERVALO_VERSION_COMPLETA versiones se guarda
+    el snapshot completo; las demás guardan solo el parche JSON respecto de la
+    versión anterior. Cualquier versión se reconstruye desde el último snapshot
+    completo aplicando los parches siguientes. En el acuerdo queda solo
+    `current_version` (número de la última versión).
+    """
+    
+    def __init__(self, carpeta: str = None):
+        self.carpeta = carpeta or VERSIONES_DIR
+        self._lock = threading.RLock()
+        self._leidos: Dict[str, tuple] = {}  # id → ((mtime, tamaño), registros)
+        os.makedirs(self.carpeta, exist_ok=True)
+    
+    def _ruta(self, agr_id: str) -> str:
+        return os.path.join(self.carpeta, f"{agr_id}.jsonl.gz")
+    
+    def _registros(self, agr_id: str) -> List[Dict[str, Any]]:
+        ruta = self._ruta(agr_id)
+        try:
+            estado = os.stat(ruta)
+        except OSError:
+            return []
+        firma = (estado.st_mtime_ns, estado.st_size)
+        with self._lock:
+            leido = self._leidos.get(agr_id)
+            if leido is None or leido[0] != firma:
+                registros = leer_jsonl_gz(ruta)
+                leido = self._leidos[agr_id] = (firma, registros)
+            return leido[1]
+    
+    def listar(self, agr_id: str) -> List[Dict[str, Any]]:
+        """Metadatos de las versiones (sin snapshot ni parche), de la más vieja a la más nueva"""
+        return [{k: v for k, v in r.items() if k not in CAMPOS_CONTENIDO_VERSION}
+                for r in self._registros(agr_id)]
+    
+    def reconstruir(self, agr_id: str, numero: int) -> Optional[Dict[str, Any]]:
+        """Snapshot completo de la versión `numero` (None si no existe)"""
+        registros = self._registros(agr_id)
+        if not 1 <= numero <= len(registros):
+            return None
+        inicio = max(i for i in range(numero) if registros[i].get("tipo") == "completa")
+        snapshot = registros[inicio]["snapshot"]
+        for registro in registros[inicio + 1:numero]:
+            snapshot = aplicar_parche_json(snapshot, registro["parche"])
+        return snapshot
+    
+    def agregar(self, agr_id: str, version: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Guarda una versión creada con crear_version_acuerdo (con "snapshot").
+        
+        Returns:
+            dict: Metadatos de la versión guardada (numerada según el historial)
+        """
+        with self._lock:
+            anteriores = self._registros(agr_id)
+            numero = len(anteriores) + 1
+            registro = {k: v for k, v in version.items() if k not in CAMPOS_CONTENIDO_VERSION}
+            registro.update(version_id=f"V{numero:04d}", version_number=numero)
+            snapshot = version.get("snapshot") or {}
+            if (numero - 1) % INTERVALO_VERSION_COMPLETA == 0:
+                registro.update(tipo="completa", snapshot=snapshot)
+            else:
+                registro.update(tipo="delta", parche=diferencia_json(self.reconstruir(agr_id, numero - 1), snapshot))
+            
+            linea = json.dumps(registro, ensure_ascii=False, default=str) + "\n"
+            with gzip.open(self._ruta(agr_id), "at", encoding="utf-8") as f:  # un miembro gzip por versión
+                f.write(linea)
+            self._leidos.pop(agr_id, None)
+            return {k: v for k, v in registro.items() if k not in CAMPOS_CONTENIDO_VERSION}
+    
+    def eliminar(self, agr_id: str):
+        with self._lock:
+            self._leidos.pop(agr_id, None)
+            try:
+                os.remove(self._ruta(agr_id))
+            except OSError:
+                pass
+    
+    @staticmethod
+    def _clave_migracion(version: Dict[str, Any]) -> tuple:
+        """Identidad de una versión del esquema anterior (agregar() renumera version_id)"""
+        fecha = version.get("timestamp") or version.get("version_ts")
+        if fecha is None:
+            return ("id", version.get("version_id"))
+        return ("fecha", fecha, version.get("usuario") or version.get("version_by"),
+                version.get("motivo") or version.get("version_motivo"))
+    
+    def migrar(self, db: Dict[str, Any]) -> int:
+        """
+        Pasa al almacén las versiones guardadas dentro de los acuerdos (agr["versions"])
+        y deja en su lugar el puntero current_version. Modifica los acuerdos en db.
+        Es idempotente: las versiones que ya están en el almacén no se vuelven a agregar.
+        
+        Returns:
+            int: Cantidad de versiones migradas
+        """
+        migradas = 0
+        for agr_id, agr in db.items():
+            versiones = agr.get("versions")
+            if versiones is None:
+                continue
+            with self._lock:
+                existentes = {self._clave_migracion(v) for v in self.listar(agr_id)}
+                for version in versiones:
+                    clave = self._clave_migracion(version)
+                    if clave in existentes:
+                        continue
+                    self.agregar(agr_id, version)
+                    existentes.add(clave)
+                    migradas += 1
+                ultima = self.listar(agr_id)
+            if ultima:
+                agr["current_version"] = ultima[-1]["version_number"]
+            del agr["versions"]  # recién cuando todas quedaron en el almacén
+        return migradas
+
+@st.cache_resource(show_spinner=False)
+def obtener_almacen_versiones() -> AlmacenVersiones:
+    """Almacén de versiones compartido por todas las sesiones"""
+    return AlmacenVersiones()
+
+def registrar_version_acuerdo(agr: Dict[str, Any], version: Dict[str, Any]) -> Dict[str, Any]:
+    """Guarda la versión en el almacén y apunta el acuerdo a ella; devuelve sus metadatos"""
+    metadatos = obtener_almacen_versiones().agregar(agr["id"], version)
+    agr["current_version"] = metadatos["version_number"]
+    return metadatos
+
+# === HISTORIAL DE LOS ACUERDOS EN ALMACÉN APARTE ===
+
+class AlmacenHistorial:
+    """
+    Campos de historial de los acuerdos fuera de agreements.json, por id de acuerdo.
+    
+    approval_flow y el historial_estados de cada meta se agregan como eventos a
+    HISTORIAL_DIR/<id>.jsonl.gz (un miembro gzip por escritura). Las listas de
+    adjuntos van en un único índice ADJUNTOS_ACUERDOS_FILE (acuerdo → adjuntos),
+    porque el almacén de adjuntos las recorre todas para contar referencias.
+    
+    Los acuerdos se guardan livianos: un campo de historial presente en el
+    documento son cambios aún no guardados, y separar() los pasa al almacén
+    (los eventos se agregan sin repetir; la lista de adjuntos reemplaza a la guardada).
+    """
+    
+    def __init__(self, carpeta: str = None, archivo_adjuntos: str = None):
+        self.carpeta = carpeta or HISTORIAL_DIR
+        self.archivo_adjuntos = archivo_adjuntos or ADJUNTOS_ACUERDOS_FILE
+        self._lock = threading.RLock()
+        self._leidos: Dict[str, tuple] = {}  # id → ((mtime, tamaño), eventos)
+        self._adjuntos: Optional[tuple] = None  # ((mtime, tamaño), acuerdo → adjuntos)
+        os.makedirs(self.carpeta, exist_ok=True)
+    
+    @staticmethod
+    def _firma(ruta: str) -> Optional[tuple]:
+        try:
+            estado = os.stat(ruta)
+        except OSError:
+            return None
+        return (estado.st_mtime_ns, estado.st_size)
+    
+    def _ruta(self, agr_id: str) -> str:
+        return os.path.join(self.carpeta, f"{agr_id}.jsonl.gz")
+    
+    # ---------- eventos (aprobaciones y estados de metas) ----------
+    def _eventos(self, agr_id: str) -> List[Dict[str, Any]]:
+        ruta = self._ruta(agr_id)
+        firma = self._firma(ruta)
+        if firma is None:
+            return []
+        with self._lock:
+            leido = self._leidos.get(agr_id)
+            if leido is None or leido[0] != firma:
+                eventos = leer_jsonl_gz(ruta)
+                leido = self._leidos[agr_id] = (firma, eventos)
+            return leido[1]
+    
+    @staticmethod
+    def _clave_evento(evento: Dict[str, Any]) -> str:
+        return json.dumps(evento, ensure_ascii=False, sort_keys=True, default=str)
+    
+    def _anexar(self, agr_id: str, eventos: List[Dict[str, Any]]) -> int:
+        """Agrega los eventos que no estén ya guardados; devuelve cuántos agregó"""
+        with self._lock:
+            guardados = {self._clave_evento(e) for e in self._eventos(agr_id)}
+            nuevos = []
+            for evento in eventos:
+                clave = self._clave_evento(evento)
+                if clave not in guardados:
+                    guardados.add(clave)
+                    nuevos.append(evento)
+            if nuevos:
+                texto = "".join(json.dumps(e, ensure_ascii=False, default=str) + "\n" for e in nuevos)
+                with gzip.open(self._ruta(agr_id), "at", encoding="utf-8") as f:
+                    f.write(texto)
+                self._leidos.pop(agr_id, None)
+            return len(nuevos)
+    
+    def aprobaciones(self, agr_id: str) -> List[Dict[str, Any]]:
+        """approval_flow guardado del acuerdo, del más viejo al más nuevo"""
+        return [e["registro"] for e in self._eventos(agr_id) if e.get("campo") == "approval_flow"]
+    
+    def estados_meta(self, agr_id: str, meta_id: str) -> List[Dict[str, Any]]:
+        """historial_estados guardado de una meta, del más viejo al más nuevo"""
+        return [e["registro"] for e in self._eventos(agr_id)
+                if e.get("campo") == "historial_estados" and e.get("meta_id") == meta_id]
+    
+    # ---------- adjuntos ----------
+    def _indice_adjuntos(self) -> Dict[str, List[Dict[str, Any]]]:
+        firma = self._firma(self.archivo_adjuntos)
+        with self._lock:
+            if self._adjuntos is None or self._adjuntos[0] != firma:
+                self._adjuntos = (firma, load_json(self.archivo_adjuntos, {}))
+            return self._adjuntos[1]
+    
+    def adjuntos(self, agr_id: str) -> List[Dict[str, Any]]:
+        """Copia de la lista de adjuntos guardada del acuerdo"""
+        return [dict(a) for a in self._indice_adjuntos().get(agr_id, [])]
+    
+    def guardar_adjuntos(self, agr_id: str, adjuntos: List[Dict[str, Any]]):
+        with self._lock:
+            indice = dict(self._indice_adjuntos())
+            if adjuntos:
+                indice[agr_id] = adjuntos
+            else:
+                indice.pop(agr_id, None)
+            save_json(self.archivo_adjuntos, indice)
+            self._adjuntos = (self._firma(self.archivo_adjuntos), indice)
+    
+    # ---------- acuerdos ----------
+    @staticmethod
+    def tiene_historial(agr: Dict[str, Any]) -> bool:
+        """True si el acuerdo trae campos de historial dentro del documento"""
+        if "approval_flow" in agr or "attachments" in agr:
+            return True
+        return any("historial_estados" in meta
+                   for ficha in agr.get("fichas", []) or [] for meta in ficha.get("metas", []) or [])
+    
+    def separar(self, agr: Dict[str, Any]) -> bool:
+        """
+        Pasa al almacén los campos de historial del acuerdo y los quita del documento
+        (recién después de escribirlos).
+        
+        Returns:
+            bool: True si el acuerdo traía historial
+        """
+        if not self.tiene_historial(agr):
+            return False
+        metas = [meta for ficha in agr.get("fichas", []) or [] for meta in ficha.get("metas", []) or []]
+        eventos = [{"campo": "approval_flow", "registro": r} for r in agr.get("approval_flow") or []]
+        for meta in metas:
+            eventos.extend({"campo": "historial_estados", "meta_id": meta.get("id"), "registro": r}
+                           for r in meta.get("historial_estados") or [])
+        self._anexar(agr["id"], eventos)
+        if "attachments" in agr:
+            self.guardar_adjuntos(agr["id"], agr["attachments"] or [])
+        
+        agr.pop("approval_flow", None)
+        agr.pop("attachments", None)
+        for meta in metas:
+            meta.pop("historial_estados", None)
+        return True
+    
+    def migrar(self, db: Dict[str, Any]) -> int:
+        """
+        Separa el historial de todos los acuerdos de db (los modifica).
+        
+        Returns:
+            int: Cantidad de acuerdos que traían historial
+        """
+        return sum(self.separar(agr) for agr in db.values())
+    
+    def completar(self, agr: Dict[str, Any]) -> Dict[str, Any]:
+        """Copia del acuerdo con su historial guardado más el pendiente (para exportar)"""
+        import copy
+        completo = copy.deepcopy(agr)
+        completo["approval_flow"] = self.aprobaciones(agr["id"]) + list(agr.get("approval_flow") or [])
+        completo["attachments"] = adjuntos_acuerdo(agr)
+        for ficha in completo.get("fichas", []) or []:
+            for meta in ficha.get("metas", []) or []:
+                meta["historial_estados"] = (self.estados_meta(agr["id"], meta.get("id"))
+                                             + list(meta.get("historial_estados") or []))
+        return completo
+    
+    def eliminar(self, agr_id: str):
+        with self._lock:
+            self._leidos.pop(agr_id, None)
+            try:
+                os.remove(self._ruta(agr_id))
+            except OSError:
+                pass
+            if agr_id in self._indice_adjuntos():
+                self.guardar_adjuntos(agr_id, [])
+
+@st.cache_resource(show_spinner=False)
+def obtener_almacen_historial() -> AlmacenHistorial:
+    """Almacén de historial compartido por todas las sesiones"""
+    return AlmacenHistorial()
+
+def adjuntos_acuerdo(agr: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Adjuntos del acuerdo: los del documento si tiene cambios sin guardar, si no los del almacén"""
+    if "attachments" in agr:
+        return agr["attachments"] or []
+    return obtener_almacen_historial().adjuntos(agr["id"])
+
+# === ARCHIVO DE ACUERDOS CERRADOS POR AÑO ===
+
+ESTADOS_ARCHIVABLES = ("Archivado", "Aprobado")
+CAMPOS_RESUMEN_ARCHIVO = ("id", "año", "organismo_nombre", "organismo_tipo", "tipo_compromiso", "estado")
+
+class AlmacenArchivo:
+    """
+    Acuerdos cerrados de años anteriores, fuera del conjunto de trabajo.
+    
+    Los acuerdos "Archivado"/"Aprobado" de un año ya terminado se mueven a una
+    partición de solo lectura ARCHIVO_DIR/acuerdos_<año>.json.gz y dejan de
+    cargarse con agreements_load. En ARCHIVO_DIR/indice.json queda un resumen por
+    acuerdo (organismo, tipo, estado, fichas, metas, cumplimiento) para el listado;
+    el documento completo se lee de la partición solo cuando se pide. La tabla
+    plana y el cubo conservan los bloques de los acuerdos archivados, y sus
+    adjuntos, versiones e historial siguen en sus almacenes.
+    """
+    
+    def __init__(self, carpeta: str = None):
+        self.carpeta = carpeta or ARCHIVO_DIR
+        self.archivo_indice = os.path.join(self.carpeta, "indice.json")
+        self._lock = threading.RLock()
+        self._indice: Optional[tuple] = None  # ((mtime, tamaño), id → resumen)
+        self._particiones: Dict[int, tuple] = {}  # año → ((mtime, tamaño), id → acuerdo)
+        os.makedirs(self.carpeta, exist_ok=True)
+    
+    def _ruta(self, año: int) -> str:
+        return os.path.join(self.carpeta, f"acuerdos_{año}.json.gz")
+    
+    # ---------- resúmenes ----------
+    def resumenes(self, año: Optional[int] = None) -> Dict[str, Dict[str, Any]]:
+        """Resúmenes de los acuerdos archivados (de un año, o de todos)"""
+        firma = AlmacenHistorial._firma(self.archivo_indice)
+        with self._lock:
+            if self._indice is None or self._indice[0] != firma:
+                self._indice = (firma, load_json(self.archivo_indice, {}))
+            indice = self._indice[1]
+        return {i: r for i, r in indice.items() if año is None or r.get("año") == año}
+    
+    def ids(self) -> set:
+        return set(self.resumenes())
+    
+    def años(self) -> List[int]:
+        return sorted({r.get("año") for r in self.resumenes().values()})
+    
+    def tamaño(self, año: int) -> int:
+        """Bytes en disco de la partición del año"""
+        try:
+            return os.path.getsize(self._ruta(año))
+        except OSError:
+            return 0
+    
+    @staticmethod
+    def resumen(agr: Dict[str, Any]) -> Dict[str, Any]:
+        filas = aplanar_acuerdo(agr)
+        resumen = {campo: agr.get(campo) for campo in CAMPOS_RESUMEN_ARCHIVO}
+        resumen.update(
+            fichas=len(agr.get("fichas", []) or []),
+            metas=len(filas),
+            cumplimiento=next((f["cumplimiento_acuerdo"] for f in filas if f.get("cumplimiento_acuerdo") is not None), None),
+        )
+        return resumen
+    
+    # ---------- documentos completos ----------
+    def _particion(self, año: int) -> Dict[str, Dict[str, Any]]:
+        ruta = self._ruta(año)
+        firma = AlmacenHistorial._firma(ruta)
+        if firma is None:
+            return {}
+        with self._lock:
+            leida = self._particiones.get(año)
+            if leida is None or leida[0] != firma:
+                with gzip.open(ruta, "rt", encoding="utf-8") as f:
+                    leida = self._particiones[año] = (firma, json.load(f))
+            return leida[1]
+    
+    def cargar_año(self, año: int) -> Dict[str, Dict[str, Any]]:
+        """Acuerdos completos de un año archivado (copias: la partición no se modifica)"""
+        import copy
+        return copy.deepcopy(self._particion(año))
+    
+    def acuerdo(self, agr_id: str) -> Optional[Dict[str, Any]]:
+        """Documento completo de un acuerdo archivado (None si no está archivado)"""
+        import copy
+        resumen = self.resumenes().get(agr_id)
+        if resumen is None:
+            return None
+        return copy.deepcopy(self._particion(resumen.get("año")).get(agr_id))
+    
+    def _escribir_particion(self, año: int, acuerdos: Dict[str, Dict[str, Any]]):
+        ruta = self._ruta(año)
+        tmp = ruta + ".tmp"
+        with gzip.open(tmp, "wt", encoding="utf-8") as f:
+            json.dump(acuerdos, f, ensure_ascii=False, default=str)
+        os.replace(tmp, ruta)
+        self._particiones.pop(año, None)
+    
+    # ---------- archivar / restaurar ----------
+    @staticmethod
+    def candidatos(db: Dict[str, Any], año: int) -> List[str]:
+        """IDs de los acuerdos cerrados del año que pueden archivarse"""
+        return [agr_id for agr_id, agr in db.items()
+                if agr.get("año") == año and agr.get("estado") in ESTADOS_ARCHIVABLES]
+    
+    def archivar(self, db: Dict[str, Any], año: int, usuario: str) -> List[str]:
+        """
+        Mueve a la partición del año sus acuerdos cerrados y los quita de db
+        (quien llama guarda db con agreements_save).
+        
+        Returns:
+            List[str]: IDs archivados
+        """
+        if año >= date.today().year:
+            raise ValueError("Solo se pueden archivar años ya terminados")
+        ids = self.candidatos(db, año)
+        if not ids:
+            return []
+        historial = obtener_almacen_historial()
+        with self._lock:
+            particion = dict(self._particion(año))
+            for agr_id in ids:
+                historial.separar(db[agr_id])  # la partición guarda acuerdos livianos
+                particion[agr_id] = db[agr_id]
+            self._escribir_particion(año, particion)
+            
+            indice = self.resumenes()
+            ahora = datetime.now().isoformat()
+            for agr_id in ids:
+                indice[agr_id] = dict(self.resumen(db[agr_id]), archivado_en=ahora, archivado_por=usuario)
+            save_json(self.archivo_indice, indice)
+            self._indice = None
+        for agr_id in ids:
+            del db[agr_id]
+        return ids
+    
+    def restaurar(self, db: Dict[str, Any], año: int) -> List[str]:
+        """
+        Devuelve a db los acuerdos archivados del año. La partición se descarta con
+        descartar() recién después de guardar db.
+        
+        Returns:
+            List[str]: IDs restaurados
+        """
+        acuerdos = self.cargar_año(año)
+        db.update(acuerdos)
+        return list(acuerdos)
+    
+    def descartar(self, año: int):
+        """Elimina la partición del año y sus resúmenes"""
+        with self._lock:
+            indice = {i: r for i, r in self.resumenes().items() if r.get("año") != año}
+            save_json(self.archivo_indice, indice)
+            self._indice = None
+            self._particiones.pop(año, None)
+            try:
+                os.remove(self._ruta(año))
+            except OSError:
+                pass
+
+@st.cache_resource(show_spinner=False)
+def obtener_almacen_archivo() -> AlmacenArchivo:
+    """Archivo de acuerdos cerrados compartido por todas las sesiones"""
+    return AlmacenArchivo()
+
+def acuerdos_con_archivados(db: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    """db más el resumen (no el documento) de cada acuerdo archivado"""
+    return {**obtener_almacen_archivo().resumenes(), **db}
+
+def acuerdos_del_año(db: Dict[str, Any], año: int) -> Dict[str, Dict[str, Any]]:
+    """db más los acuerdos archivados del año (la partición se lee solo si el año tiene archivo)"""
+    archivo = obtener_almacen_archivo()
+    if año not in archivo.años():
+        return db
+    return {**archivo.cargar_año(año), **db}
+
+def años_con_acuerdos(db: Dict[str, Any]) -> List[int]:
+    """Años del conjunto de trabajo más los archivados"""
+    años = {a.get("año", date.today().year) for a in db.values()} | set(obtener_almacen_archivo().años())
+    return sorted(años) or [date.today().year]
+
+def mostrar_acuerdo_archivado(agr_id: str):
+    """Vista de solo lectura de un acuerdo archivado (lee su partición)"""
+    agr = obtener_almacen_archivo().acuerdo(agr_id)
+    if agr is None:
+        st.session_state.pop("ver_archivado", None)
+        return
+    st.markdown("---")
+    col1, col2 = st.columns([4, 1])
+    col1.subheader(f"📦 Acuerdo archivado: {agr_id}")
+    if col2.button("✖️ Cerrar", key="cerrar_archivado"):
+        st.session_state.pop("ver_archivado", None)
+        st.rerun()
+    st.caption(f"{agr.get('organismo_nombre') or 'Sin nombre'} · {agr.get('año')} · {agr.get('estado')} · solo lectura")
+    st.dataframe(pd.DataFrame(aplanar_acuerdo(agr), columns=COLUMNAS_TABLA_PLANA), use_container_width=True, hide_index=True)
+    json_data = json.dumps(obtener_almacen_historial().completar(agr), ensure_ascii=False, indent=2, default=str)
+    st.download_button("📄 Exportar JSON", data=json_data.encode("utf-8"), file_name=f"{agr_id}_completo.json",
+                       mime="application/json", key=f"json_archivado_{agr_id}")
+
+def administrar_archivo_acuerdos():
+    """Archivar (o restaurar) los acuerdos cerrados de un año terminado"""
+    archivo = obtener_almacen_archivo()
+    db = agreements_load()
+    año_actual = date.today().year
+    años_cerrados = sorted({a.get("año") for a in db.values()
+                            if isinstance(a.get("año"), int) and a.get("año") < año_actual})
+    
+    col_arch1, col_arch2 = st.columns(2)
+    with col_arch1:
+        st.markdown("**Archivar un año terminado**")
+        if not años_cerrados:
+            st.caption("No hay acuerdos de años anteriores en el conjunto de trabajo")
+        else:
+            año = st.selectbox("Año", años_cerrados, key="archivo_año")
+            ids = archivo.candidatos(db, año)
+            abiertos = sum(1 for a in db.values() if a.get("año") == año) - len(ids)
+            st.caption(f"{len(ids)} acuerdo(s) {' / '.join(ESTADOS_ARCHIVABLES)} para archivar; "
+                       f"{abiertos} sin cerrar siguen en el conjunto de trabajo")
+            if st.button("📦 Archivar año", key="archivar_año", disabled=not ids):
+                archivados = archivo.archivar(db, año, st.session_state.user["username"])
+                agreements_save(db, archivados)
+                audit_log("archive_year", {"año": año, "acuerdos": archivados, "by": st.session_state.user["username"]})
+                st.success(f"✅ {len(archivados)} acuerdo(s) de {año} archivados")
+                st.rerun()
+    
+    with col_arch2:
+        st.markdown("**Años archivados**")
+        resumenes = archivo.resumenes()
+        if not resumenes:
+            st.caption("Todavía no hay años archivados")
+            return
+        df = pd.DataFrame(list(resumenes.values()))
+        tabla = df.groupby("año").agg(acuerdos=("id", "size"), metas=("metas", "sum")).reset_index()
+        tabla["tamaño (KB)"] = [round(archivo.tamaño(a) / 1024, 1) for a in tabla["año"]]
+        st.dataframe(tabla, use_container_width=True, hide_index=True)
+        año_restaurar = st.selectbox("Restaurar año", archivo.años(), key="restaurar_año")
+        if st.button("↩️ Volver al conjunto de trabajo", key="restaurar_archivo"):
+            restaurados = archivo.restaurar(db, año_restaurar)
+            agreements_save(db, restaurados)
+            archivo.descartar(año_restaurar)
+            audit_log("restore_year", {"año": año_restaurar, "acuerdos": restaurados, "by": st.session_state.user["username"]})
+            st.success(f"✅ {len(restaurados)} acuerdo(s) de {año_restaurar} restaurados")
+            st.rerun()
+
+# === COMPARACIÓN ESTRUCTURAL ENTRE VERSIONES ===
+
+ESTADOS_REVISION = ("En Revisión OPP", "En Revisión Comisión CG")
+# Campos que no son contenido del acuerdo (historial, punteros) y no se comparan
+CAMPOS_IGNORADOS_DIFERENCIA = {"fichas", "versions", "approval_flow", "attachments", "current_version"}
+COLUMNAS_DIFERENCIA = ["nivel", "ficha_id", "meta_id", "elemento", "campo", "cambio", "antes", "despues"]
+MAX_CARACTERES_VALOR_DIFERENCIA = 200
+
+def _valor_diferencia(valor: Any) -> str:
+    """Representación corta de un valor para la tabla de diferencias"""
+    texto = valor if isinstance(valor, str) else json.dumps(valor, ensure_ascii=False, default=str)
+    if len(texto) > MAX_CARACTERES_VALOR_DIFERENCIA:
+        return texto[:MAX_CARACTERES_VALOR_DIFERENCIA] + "…"
+    return texto
+
+def _diferencia_campos(anterior: Dict[str, Any], nuevo: Dict[str, Any], ignorar: set, base: Dict[str, Any]) -> List[Dict[str, Any]]:
+    filas = []
+    for campo in sorted((set(anterior) | set(nuevo)) - ignorar):
+        antes, despues = anterior.get(campo), nuevo.get(campo)
+        if antes == despues:
+            continue
+        filas.append(dict(base, campo=campo, cambio="modificado",
+                          antes=_valor_diferencia(antes) if antes is not None else "",
+                          despues=_valor_diferencia(despues) if despues is not None else ""))
+    return filas
+
+def _por_id(elementos: Iterable[Dict[str, Any]], prefijo: str) -> Dict[str, Dict[str, Any]]:
+    """Indexa por id; los elementos sin id usan su posición para no perderse"""
+    return {e.get("id") or f"{prefijo}#{i}": e for i, e in enumerate(elementos)}
+
+def diferencia_estructural(anterior: Dict[str, Any], nuevo: Dict[str, Any]) -> pd.DataFrame:
+    """
+    Diferencias entre dos revisiones de un acuerdo, emparejando fichas y metas por
+    id (no por posición): una meta movida o reordenada no aparece como cambio.
+    
+    Returns:
+        DataFrame con COLUMNAS_DIFERENCIA; cambio es "agregado", "eliminado" o
+        "modificado" (en este último caso, una fila por campo)
+    """
+    filas = _diferencia_campos(anterior, nuevo, CAMPOS_IGNORADOS_DIFERENCIA,
+                               {"nivel": "acuerdo", "ficha_id": "", "meta_id": "", "elemento": nuevo.get("id") or anterior.get("id", "")})
+    
+    fichas_antes = _por_id(anterior.get("fichas", []), "ficha")
+    fichas_despues = _por_id(nuevo.get("fichas", []), "ficha")
+    metas_antes = {m_id: (f_id, m) for f_id, f in fichas_antes.items() for m_id, m in _por_id(f.get("metas", []), f"{f_id}/meta").items()}
+    metas_despues = {m_id: (f_id, m) for f_id, f in fichas_despues.items() for m_id, m in _por_id(f.get("metas", []), f"{f_id}/meta").items()}
+    
+    for ficha_id in list(fichas_antes) + [f for f in fichas_despues if f not in fichas_antes]:
+        antes, despues = fichas_antes.get(ficha_id), fichas_despues.get(ficha_id)
+        base = {"nivel": "ficha", "ficha_id": ficha_id, "meta_id": "", "elemento": (despues or antes).get("nombre", "")}
+        if antes is None:
+            filas.append(dict(base, campo="", cambio="agregado", antes="", despues=_valor_diferencia(despues.get("nombre", ""))))
+        elif despues is None:
+            filas.append(dict(base, campo="", cambio="eliminado", antes=_valor_diferencia(antes.get("nombre", "")), despues=""))
+        else:
+            filas.extend(_diferencia_campos(antes, despues, {"metas"}, base))
+    
+    for meta_id in list(metas_antes) + [m for m in metas_despues if m not in metas_antes]:
+        (ficha_antes, antes), (ficha_despues, despues) = metas_antes.get(meta_id, (None, None)), metas_despues.get(meta_id, (None, None))
+        base = {"nivel": "meta", "ficha_id": ficha_despues or ficha_antes, "meta_id": meta_id,
+                "elemento": f"N°{(despues or antes).get('numero', '')} {(despues or antes).get('descripcion', '')}".strip()}
+        if antes is None:
+            filas.append(dict(base, campo="", cambio="agregado", antes="", despues=_valor_diferencia(despues.get("descripcion", ""))))
+        elif despues is None:
+            filas.append(dict(base, campo="", cambio="eliminado", antes=_valor_diferencia(antes.get("descripcion", "")), despues=""))
+        else:
+            if ficha_antes != ficha_despues:
+                filas.append(dict(base, campo="ficha", cambio="modificado", antes=ficha_antes, despues=ficha_despues))
+            filas.extend(_diferencia_campos(antes, despues, {"historial_estados"}, base))
+    
+    return pd.DataFrame(filas, columns=COLUMNAS_DIFERENCIA)
+
+def resumen_diferencia(diferencias: pd.DataFrame) -> Dict[str, int]:
+    """Conteos para cambios_detectados: elementos agregados/eliminados y campos modificados"""
+    conteos = diferencias["cambio"].value_counts()
+    return {cambio: int(conteos.get(cambio, 0)) for cambio in ("agregado", "eliminado", "modificado")}
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def diferencia_versiones(agr_id: str, numero_anterior: int, numero_nuevo: int) -> pd.DataFrame:
+    """Diferencia entre dos versiones guardadas (inmutables: se cachea por par de versiones)"""
+    almacen = obtener_almacen_versiones()
+    return diferencia_estructural(almacen.reconstruir(agr_id, numero_anterior) or {},
+                                  almacen.reconstruir(agr_id, numero_nuevo) or {})
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def diferencia_con_actual(agr_id: str, numero: int, digest_actual: str, _agr: Dict[str, Any]) -> pd.DataFrame:
+    """Diferencia entre una versión y el acuerdo en edición (cacheada por digest del acuerdo)"""
+    return diferencia_estructural(obtener_almacen_versiones().reconstruir(agr_id, numero) or {}, _agr)
+
+def mostrar_diferencias(diferencias: pd.DataFrame, clave: str):
+    """Tabla de diferencias con conteos y filtro por nivel"""
+    if diferencias.empty:
+        st.success("✅ Sin diferencias")
+        return
+    resumen = resumen_diferencia(diferencias)
+    st.caption(f"➕ {resumen['agregado']} agregado(s) · ➖ {resumen['eliminado']} eliminado(s) · "
+               f"✏️ {resumen['modificado']} campo(s) modificado(s)")
+    niveles = st.multiselect("Nivel", ["acuerdo", "ficha", "meta"], default=["acuerdo", "ficha", "meta"],
+                             key=f"diff_niveles_{clave}")
+    st.dataframe(diferencias[diferencias["nivel"].isin(niveles)], use_container_width=True, hide_index=True)
+
 def crear_version_acuerdo(agr: Dict[str, Any], usuario: str, motivo: str,
                          cambios: Dict[str, Any] = None) -> Dict[str, Any]:
-    """Crea una nueva versión del acuerdo con snapshot completo"""
+    """Crea una nueva versión del acuerdo con snapshot completo (se guarda con registrar_version_acuerdo)"""
     # Snapshot del acuerdo actual (sin referencias)
     import copy
     snapshot = copy.deepcopy(agr)
@@ -1910,17 +3325,25 @@ def crear_version_acuerdo(agr: Dict[str, Any], usuario: str, motivo: str,
     # Remover datos temporales del snapshot
     snapshot.pop("versions", None)
     snapshot.pop("approval_flow", None)
+    snapshot.pop("attachments", None)
     snapshot.pop("current_version", None)
     
+    almacen = obtener_almacen_versiones()
+    numero = len(almacen.listar(agr["id"])) + 1
+    
+    # Resumen de lo que cambió respecto de la versión anterior (más los cambios informados)
+    anterior = almacen.reconstruir(agr["id"], numero - 1) if numero > 1 else None
+    detectados = resumen_diferencia(diferencia_estructural(anterior, snapshot)) if anterior is not None else {}
+    
     version = {
-        "version_id": f"V{len(agr.get('versions', [])) + 1:04d}",
-        "version_number": len(agr.get('versions', [])) + 1,
+        "version_id": f"V{numero:04d}",
+        "version_number": numero,
         "timestamp": datetime.now().isoformat(),
         "usuario": usuario,
         "motivo": motivo,
         "estado_anterior": agr.get('estado'),
         "estado_nuevo": agr.get('estado'), # Puede cambiar después
-        "cambios_detectados": cambios or {},
+        "cambios_detectados": {**detectados, **(cambios or {})},
         "snapshot": snapshot
     }
     return version
@@ -2044,23 +3467,108 @@ def reset_counters_force_start():
 def gen_uuid(prefix:str="ID") -> str:
     return f"{prefix}_{secrets.token_hex(6)}"
 
+def _tiene_historial_embebido(db: Dict[str, Any]) -> bool:
+    return any("versions" in agr or AlmacenHistorial.tiene_historial(agr) for agr in db.values())
+
+@st.cache_resource(show_spinner=False)
+def _lock_separacion_historial() -> threading.Lock:
+    """Lock del proceso (compartido por todas las sesiones) para separar el historial embebido"""
+    return threading.Lock()
+
+def _separar_historial_embebido() -> Dict[str, Any]:
+    """
+    Pasa a sus almacenes el historial guardado dentro de agreements.json, una sola vez.
+    
+    Corre bajo un lock del proceso y vuelve a leer el archivo dentro del lock: si otra
+    sesión ya lo separó, no se repite. Los adjuntos viejos se borran solo si el
+    archivo liviano quedó guardado.
+    """
+    with _lock_separacion_historial():
+        db = load_json(AGREEMENTS_FILE, {})
+        if not _tiene_historial_embebido(db):
+            return db
+        try:
+            legados = obtener_almacen_adjuntos().migrar(db)
+            obtener_almacen_versiones().migrar(db)
+            obtener_almacen_historial().migrar(db)
+        except OSError as e:
+            st.warning(f"⚠️ No se pudo separar el historial de los acuerdos: {e}")
+            return load_json(AGREEMENTS_FILE, {})
+        if save_json(AGREEMENTS_FILE, db):
+            obtener_almacen_adjuntos().eliminar_legados(legados)
+        return db
+
+class AcuerdosCargados(dict):
+    """
+    Acuerdos tal como se leyeron de agreements.json, junto con el mtime del archivo
+    que se leyó. agreements_save lo usa para saber si el resto de los acuerdos
+    (los no modificados) coincide con lo que refleja la tabla plana.
+    """
+    
+    def __init__(self, acuerdos: Dict[str, Any], mtime_fuente: Optional[float]):
+        super().__init__(acuerdos)
+        self.mtime_fuente = mtime_fuente
+
 def agreements_load() -> Dict[str, Any]:
-    return load_json(AGREEMENTS_FILE, {})
+    """Acuerdos livianos: el historial (aprobaciones, estados de metas, adjuntos, versiones) está en sus almacenes"""
+    mtime = TablaPlanaMaterializada._mtime_agreements()  # antes de leer: si cambia en medio, no coincide
+    db = load_json(AGREEMENTS_FILE, {})
+    
+    # 🆕 ACUERDOS GUARDADOS CON EL HISTORIAL ADENTRO → SE SEPARA UNA SOLA VEZ
+    if _tiene_historial_embebido(db):
+        mtime = TablaPlanaMaterializada._mtime_agreements()
+        db = _separar_historial_embebido()
+    return AcuerdosCargados(db, mtime)
 
-def agreements_save(db):
+def agreements_save(db, modificados: Optional[Iterable[str]] = None):
     """
-    💾 Guarda acuerdos en la base de datos y limpia caches relevantes
+    💾 Guarda acuerdos en la base de datos e invalida los reportes de los acuerdos modificados
+    
+    Args:
+        modificados: IDs de los acuerdos que cambiaron (o se eliminaron). La tabla
+                     plana y el cubo solo revisan esos y los nuevos; None revisa todos.
+                     Se revisan todos igual si db no se leyó de la misma versión de
+                     agreements.json que refleja la tabla plana (otra sesión guardó
+                     en el medio y db puede pisar sus cambios con acuerdos viejos).
     """
     try:
-        # 🆕 LIMPIAR CACHES DE STREAMLIT ANTES DE GUARDAR
+        # 🆕 ADJUNTOS DEL ESQUEMA ANTERIOR → ALMACÉN POR CONTENIDO (antes de escribir)
+        legados = []
         try:
-            # Limpiar cache de datos
-            st.cache_data.clear()
-        except:
-            pass
+            legados = obtener_almacen_adjuntos().migrar(db)
+        except OSError as e:
+            st.warning(f"⚠️ No se pudieron migrar algunos adjuntos: {e}")
+        
+        # 🆕 VERSIONES DENTRO DEL ACUERDO → ALMACÉN DE VERSIONES (queda solo current_version)
+        try:
+            obtener_almacen_versiones().migrar(db)
+        except OSError as e:
+            st.warning(f"⚠️ No se pudieron migrar algunas versiones: {e}")
         
-        # 🆕 GUARDAR CON VERIFICACIÓN
-        save_json(AGREEMENTS_FILE, db)
+        # 🆕 APROBACIONES, ESTADOS DE METAS Y ADJUNTOS → ALMACÉN DE HISTORIAL (acuerdos livianos)
+        try:
+            obtener_almacen_historial().migrar(db)
+        except OSError as e:
+            st.warning(f"⚠️ No se pudo guardar el historial de algunos acuerdos: {e}")
+        
+        # 🆕 GUARDAR CON VERIFICACIÓN (los adjuntos viejos se borran solo si quedó en disco)
+        tabla = obtener_tabla_plana()
+        al_dia = isinstance(db, AcuerdosCargados) and db.mtime_fuente == tabla.mtime_fuente
+        if save_json(AGREEMENTS_FILE, db):
+            obtener_almacen_adjuntos().eliminar_legados(legados)
+            if isinstance(db, AcuerdosCargados):
+                db.mtime_fuente = tabla._mtime_agreements()  # db ahora es lo que está en disco
+        
+        # 🆕 ACTUALIZAR TABLA PLANA SOLO CON LOS ACUERDOS MODIFICADOS
+        try:
+            modificados = None if modificados is None or not al_dia else list(modificados)
+            cambiados = tabla.sincronizar(db, modificados)
+            obtener_cubo_cumplimiento().sincronizar(db, modificados=modificados)
+            obtener_almacen_adjuntos().liberar(db)
+            st.session_state.acuerdos_modificados = cambiados
+            obtener_cache_reportes().invalidar(cambiados)
+        except Exception as e:
+            st.warning(f"⚠️ No se pudo actualizar la tabla de reportes: {e}")
         
         # 🆕 VERIFICAR QUE SE GUARDÓ CORRECTAMENTE
         if os.path.exists(AGREEMENTS_FILE):
@@ -2092,6 +3600,7 @@ def limpiar_caches():
     🗑️ Limpia todos los caches de Streamlit
     """
     try:
+        obtener_cache_reportes().limpiar()
         st.cache_data.clear()
         st.cache_resource.clear()
         st.success("✅ Caches limpiados correctamente")
@@ -2113,6 +3622,7 @@ def verificar_archivos_indicadores():
     
     # Botón para limpiar indicadores
     if st.sidebar.button("🗑️ Limpiar TODOS los indicadores"):
+        obtener_repositorio_indicadores().limpiar()
         limpiar_indicadores()
 
 def limpiar_indicadores():
@@ -2235,60 +3745,185 @@ def default_agreement(created_by, external_prefix:Optional[str]=None, año_selec
         "antecedentes": "",
         "estado": "Borrador",
         "created_by": created_by,
-        "attachments": [],
         "fichas": [],
-        "versions": [],
-        "current_version": None,
-        "approval_flow": []
+        "current_version": None
     }
 
 def parse_bool_si_no(x: str) -> bool:
     return str(x or "").strip().lower() in ["si","sí","true","1","yes"]
 
-def export_csv_horizontal_agreement(acuerdo: Dict[str, Any]) -> str:
-    """
-    📊 Exporta acuerdo a formato CSV horizontal premium - VERSIÓN CORREGIDA
-    
-    Args:
-        acuerdo: Diccionario con datos del acuerdo
+# 🎨 ENCABEZADOS DEL FORMATO CSV HORIZONTAL (EXPORTACIÓN, PLANTILLA E IMPORTACIÓN)
+ENCABEZADOS_CSV_HORIZONTAL = [
+    # === BLOQUE INFORMACIÓN GENERAL ===
+    "id_acuerdo", "año_vigencia", "tipo_compromiso", "estado_actual",
+    "tipo_organismo", "nombre_organismo", "organismo_enlace",
+    "vigencia_desde", "vigencia_hasta", "creado_por", "responsable_asignado",
+    
+    # === BLOQUE FICHA COMPROMISO ===
+    "id_ficha", "nombre_ficha", "tipo_meta",
+    "responsables_cumplimiento", "objetivo_estrategico", "indicador_principal",
+    "metodologia_calculo", "fuente_informacion", "valor_linea_base",
+    "responsables_seguimiento", "observaciones_ficha",
+    "requiere_salvaguarda", "texto_salvaguarda",
+    
+    # === BLOQUE META ESPECÍFICA ===
+    "id_meta", "numero_meta", "descripcion_meta", "estado_meta",
+    "unidad_medida", "valor_objetivo", "sentido_cumplimiento",
+    "frecuencia_medicion", "fecha_vencimiento", "es_hito_critico",
+    "ponderacion_porcentual", "valor_alcanzado", "porcentaje_cumplimiento",
+    "observaciones_meta",
+    
+    # === BLOQUE RANGOS MEJORADO ===
+    "cantidad_rangos",
+    "rango_1_intervalo", "rango_1_porcentaje", "rango_1_clasificacion",
+    "rango_2_intervalo", "rango_2_porcentaje", "rango_2_clasificacion",
+    "rango_3_intervalo", "rango_3_porcentaje", "rango_3_clasificacion",
+    "rango_4_intervalo", "rango_4_porcentaje", "rango_4_clasificacion",
+    "rango_5_intervalo", "rango_5_porcentaje", "rango_5_clasificacion"
+]
+
+def _formatear_fecha_legible(fecha_str: str) -> str:
+    """Convierte fecha ISO a formato español legible"""
+    if not fecha_str:
+        return "No definida"
+    try:
+        fecha_obj = datetime.strptime(fecha_str, "%Y-%m-%d")
+        return fecha_obj.strftime("%d/%m/%Y")
+    except (ValueError, TypeError):
+        return fecha_str  # Mantener original si hay error
+
+def _formatear_valor_numerico(valor: Any) -> str:
+    """Formatea valores numéricos para mejor legibilidad"""
+    if valor is None or valor == "":
+        return "No definido"
+    try:
+        num = float(valor)
+        if num.is_integer():
+            return str(int(num))
+        return f"{num:.2f}"
+    except (ValueError, TypeError):
+        return str(valor)
+
+def _fila_csv_horizontal(acuerdo: Dict[str, Any], ficha: Dict[str, Any], meta: Dict[str, Any]) -> List[Any]:
+    """Construye la fila CSV horizontal de una meta (mismo orden que ENCABEZADOS_CSV_HORIZONTAL)"""
+    # 🎯 PROCESAMIENTO MEJORADO DE RANGOS
+    rangos = meta.get("rango", [])
+    datos_rangos_mejorados = [""] * 16  # 5 rangos × 3 campos + cantidad
+    
+    # Agregar cantidad de rangos como primer campo
+    datos_rangos_mejorados[0] = len(rangos)
+    
+    for indice, rango in enumerate(rangos[:5]):  # Máximo 5 rangos
+        posicion_base = 1 + (indice * 3)  # Saltar campo cantidad
+        
+        # 🆕 FORMATEO INTELIGENTE DE INTERVALOS
+        min_val = rango.get('min', '')
+        max_val = rango.get('max', '')
+        porcentaje = rango.get('porcentaje', '')
+        
+        # Crear intervalo legible
+        if min_val and max_val:
+            intervalo = f"[{min_val} - {max_val}]"
+        elif min_val and not max_val:
+            intervalo = f"[{min_val} → ∞]"
+        elif not min_val and max_val:
+            intervalo = f"[∞ ← {max_val}]"
+        else:
+            intervalo = "[Sin definir]"
         
-    Returns:
-        str: Contenido CSV formateado
-    """
-    
-    # 🎨 ENCABEZADOS MEJORADOS CON ESTRUCTURA JERÁRQUICA
-    encabezados = [
+        # 🆕 CLASIFICACIÓN AUTOMÁTICA DEL RANGO
+        try:
+            pct_num = float(porcentaje) if porcentaje else 0
+            if pct_num >= 90:
+                clasificacion = "CUMPLIDO"
+            elif pct_num >= 60:
+                clasificacion = "PARCIAL"
+            else:
+                clasificacion = "BAJO"
+        except (ValueError, TypeError):
+            clasificacion = "NO DEFINIDO"
+        
+        datos_rangos_mejorados[posicion_base] = intervalo
+        datos_rangos_mejorados[posicion_base + 1] = f"{porcentaje}%" if porcentaje else ""
+        datos_rangos_mejorados[posicion_base + 2] = clasificacion
+
+    # 🏷️ PREPARAR VALORES LEGIBLES Y CONSISTENTES
+    vencimiento_formateado = _formatear_fecha_legible(meta.get("vencimiento", ""))
+    vigencia_desde_formateado = _formatear_fecha_legible(acuerdo.get("vigencia_desde", ""))
+    vigencia_hasta_formateado = _formatear_fecha_legible(acuerdo.get("vigencia_hasta", ""))
+    ponderacion_formateada = _formatear_valor_numerico(meta.get("ponderacion", 0))
+    cumplimiento_formateado = _formatear_valor_numerico(meta.get("cumplimiento_calc", ""))
+    valor_objetivo_formateado = _formatear_valor_numerico(meta.get("valor_objetivo", ""))
+
+    # ✅ VALORES BOOLEANOS LEGIBLES
+    requiere_salvaguarda = "SÍ" if ficha.get("salvaguarda_flag") else "NO"
+    es_hito_meta = "SÍ" if meta.get("es_hito") else "NO"
+
+    # ✍️ CONSTRUIR FILA DE DATOS PREMIUM
+    return [
         # === BLOQUE INFORMACIÓN GENERAL ===
-        "id_acuerdo", "año_vigencia", "tipo_compromiso", "estado_actual",
-        "tipo_organismo", "nombre_organismo", "organismo_enlace",
-        "vigencia_desde", "vigencia_hasta", "creado_por", "responsable_asignado",
-        
+        acuerdo.get("id", "N/D"),
+        acuerdo.get("año", "N/D"),  # 🆕 CORREGIDO: 'anio' → 'año'
+        acuerdo.get("tipo_compromiso", "No especificado"),
+        acuerdo.get("estado", "Sin estado"),
+        acuerdo.get("organismo_tipo", "No especificado"),
+        acuerdo.get("organismo_nombre", "No especificado"),
+        acuerdo.get("organismo_enlace", "No especificado"),
+        vigencia_desde_formateado,
+        vigencia_hasta_formateado,
+        acuerdo.get("created_by", "No especificado"),
+        acuerdo.get("responsable_username", "No asignado"),
+
         # === BLOQUE FICHA COMPROMISO ===
-        "id_ficha", "nombre_ficha", "tipo_meta",
-        "responsables_cumplimiento", "objetivo_estrategico", "indicador_principal",
-        "metodologia_calculo", "fuente_informacion", "valor_linea_base",
-        "responsables_seguimiento", "observaciones_ficha",
-        "requiere_salvaguarda", "texto_salvaguarda",
-        
+        ficha.get("id", "N/D"),
+        ficha.get("nombre", "Sin nombre"),
+        ficha.get("tipo_meta", "No especificado"),
+        ficha.get("responsables_cumpl", "No asignado"),
+        ficha.get("objetivo", "No definido"),
+        ficha.get("indicador", "No definido"),
+        ficha.get("forma_calculo", "No especificado"),
+        ficha.get("fuente", "No definida"),
+        ficha.get("valor_base", "No establecido"),
+        ficha.get("responsables_seguimiento", "No asignado"),
+        ficha.get("observaciones", "Sin observaciones"),
+        requiere_salvaguarda,
+        ficha.get("salvaguarda_text", "No aplica"),
+
         # === BLOQUE META ESPECÍFICA ===
-        "id_meta", "numero_meta", "descripcion_meta", "estado_meta",
-        "unidad_medida", "valor_objetivo", "sentido_cumplimiento",
-        "frecuencia_medicion", "fecha_vencimiento", "es_hito_critico",
-        "ponderacion_porcentual", "valor_alcanzado", "porcentaje_cumplimiento",
-        "observaciones_meta",
-        
+        meta.get("id", "N/D"),
+        meta.get("numero", "N/D"),
+        meta.get("descripcion", "Sin descripción"),
+        meta.get("estado", "No iniciada"),
+        meta.get("unidad", "No definida"),
+        valor_objetivo_formateado,
+        meta.get("sentido", "No definido"),
+        meta.get("frecuencia", "No definida"),
+        vencimiento_formateado,
+        es_hito_meta,
+        f"{ponderacion_formateada}%",
+        _formatear_valor_numerico(meta.get("cumplimiento_valor", "")),
+        f"{cumplimiento_formateado}%" if cumplimiento_formateado != "No definido" else "No calculado",
+        meta.get("observaciones", "Sin observaciones"),
+
         # === BLOQUE RANGOS MEJORADO ===
-        "cantidad_rangos",
-        "rango_1_intervalo", "rango_1_porcentaje", "rango_1_clasificacion",
-        "rango_2_intervalo", "rango_2_porcentaje", "rango_2_clasificacion",
-        "rango_3_intervalo", "rango_3_porcentaje", "rango_3_clasificacion",
-        "rango_4_intervalo", "rango_4_porcentaje", "rango_4_clasificacion",
-        "rango_5_intervalo", "rango_5_porcentaje", "rango_5_clasificacion"
+        *datos_rangos_mejorados
     ]
 
-    # 📝 CONFIGURACIÓN CSV AVANZADA
-    buffer = io.StringIO()
-    escritor = csv.writer(
+def iterar_filas_csv_horizontal(acuerdos: Iterable[Dict[str, Any]]) -> Iterator[List[Any]]:
+    """
+    🔄 Genera las filas CSV horizontales (sin encabezado) de cualquier conjunto de acuerdos.
+    
+    Recorre acuerdo → ficha → meta de forma perezosa: nunca mantiene en memoria
+    más de una fila, por lo que sirve para exportar un año completo.
+    """
+    for acuerdo in acuerdos:
+        for ficha in acuerdo.get("fichas", []):
+            for meta in ficha.get("metas", []):
+                yield _fila_csv_horizontal(acuerdo, ficha, meta)
+
+def _nuevo_escritor_csv_horizontal(buffer):
+    """Escritor CSV con la configuración del formato horizontal"""
+    return csv.writer(
         buffer,
         delimiter=',',
         quotechar='"',
@@ -2296,144 +3931,69 @@ def export_csv_horizontal_agreement(acuerdo: Dict[str, Any]) -> str:
         lineterminator='\n'
     )
 
+def export_csv_horizontal_agreement(acuerdo: Dict[str, Any]) -> str:
+    """
+    📊 Exporta acuerdo a formato CSV horizontal premium - VERSIÓN CORREGIDA
+    
+    Args:
+        acuerdo: Diccionario con datos del acuerdo
+        
+    Returns:
+        str: Contenido CSV formateado
+    """
+    # 📝 CONFIGURACIÓN CSV AVANZADA
+    buffer = io.StringIO()
+    escritor = _nuevo_escritor_csv_horizontal(buffer)
+
     # ✨ ESCRIBIR ENCABEZADOS
-    escritor.writerow(encabezados)
+    escritor.writerow(ENCABEZADOS_CSV_HORIZONTAL)
 
     # 🔄 PROCESAR CADA FICHA Y META
-    for ficha in acuerdo.get("fichas", []):
-        for meta in ficha.get("metas", []):
-            # 🎯 PROCESAMIENTO MEJORADO DE RANGOS
-            rangos = meta.get("rango", [])
-            datos_rangos_mejorados = [""] * 16  # 5 rangos × 3 campos + cantidad
-            
-            # Agregar cantidad de rangos como primer campo
-            datos_rangos_mejorados[0] = len(rangos)
-            
-            for indice, rango in enumerate(rangos[:5]):  # Máximo 5 rangos
-                if indice < 5:
-                    posicion_base = 1 + (indice * 3)  # Saltar campo cantidad
-                    
-                    # 🆕 FORMATEO INTELIGENTE DE INTERVALOS
-                    min_val = rango.get('min', '')
-                    max_val = rango.get('max', '')
-                    porcentaje = rango.get('porcentaje', '')
-                    
-                    # Crear intervalo legible
-                    if min_val and max_val:
-                        intervalo = f"[{min_val} - {max_val}]"
-                    elif min_val and not max_val:
-                        intervalo = f"[{min_val} → ∞]"
-                    elif not min_val and max_val:
-                        intervalo = f"[∞ ← {max_val}]"
-                    else:
-                        intervalo = "[Sin definir]"
-                    
-                    # 🆕 CLASIFICACIÓN AUTOMÁTICA DEL RANGO
-                    try:
-                        pct_num = float(porcentaje) if porcentaje else 0
-                        if pct_num >= 90:
-                            clasificacion = "CUMPLIDO"
-                        elif pct_num >= 60:
-                            clasificacion = "PARCIAL"
-                        else:
-                            clasificacion = "BAJO"
-                    except (ValueError, TypeError):
-                        clasificacion = "NO DEFINIDO"
-                    
-                    datos_rangos_mejorados[posicion_base] = intervalo
-                    datos_rangos_mejorados[posicion_base + 1] = f"{porcentaje}%" if porcentaje else ""
-                    datos_rangos_mejorados[posicion_base + 2] = clasificacion
-
-            # 📅 FORMATEADOR DE FECHAS MEJORADO
-            def formatear_fecha_legible(fecha_str: str) -> str:
-                """Convierte fecha ISO a formato español legible"""
-                if not fecha_str:
-                    return "No definida"
-                try:
-                    fecha_obj = datetime.strptime(fecha_str, "%Y-%m-%d")
-                    return fecha_obj.strftime("%d/%m/%Y")
-                except (ValueError, TypeError):
-                    return fecha_str  # Mantener original si hay error
-
-            # 🔢 FORMATEADOR DE VALORES NUMÉRICOS
-            def formatear_valor_numerico(valor: Any) -> str:
-                """Formatea valores numéricos para mejor legibilidad"""
-                if valor is None or valor == "":
-                    return "No definido"
-                try:
-                    num = float(valor)
-                    if num.is_integer():
-                        return str(int(num))
-                    return f"{num:.2f}"
-                except (ValueError, TypeError):
-                    return str(valor)
-
-            # 🏷️ PREPARAR VALORES LEGIBLES Y CONSISTENTES
-            vencimiento_formateado = formatear_fecha_legible(meta.get("vencimiento", ""))
-            vigencia_desde_formateado = formatear_fecha_legible(acuerdo.get("vigencia_desde", ""))
-            vigencia_hasta_formateado = formatear_fecha_legible(acuerdo.get("vigencia_hasta", ""))
-            ponderacion_formateada = formatear_valor_numerico(meta.get("ponderacion", 0))
-            cumplimiento_formateado = formatear_valor_numerico(meta.get("cumplimiento_calc", ""))
-            valor_objetivo_formateado = formatear_valor_numerico(meta.get("valor_objetivo", ""))
-
-            # ✅ VALORES BOOLEANOS LEGIBLES
-            requiere_salvaguarda = "SÍ" if ficha.get("salvaguarda_flag") else "NO"
-            es_hito_meta = "SÍ" if meta.get("es_hito") else "NO"
-
-            # ✍️ CONSTRUIR FILA DE DATOS PREMIUM
-            fila_datos = [
-                # === BLOQUE INFORMACIÓN GENERAL ===
-                acuerdo.get("id", "N/D"),
-                acuerdo.get("año", "N/D"),  # 🆕 CORREGIDO: 'anio' → 'año'
-                acuerdo.get("tipo_compromiso", "No especificado"),
-                acuerdo.get("estado", "Sin estado"),
-                acuerdo.get("organismo_tipo", "No especificado"),
-                acuerdo.get("organismo_nombre", "No especificado"),
-                acuerdo.get("organismo_enlace", "No especificado"),
-                vigencia_desde_formateado,
-                vigencia_hasta_formateado,
-                acuerdo.get("created_by", "No especificado"),
-                acuerdo.get("responsable_username", "No asignado"),
-
-                # === BLOQUE FICHA COMPROMISO ===
-                ficha.get("id", "N/D"),
-                ficha.get("nombre", "Sin nombre"),
-                ficha.get("tipo_meta", "No especificado"),
-                ficha.get("responsables_cumpl", "No asignado"),
-                ficha.get("objetivo", "No definido"),
-                ficha.get("indicador", "No definido"),
-                ficha.get("forma_calculo", "No especificado"),
-                ficha.get("fuente", "No definida"),
-                ficha.get("valor_base", "No establecido"),
-                ficha.get("responsables_seguimiento", "No asignado"),
-                ficha.get("observaciones", "Sin observaciones"),
-                requiere_salvaguarda,
-                ficha.get("salvaguarda_text", "No aplica"),
-
-                # === BLOQUE META ESPECÍFICA ===
-                meta.get("id", "N/D"),
-                meta.get("numero", "N/D"),
-                meta.get("descripcion", "Sin descripción"),
-                meta.get("estado", "No iniciada"),
-                meta.get("unidad", "No definida"),
-                valor_objetivo_formateado,
-                meta.get("sentido", "No definido"),
-                meta.get("frecuencia", "No definida"),
-                vencimiento_formateado,
-                es_hito_meta,
-                f"{ponderacion_formateada}%",
-                formatear_valor_numerico(meta.get("cumplimiento_valor", "")),
-                f"{cumplimiento_formateado}%" if cumplimiento_formateado != "No definido" else "No calculado",
-                meta.get("observaciones", "Sin observaciones"),
-
-                # === BLOQUE RANGOS MEJORADO ===
-                *datos_rangos_mejorados
-            ]
-
-            escritor.writerow(fila_datos)
+    escritor.writerows(iterar_filas_csv_horizontal([acuerdo]))
 
     return buffer.getvalue()
 
+def exportar_csv_horizontal_streaming(acuerdos: Iterable[Dict[str, Any]],
+                                      destino: Optional[str] = None,
+                                      filas_por_bloque: int = 500) -> str:
+    """
+    📦 Exporta cualquier conjunto de acuerdos a un archivo CSV horizontal en disco.
+    
+    Las filas se codifican en UTF-8 y se vuelcan al archivo cada `filas_por_bloque`
+    filas, así la memoria usada no depende de la cantidad de metas exportadas.
+    Usa los mismos encabezados que crear_plantilla_csv_vacia, por lo que el
+    archivo resultante se puede volver a importar.
+    
+    Args:
+        acuerdos: Iterable de acuerdos (puede ser un generador)
+        destino: Ruta del archivo a escribir; si es None se crea un temporal
+        filas_por_bloque: Cantidad de filas por bloque codificado
+        
+    Returns:
+        str: Ruta del archivo CSV generado
+    """
+    if destino is None:
+        fd, destino = tempfile.mkstemp(prefix="export_cg_", suffix=".csv")
+        os.close(fd)
+    
+    buffer = io.StringIO()
+    escritor = _nuevo_escritor_csv_horizontal(buffer)
+    escritor.writerow(ENCABEZADOS_CSV_HORIZONTAL)
+    
+    with open(destino, "wb") as f:
+        pendientes = 0
+        for fila in iterar_filas_csv_horizontal(acuerdos):
+            escritor.writerow(fila)
+            pendientes += 1
+            if pendientes >= filas_por_bloque:
+                f.write(buffer.getvalue().encode("utf-8"))
+                buffer.seek(0)
+                buffer.truncate(0)
+                pendientes = 0
+        f.write(buffer.getvalue().encode("utf-8"))
+    
+    return destino
+
 def import_csv_horizontal_to_ficha(df, acuerdo_id):  # ← Simple, 2 parámetros
     """
     📥 Importa una ficha desde formato CSV horizontal
@@ -2568,7 +4128,6 @@ def import_csv_horizontal_to_ficha(df, acuerdo_id):  # ← Simple, 2 parámetros
                 "ponderacion": ponderacion,
                 "observaciones": meta_data.get('observaciones_meta', ''),
                 "estado": meta_data.get('estado_meta', 'No Iniciada'),
-                "historial_estados": [],
                 "rango": rangos_importados,
                 "rangos_cumplimiento": rangos_importados.copy() if rangos_importados else [],
                 "cumplimiento_valor": meta_data.get('valor_alcanzado', ''),
@@ -2589,35 +4148,8 @@ def crear_plantilla_csv_vacia():
     """
     📝 Crea una plantilla CSV vacía basada en la estructura de exportación
     """
-    # Usar los mismos encabezados que tu función de exportación
-    encabezados = [
-        # === BLOQUE INFORMACIÓN GENERAL ===
-        "id_acuerdo", "año_vigencia", "tipo_compromiso", "estado_actual",
-        "tipo_organismo", "nombre_organismo", "organismo_enlace",
-        "vigencia_desde", "vigencia_hasta", "creado_por", "responsable_asignado",
-        
-        # === BLOQUE FICHA COMPROMISO ===
-        "id_ficha", "nombre_ficha", "tipo_meta",
-        "responsables_cumplimiento", "objetivo_estrategico", "indicador_principal",
-        "metodologia_calculo", "fuente_informacion", "valor_linea_base",
-        "responsables_seguimiento", "observaciones_ficha",
-        "requiere_salvaguarda", "texto_salvaguarda",
-        
-        # === BLOQUE META ESPECÍFICA ===
-        "id_meta", "numero_meta", "descripcion_meta", "estado_meta",
-        "unidad_medida", "valor_objetivo", "sentido_cumplimiento",
-        "frecuencia_medicion", "fecha_vencimiento", "es_hito_critico",
-        "ponderacion_porcentual", "valor_alcanzado", "porcentaje_cumplimiento",
-        "observaciones_meta",
-        
-        # === BLOQUE RANGOS MEJORADO ===
-        "cantidad_rangos",
-        "rango_1_intervalo", "rango_1_porcentaje", "rango_1_clasificacion",
-        "rango_2_intervalo", "rango_2_porcentaje", "rango_2_clasificacion",
-        "rango_3_intervalo", "rango_3_porcentaje", "rango_3_clasificacion",
-        "rango_4_intervalo", "rango_4_porcentaje", "rango_4_clasificacion",
-        "rango_5_intervalo", "rango_5_porcentaje", "rango_5_clasificacion"
-    ]
+    # Usar los mismos encabezados que la función de exportación
+    encabezados = ENCABEZADOS_CSV_HORIZONTAL
     
     buffer = io.StringIO()
     writer = csv.writer(buffer)
@@ -2764,12 +4296,17 @@ def calcular_cumplimiento(meta: Dict[str, Any]) -> Optional[float]:
     
     return 0.0
 
-def clasificar_cumplimiento_meta(meta: Dict[str, Any]) -> str:
+def clasificar_cumplimiento_meta(meta: Dict[str, Any], cumplimiento: Optional[float] = None) -> str:
     """
     Clasifica una meta según sus rangos de cumplimiento configurables
     Retorna: 'cumplida', 'parcial', o 'no_cumplida'
+    
+    Args:
+        cumplimiento: Cumplimiento a clasificar (p. ej. el efectivo de la tabla plana);
+                      por defecto el cumplimiento_calc guardado en la meta
     """
-    cumplimiento = meta.get("cumplimiento_calc")
+    if cumplimiento is None:
+        cumplimiento = meta.get("cumplimiento_calc")
     
     # Si no hay cumplimiento calculado, se considera no cumplida
     if cumplimiento is None or not isinstance(cumplimiento, (int, float)):
@@ -3095,6 +4632,12 @@ def page_admin():
                 st.rerun()
         else:
             st.error("❌ Todos los campos marcados con * son obligatorios")
+    
+    st.markdown("---")
+    
+    # ==================== SECCIÓN 4: ARCHIVO DE ACUERDOS CERRADOS ====================
+    st.header("📦 Archivo de Acuerdos Cerrados")
+    administrar_archivo_acuerdos()
 
 def page_agreements():
     require_login()
@@ -3125,13 +4668,13 @@ def page_agreements():
             )
             
             db[agr["id"]] = agr
-            agreements_save(db)
+            agreements_save(db, [agr["id"]])
             audit_log("create_agreement", {"id": agr["id"], "by": st.session_state.user["username"]})
             st.success(f"Acuerdo {agr['id']} creado")
             st.rerun()
     
-    # 🆕 SIN FILTROS TEMPORALES - MOSTRAR TODOS LOS ACUERDOS
-    years = sorted({a.get("año", date.today().year) for a in db.values()}) if db else [date.today().year]
+    # 🆕 SIN FILTROS TEMPORALES - MOSTRAR TODOS LOS ACUERDOS (incluye los años archivados)
+    years = años_con_acuerdos(db)
     fy = st.selectbox("Filtrar por año", options=years, index=len(years)-1)
     ft = st.selectbox("Tipo de compromiso", options=TIPO_COMPROMISO, 
                      index=safe_index(TIPO_COMPROMISO, TIPO_COMPROMISO[0]))
@@ -3169,19 +4712,29 @@ def page_agreements():
                         st.session_state[f"confirm_delete_{current_agr_id}"] = True
                         st.warning(f"¿Eliminar {current_agr_id}? Presiona eliminar nuevamente.")
                     else:
-                        # Eliminar archivos adjuntos primero
-                        for att in current_agr.get("attachments", []):
-                            try:
-                                if os.path.exists(att.get("path", "")):
-                                    os.remove(att["path"])
-                            except:
-                                pass
-                        # Eliminar el acuerdo de la base de datos
+                        # Eliminar el acuerdo de la base de datos (sus adjuntos sin otras referencias se liberan al guardar)
                         del db[current_agr_id]
-                        agreements_save(db)
+                        obtener_almacen_historial().eliminar(current_agr_id)
+                        agreements_save(db, [current_agr_id])
                         audit_log("delete_agreement", {"id": current_agr_id, "by": st.session_state.user["username"]})
                         st.success(f"Acuerdo {current_agr_id} eliminado correctamente")
                         st.rerun()         
+    
+    # 🆕 ACUERDOS ARCHIVADOS DEL AÑO: SOLO EL RESUMEN, EL DOCUMENTO SE LEE AL PEDIRLO
+    archivados = [r for r in obtener_almacen_archivo().resumenes(fy).values() if r.get("tipo_compromiso") == ft]
+    if archivados:
+        st.markdown("---")
+        st.markdown(f"#### 📦 Archivados ({len(archivados)}) - solo lectura")
+        for resumen in archivados:
+            cols = st.columns([3, 2, 2, 2])
+            cols[0].write(f"**{resumen.get('organismo_nombre') or 'Sin nombre'}**  \n*Código: {resumen['id']}*")
+            cols[1].write(f"**Estado:** {resumen.get('estado')}  \n**Fichas:** {resumen.get('fichas', 0)} · **Metas:** {resumen.get('metas', 0)}")
+            cols[2].write(f"**Cumplimiento:** {_texto_cumplimiento(resumen.get('cumplimiento'))}")
+            if cols[3].button("👁️ Ver", key=f"ver_archivado_{resumen['id']}"):
+                st.session_state["ver_archivado"] = resumen["id"]
+                st.rerun()
+    if st.session_state.get("ver_archivado"):
+        mostrar_acuerdo_archivado(st.session_state["ver_archivado"])
                   
     # ------------------------------------------------------------------
     # Expander con herramientas avanzadas
@@ -3204,7 +4757,7 @@ def page_agreements():
             
         col_top1.subheader(f"Editar Acuerdo: {agr['id']}")
         if col_top2.button("💾 Guardar Todo"):
-            db[agr["id"]] = agr; agreements_save(db); audit_log("save_agreement", {"id":agr["id"], "by":user["username"]}); st.success("Guardado"); st.rerun()
+            db[agr["id"]] = agr; agreements_save(db, [agr["id"]]); audit_log("save_agreement", {"id":agr["id"], "by":user["username"]}); st.success("Guardado"); st.rerun()
             
         # === CÓDIGO DE SEGURIDAD AQUÍ ===
         # Solo mostrar botón de eliminar si el usuario tiene permisos
@@ -3215,16 +4768,10 @@ def page_agreements():
                     st.session_state[f"confirm_delete_detailed_{agr['id']}"] = True
                     st.warning(f"¿Estás seguro de eliminar el acuerdo {agr['id']}? Esta acción no se puede deshacer. Presiona eliminar nuevamente para confirmar.")
                 else:
-                    # Eliminar archivos adjuntos
-                    for att in agr.get("attachments", []):
-                        try:
-                            if os.path.exists(att.get("path", "")):
-                                os.remove(att["path"])
-                        except:
-                            pass
-                    # Eliminar el acuerdo
+                    # Eliminar el acuerdo (sus adjuntos sin otras referencias se liberan al guardar)
                     del db[agr["id"]]
-                    agreements_save(db)
+                    obtener_almacen_historial().eliminar(agr["id"])
+                    agreements_save(db, [agr["id"]])
                     audit_log("delete_agreement", {"id": agr["id"], "by": user["username"]})
                     st.success(f"Acuerdo {agr['id']} eliminado correctamente")
                     # Limpiar el estado para volver a la lista
@@ -3375,74 +4922,57 @@ def page_agreements():
         if up and editable:
             if st.button("💾 Guardar Archivos Seleccionados", key=f"save_adjuntos_{agr['id']}"):
                 successful_uploads = 0
+                almacen = obtener_almacen_adjuntos()
                     
                 for i, file in enumerate(up[:5]):
                     try:
-                        # Verificar y crear directorio
-                        upload_dir = os.path.join(UPLOADS_DIR, agr["id"])
-                        os.makedirs(upload_dir, exist_ok=True)
-                            
-                        # Generar nombre seguro
-                        safe_filename = file.name
-                        file_path = os.path.join(upload_dir, safe_filename)
-                            
-                        # Si el archivo ya existe, agregar timestamp
-                        if os.path.exists(file_path):
-                            name, ext = os.path.splitext(file.name)
-                            safe_filename = f"{name}_{int(time.time())}_{i}{ext}"
-                            file_path = os.path.join(upload_dir, safe_filename)
-                            
-                        # Guardar archivo en disco
-                        with open(file_path, "wb") as f:
-                            f.write(file.getvalue())
-                            
-                        # Agregar a la lista de adjuntos del acuerdo
+                        # Guardar en el almacén por contenido (un archivo repetido no se vuelve a escribir)
+                        registro = almacen.adjunto(file.name, file)
+                        
+                        # Agregar a la lista de adjuntos del acuerdo (se trae del almacén de historial)
                         if "attachments" not in agr:
-                            agr["attachments"] = []
-                            
-                        # Verificar que no exista ya este archivo
-                        existing_files = [a["name"] for a in agr["attachments"]]
-                        if safe_filename not in existing_files:
-                            agr["attachments"].append({
-                                "name": safe_filename,
-                                "path": file_path,
-                                "upload_time": datetime.now().isoformat()
-                            })
-                            successful_uploads += 1
+                            agr["attachments"] = adjuntos_acuerdo(agr)
+                        
+                        # El mismo contenido ya adjunto a este acuerdo no se repite; otro
+                        # contenido con el mismo nombre se distingue con el inicio del hash
+                        if any(a.get("sha256") == registro["sha256"] for a in agr["attachments"]):
+                            continue
+                        if any(a["name"] == registro["name"] for a in agr["attachments"]):
+                            name, ext = os.path.splitext(file.name)
+                            registro["name"] = f"{name}_{registro['sha256'][:8]}{ext}"
+                        agr["attachments"].append(registro)
+                        successful_uploads += 1
                             
                     except Exception as e:
                         st.error(f"Error subiendo {file.name}: {str(e)}")
                     
                 if successful_uploads > 0:
-                    agreements_save(db)
+                    agreements_save(db, [agr["id"]])
                     st.success(f"✅ {successful_uploads} archivo(s) guardado(s)")
                     st.rerun()
                 else:
                     st.warning("⚠️ No se guardaron nuevos archivos")
                 
-        if agr.get("attachments"):
+        adjuntos = adjuntos_acuerdo(agr)
+        if adjuntos:
             st.markdown("Archivos:")
             uniq=[]; seen=set()
-            for att in agr.get("attachments", []):
+            for att in adjuntos:
                 if att["name"] not in seen: uniq.append(att); seen.add(att["name"])
             for i, att in enumerate(uniq):
                 c1,c2,c3 = st.columns([3,1,1])
                 c1.write(f"📄 {att['name']}")
-                try:
-                    with open(att["path"], "rb") as f:
-                        file_data = f.read()
-                    c2.download_button("⬇️ Descargar", data=file_data, file_name=att["name"], key=f"dl_{agr['id']}_{i}")
-                except:
-                    c2.error("No encontrado")
+                # 🆕 El archivo se lee solo cuando el usuario lo prepara para descargar
+                boton_descarga_adjunto(c2, agr["id"], att, i)
                 if c3.button("🗑️", key=f"del_att_{agr['id']}_{i}"):
                     if editable:
-                        try:
-                            if os.path.exists(att.get("path","")): os.remove(att["path"])
-                        except: pass
-                        agr["attachments"] = [a for a in agr.get("attachments", []) if a["path"] != att["path"]]
-                        agreements_save(db); st.success("Archivo eliminado"); st.rerun()
+                        # El blob se elimina al guardar solo si ningún otro acuerdo lo referencia
+                        agr["attachments"] = [a for a in adjuntos if a["name"] != att["name"]]
+                        agreements_save(db, [agr["id"]]); st.success("Archivo eliminado"); st.rerun()
                     else:
                         st.error("No tienes permisos para eliminar archivos")
+            if len(uniq) > 1:
+                boton_descarga_todos_adjuntos(agr)
                             
         st.subheader("Fichas")
         col_add1, col_add2 = st.columns(2)
@@ -3466,7 +4996,7 @@ def page_agreements():
             }
             
             agr.setdefault("fichas", []).append(new_ficha)
-            agreements_save(db)
+            agreements_save(db, [agr["id"]])
             audit_log("create_ficha", {"agr": agr["id"], "ficha": fid, "by": user["username"]})
             st.success(f"Ficha {fid} creada exitosamente")  # ✅ MENSAJE DE CONFIRMACIÓN
             st.rerun()  # ✅ ESTA LÍNEA ES CLAVE
@@ -3499,16 +5029,18 @@ def page_agreements():
                     type=["csv"],
                     key=f"csv_upload_{agr['id']}"
                 )
+                solo_validar = st.checkbox("🔍 Solo validar (dry run, no importa)", key=f"dry_run_{agr['id']}")
                     
                 if upl:
                     try:
                         with st.spinner("Procesando archivo CSV..."):
                             fichas_antes = len(agr.get("fichas", []))
-                            imported = detectar_y_importar_csv(upl.getvalue(), agr)
-                            agreements_save(db)
-                            fichas_despues = len(agr.get("fichas", []))
+                            imported = detectar_y_importar_csv(upl.getvalue(), agr, solo_validar)
                                 
+                            # 🆕 SOLO SE GUARDA SI SE IMPORTÓ ALGO (el dry run no escribe nada)
                             if imported > 0:
+                                agreements_save(db, [agr["id"]])
+                                fichas_despues = len(agr.get("fichas", []))
                                 st.success(f"✅ Importación completada. {imported} registros procesados")
                                 st.metric("Fichas agregadas", fichas_despues - fichas_antes)
                                     
@@ -3521,7 +5053,7 @@ def page_agreements():
                                 # Botón para ver fichas
                                 if st.button("👀 Ver fichas importadas", key=f"view_imported_{agr['id']}"):
                                     st.rerun()
-                            else:
+                            elif not solo_validar:
                                 st.warning("⚠️ No se importaron nuevos registros")
                                     
                     except Exception as e:
@@ -3552,16 +5084,18 @@ def page_agreements():
                         help="Suba un archivo CSV con el formato de plantilla horizontal",
                         key=f"csv_upload_advanced_{agr['id']}"
                     )
+                    solo_validar_avz = st.checkbox("🔍 Solo validar (dry run, no importa)", key=f"dry_run_advanced_{agr['id']}")
                     
                     if upl:
                         try:
                             with st.spinner("🔄 Procesando archivo CSV..."):
                                 fichas_antes = len(agr.get("fichas", []))
-                                imported = detectar_y_importar_csv(upl.getvalue(), agr)
-                                agreements_save(db)
-                                fichas_despues = len(agr.get("fichas", []))
+                                imported = detectar_y_importar_csv(upl.getvalue(), agr, solo_validar_avz)
                                 
+                                # 🆕 SOLO SE GUARDA SI SE IMPORTÓ ALGO (el dry run no escribe nada)
                                 if imported > 0:
+                                    agreements_save(db, [agr["id"]])
+                                    fichas_despues = len(agr.get("fichas", []))
                                     st.success(f"✅ Importación completada exitosamente!")
                                     st.balloons()
                                     
@@ -3579,7 +5113,7 @@ def page_agreements():
                                     # 🆕 BOTÓN PARA ACTUALIZAR VISTA
                                     if st.button("🔄 Actualizar vista para ver cambios", key=f"refresh_view_{agr['id']}"):
                                         st.rerun()
-                                else:
+                                elif not solo_validar_avz:
                                     st.warning("⚠️ No se importaron nuevos registros. Verifique el formato del archivo.")
                                     
                         except Exception as e:
@@ -3632,7 +5166,7 @@ def page_agreements():
                 
                 with col_exp3:
                     # Exportar JSON completo
-                    json_data = json.dumps(agr, ensure_ascii=False, indent=2)
+                    json_data = json.dumps(obtener_almacen_historial().completar(agr), ensure_ascii=False, indent=2)
                     st.download_button(
                         "📄 Exportar JSON",
                         data=json_data.encode("utf-8"),
@@ -3701,7 +5235,7 @@ def page_agreements():
                             
                             if nueva_ficha:
                                 agr.setdefault("fichas", []).append(nueva_ficha)
-                                agreements_save(db)
+                                agreements_save(db, [agr["id"]])
                                 st.success("✅ Ficha cargada exitosamente")
                                 st.rerun()
                         except Exception as e:
@@ -3729,7 +5263,7 @@ def page_agreements():
                     "metas": []
                 }
                 agr.setdefault("fichas", []).append(nueva_ficha)
-                agreements_save(db)
+                agreements_save(db, [agr["id"]])
                 st.rerun() 
                 
             for fi_index, fi in enumerate(agr.get("fichas", [])):
@@ -3850,11 +5384,10 @@ def page_agreements():
                             "cumplimiento_valor": "",
                             "cumplimiento_calc": None,
                             "observaciones": "",
-                            "estado": "No Iniciada",
-                            "historial_estados": []
+                            "estado": "No Iniciada"
                         }
                         fi.setdefault("metas", []).append(meta)
-                        agreements_save(db)
+                        agreements_save(db, [agr["id"]])
                         st.rerun()
                         
                     if fi.get("metas"):
@@ -3903,14 +5436,17 @@ def page_agreements():
                                         m["fecha_cambio_estado"] = datetime.now().isoformat()
                                         st.info(f"Estado cambiado a: {nuevo_estado_meta}")
                                         
-                                # Mostrar historial de la meta si existe
-                                if m.get("historial_estados"):
-                                    with st.expander("📊 Historial de estados de esta meta", expanded=False):
-                                        for i, hist in enumerate(reversed(m["historial_estados"][-3:])): # Últimos 3
-                                            st.write(f"**{hist['fecha'][:10]}**: {hist['estado_anterior']} → {hist['estado_nuevo']}")
-                                            st.write(f"*Por: {hist['usuario']}*")
-                                            if i < len(m["historial_estados"][-3:]) - 1: # No poner línea después del último
-                                                st.markdown("---")
+                                # Historial de la meta: se lee del almacén solo si se pide
+                                if st.checkbox("📊 Ver historial de estados de esta meta", key=f"hist_meta_{agr['id']}_{fi_index}_{m_index}"):
+                                    historial_meta = (obtener_almacen_historial().estados_meta(agr["id"], m.get("id"))
+                                                      + m.get("historial_estados", []))[-3:] # Últimos 3 (con los no guardados)
+                                    if not historial_meta:
+                                        st.caption("Sin cambios de estado registrados")
+                                    for i, hist in enumerate(reversed(historial_meta)):
+                                        st.write(f"**{hist['fecha'][:10]}**: {hist['estado_anterior']} → {hist['estado_nuevo']}")
+                                        st.write(f"*Por: {hist['usuario']}*")
+                                        if i < len(historial_meta) - 1: # No poner línea después del último
+                                            st.markdown("---")
                                 # ==================================================
                                 # 🆕 FIN DE ESTADOS DE META
                                 # ==================================================
@@ -3925,11 +5461,11 @@ def page_agreements():
                                     rango["porcentaje"] = cr3.text_input("Porcentaje", value=rango.get("porcentaje",""), key=f"pct_{agr['id']}_{fi_index}_{m_index}_{r_index}", disabled=not editable)
                                     if cr4.button("🗑️", key=f"del_rango_{agr['id']}_{fi_index}_{m_index}_{r_index}", disabled=not editable) and len(m["rango"])>1:
                                         m["rango"].pop(r_index)
-                                        agreements_save(db)
+                                        agreements_save(db, [agr["id"]])
                                         st.rerun()
                                 if editable and st.button("➕ Agregar rango", key=f"add_rango_{agr['id']}_{fi_index}_{m_index}"):
                                     m.setdefault("rango",[]).append({"min":"","max":"","porcentaje":""})
-                                    agreements_save(db)
+                                    agreements_save(db, [agr["id"]])
                                     st.rerun()
                                     
                                 col_p1, col_p2 = st.columns(2)
@@ -3990,13 +5526,13 @@ def page_agreements():
 
                                 colmA, colmB = st.columns([1,1])
                                 if colmA.button("💾 Guardar meta", key=f"save_meta_{agr['id']}_{fi_index}_{m_index}", disabled=not editable):
-                                    agreements_save(db); audit_log("save_meta", {"agr":agr["id"], "ficha":fi["id"], "meta":m["id"], "by":user["username"]}); st.success("Meta guardada")
+                                    agreements_save(db, [agr["id"]]); audit_log("save_meta", {"agr":agr["id"], "ficha":fi["id"], "meta":m["id"], "by":user["username"]}); st.success("Meta guardada")
                                 if colmB.button("🗑️ Eliminar meta", key=f"del_meta_{agr['id']}_{fi_index}_{m_index}"):
                                     if st.session_state.get(f"confirm_del_meta_{m['id']}") != True:
                                         st.session_state[f"confirm_del_meta_{m['id']}"] = True
                                         st.warning("Confirma eliminar meta (presiona eliminar nuevamente).")
                                     else:
-                                        fi["metas"].pop(m_index); agreements_save(db); audit_log("delete_meta", {"agr":agr["id"], "ficha":fi["id"], "meta":m["id"], "by":user["username"]}); st.success("Meta eliminada"); st.rerun()
+                                        fi["metas"].pop(m_index); agreements_save(db, [agr["id"]]); audit_log("delete_meta", {"agr":agr["id"], "ficha":fi["id"], "meta":m["id"], "by":user["username"]}); st.success("Meta eliminada"); st.rerun()
                                         
                     # 🆕 CORREGIR CLAVE DEL BOTÓN DE VALIDACIÓN
                     if st.button("✅ Validar ponderaciones de ficha", key=f"valid_{agr['id']}_{fi_index}_{int(time.time())}"):
@@ -4005,13 +5541,13 @@ def page_agreements():
                     colfA, colfB = st.columns([1,1])
                     # 🆕 CORREGIR CLAVE DEL BOTÓN GUARDAR FICHA
                     if colfA.button("💾 Guardar ficha", key=f"save_ficha_{agr['id']}_{fi_index}"):
-                        agreements_save(db); audit_log("save_ficha", {"agr":agr["id"], "ficha":fi["id"], "by":user["username"]}); st.success("Ficha guardada")
+                        agreements_save(db, [agr["id"]]); audit_log("save_ficha", {"agr":agr["id"], "ficha":fi["id"], "by":user["username"]}); st.success("Ficha guardada")
                     # 🆕 CORREGIR CLAVE DEL BOTÓN ELIMINAR FICHA
                     if colfB.button("🗑️ Eliminar ficha", key=f"del_ficha_{agr['id']}_{fi_index}"):
                         if st.session_state.get(f"confirm_del_ficha_{fi['id']}") != True:
                             st.session_state[f"confirm_del_ficha_{fi['id']}"] = True; st.warning("Confirma eliminar ficha (presiona eliminar nuevamente).")
                         else:
-                            agr["fichas"].pop(fi_index); agreements_save(db); audit_log("delete_ficha", {"agr":agr["id"], "ficha":fi["id"], "by":user["username"]}); st.success("Ficha eliminada"); st.rerun()
+                            agr["fichas"].pop(fi_index); agreements_save(db, [agr["id"]]); audit_log("delete_ficha", {"agr":agr["id"], "ficha":fi["id"], "by":user["username"]}); st.success("Ficha eliminada"); st.rerun()
         else:
             st.info("No hay fichas. Usa 'Crear Ficha Manual' o la carga masiva.")
             
@@ -4020,10 +5556,12 @@ def page_agreements():
             estado_actual = agr.get("estado", "Borrador")
             st.markdown(f"### 📊 Estado: **{estado_actual}**")
             
-            # Mostrar historial de estados
-            if agr.get("approval_flow"):
-                st.markdown("#### 📈 Historial de Estados:")
-                for i, cambio in enumerate(reversed(agr["approval_flow"][-5:])): # Últimos 5
+            # Mostrar historial de estados (se lee del almacén de historial solo si se pide)
+            if st.checkbox("📈 Ver historial de estados", key=f"ver_flujo_{agr['id']}"):
+                flujo = obtener_almacen_historial().aprobaciones(agr["id"]) + agr.get("approval_flow", [])
+                if not flujo:
+                    st.caption("Sin cambios de estado registrados")
+                for i, cambio in enumerate(reversed(flujo[-5:])): # Últimos 5
                     with st.expander(f"{cambio['timestamp'][:10]} - {cambio['estado_nuevo']}", expanded=False):
                         st.write(f"**Usuario:** {cambio['usuario']} ({cambio['rol']})")
                         st.write(f"**Cambio:** {cambio['estado_anterior']} → {cambio['estado_nuevo']}")
@@ -4059,17 +5597,17 @@ def page_agreements():
                         agr.setdefault("approval_flow", []).append(cambio)
                         agr["estado"] = nuevo_estado
                         
-                        # Crear versión si el cambio es significativo
-                        if nuevo_estado in ["Aprobado", "Rechazado"]:
+                        # Crear versión si el cambio es significativo (incluye cada envío a revisión)
+                        if nuevo_estado in ["Aprobado", "Rechazado", *ESTADOS_REVISION]:
                             version = crear_version_acuerdo(
                                 agr,
                                 st.session_state.user["username"],
                                 f"Cambio de estado a {nuevo_estado}",
                                 {"estado": f"{estado_actual} → {nuevo_estado}"}
                             )
-                            agr.setdefault("versions", []).append(version)
+                            registrar_version_acuerdo(agr, version)
                             
-                        agreements_save(db)
+                        agreements_save(db, [agr["id"]])
                         audit_log("cambio_estado", {
                             "acuerdo": agr["id"],
                             "de": estado_actual,
@@ -4095,9 +5633,8 @@ def page_agreements():
                             st.session_state.user["username"],
                             motivo_version
                         )
-                        agr.setdefault("versions", []).append(version)
-                        agr["current_version"] = len(agr["versions"]) - 1
-                        agreements_save(db)
+                        version = registrar_version_acuerdo(agr, version)
+                        agreements_save(db, [agr["id"]])
                         audit_log("crear_version", {
                             "acuerdo": agr["id"],
                             "version": version["version_id"],
@@ -4108,11 +5645,29 @@ def page_agreements():
                     else:
                         st.error("Debe especificar un motivo")
                         
-            # Listar versiones existentes
-            if agr.get("versions"):
+            # Listar versiones existentes (metadatos del almacén de versiones)
+            versiones = obtener_almacen_versiones().listar(agr["id"])
+            
+            # 🆕 En revisión: qué cambió entre el envío anterior y el actual
+            if agr.get("estado") in ESTADOS_REVISION:
+                envios = [v for v in versiones if v.get("estado_nuevo") in ESTADOS_REVISION]
+                st.markdown("---")
+                st.subheader("🔎 Cambios entre Envíos a Revisión")
+                if len(envios) >= 2:
+                    previo, ultimo = envios[-2], envios[-1]
+                    st.caption(f"Versión {previo['version_id']} ({previo['timestamp'][:10]}, {previo.get('estado_nuevo')}) → "
+                               f"versión {ultimo['version_id']} ({ultimo['timestamp'][:10]}, {ultimo.get('estado_nuevo')})")
+                    mostrar_diferencias(diferencia_versiones(agr["id"], previo["version_number"], ultimo["version_number"]),
+                                        f"envios_{agr['id']}")
+                elif envios:
+                    st.info("Es el primer envío a revisión: no hay un envío anterior para comparar")
+                else:
+                    st.info("No hay versiones registradas de los envíos a revisión")
+            
+            if versiones:
                 st.markdown("---")
                 st.subheader("📚 Historial de Versiones")
-                for version in reversed(agr["versions"]):
+                for version in reversed(versiones):
                     with st.expander(f"Versión {version['version_id']} - {version['timestamp'][:10]}", expanded=False):
                         col_ver_info1, col_ver_info2 = st.columns(2)
                         with col_ver_info1:
@@ -4122,11 +5677,20 @@ def page_agreements():
                         with col_ver_info2:
                             st.write(f"**Fecha:** {version['timestamp'][:19]}")
                             st.write(f"**N°:** {version['version_number']}")
+                        if version.get("cambios_detectados"):
+                            st.caption(" · ".join(f"{k}: {v}" for k, v in version["cambios_detectados"].items()))
                             
+                        # El contenido se reconstruye solo cuando se pide
+                        if st.button("📄 Ver contenido", key=f"ver_version_{agr['id']}_{version['version_id']}"):
+                            st.json(obtener_almacen_versiones().reconstruir(agr["id"], version["version_number"]))
+                        
                         # Botón para comparar con actual
                         if st.button("🔍 Comparar con actual", key=f"compare_{version['version_id']}"):
-                            st.session_state.version_comparar = version
-                            st.info("Función de comparación en desarrollo")
+                            st.session_state.version_comparar = (agr["id"], version["version_id"])
+                        if st.session_state.get("version_comparar") == (agr["id"], version["version_id"]):
+                            mostrar_diferencias(
+                                diferencia_con_actual(agr["id"], version["version_number"], digest_acuerdo(agr), agr),
+                                f"actual_{agr['id']}_{version['version_id']}")
                             
                         # Botón para restaurar (solo admin)
                         if rol_usuario == "Administrador":
@@ -4137,15 +5701,14 @@ def page_agreements():
                                     
             st.markdown("---")
             st.markdown("Historial de versiones y aprobaciones")
-            if agr.get("versions"):
-                info = [{"número": v.get("version_number", i+1), "fecha": v.get("version_ts",""), "usuario": v.get("version_by",""), "motivo": v.get("version_motivo","")} for i,v in enumerate(agr.get("versions"))]
+            if versiones:
+                info = [{"número": v.get("version_number", i+1), "fecha": v.get("timestamp", v.get("version_ts","")), "usuario": v.get("usuario", v.get("version_by","")), "motivo": v.get("motivo", v.get("version_motivo",""))} for i,v in enumerate(versiones)]
                 st.dataframe(info)
-            if agr.get("approval_flow"):
-                st.markdown("Registro de acciones de aprobación")
-                st.json(agr.get("approval_flow"))
+            if st.checkbox("Ver registro de acciones de aprobación", key=f"ver_registro_aprobacion_{agr['id']}"):
+                st.json(obtener_almacen_historial().aprobaciones(agr["id"]) + agr.get("approval_flow", []))
                 
             if st.button("📄 Generar reporte completo (JSON + CSV)"):
-                json_data = json.dumps(agr, ensure_ascii=False, indent=2).encode("utf-8")
+                json_data = json.dumps(obtener_almacen_historial().completar(agr), ensure_ascii=False, indent=2).encode("utf-8")
                 csv_h = export_csv_horizontal_agreement(agr).encode("utf-8")
                 mem = io.BytesIO()
                 with zipfile.ZipFile(mem, mode="w") as z:
@@ -4158,17 +5721,20 @@ def page_agreements():
         st.markdown("---")
         st.subheader("📊 Opciones de Impresión y Exportación")
         
-        # Generar el contenido HTML una sola vez
-        html_content = exportar_html_imprimible(agr)
+        # Generar el contenido HTML una sola vez (cacheado mientras el acuerdo no cambie)
+        html_bytes = html_imprimible_cacheado(agr)
+        html_content = html_bytes.decode('utf-8')
         col_imp1, col_imp2, col_imp3 = st.columns([1, 1, 1])
         
         with col_imp1:
             st.download_button(
                 "💾 Descargar HTML",
-                data=html_content.encode('utf-8'),
+                data=html_bytes,
                 file_name=f"{agr['id']}.html",
                 mime="text/html"
             )
+            # 🆕 El PDF se renderiza (o se lee de la caché) solo cuando se prepara
+            boton_descarga_pdf_acuerdo(agr)
         with col_imp2:
             if st.button("👁️ Vista Previa"):
                 st.components.v1.html(html_content, height=600, scrolling=True)
@@ -4176,42 +5742,342 @@ def page_agreements():
             if st.button("🖨️ Imprimir"):
                 st.download_button(
                     "📄 Descargar para Imprimir",
-                    data=html_content.encode('utf-8'),
+                    data=html_bytes,
                     file_name=f"{agr['id']}_imprimir.html",
                     mime="text/html"
                 )
         st.info("💡 Descargue el HTML y ábralo en su navegador. Use Ctrl+P para imprimir.")
 
-def detectar_y_importar_csv(upl_bytes: bytes, agr: Dict[str, Any]) -> int:
+# ==================== VALIDACIÓN PREVIA DE IMPORTACIÓN (DRY RUN) ====================
+
+# 🆕 COLUMNAS DEL FORMATO DE IMPORTACIÓN (las que lee importar_csv_en_acuerdo)
+COL_IMP_FICHA_ID = "ficha_id(blank_new)"
+COL_IMP_FICHA_NOMBRE = "ficha_nombre"
+COL_IMP_DESCRIPCION = "descripcion"
+COL_IMP_VALOR_OBJETIVO = "valor_objetivo"
+COL_IMP_PONDERACION = "ponderacion(%)"
+COL_IMP_SENTIDO = "sentido[>=|<=|==]"
+COL_IMP_FRECUENCIA = "frecuencia[Mensual|Trimestral|Semestral|Anual]"
+COL_IMP_VENCIMIENTO = "vencimiento(YYYY-MM-DD)"
+COL_IMP_RANGO = "rango(min1|max1|pct1;min2|max2|pct2;...)"
+COL_IMP_ES_HITO = "es_hito[SI/NO]"
+
+SENTIDOS_VALIDOS = [">=", "<=", "=="]
+FRECUENCIAS_VALIDAS = ["Mensual", "Trimestral", "Semestral", "Anual"]
+VALORES_SI_NO = ["si", "sí", "no", "true", "false", "1", "0", "yes"]
+COLUMNAS_REPORTE_ERRORES = ["fila", "columna", "valor", "severidad", "mensaje"]
+
+# 🆕 EQUIVALENCIAS DEL CSV HORIZONTAL (ENCABEZADOS_CSV_HORIZONTAL) → FORMATO DE IMPORTACIÓN
+MAPEO_HORIZONTAL_IMPORTACION = {
+    "id_ficha": COL_IMP_FICHA_ID,
+    "nombre_ficha": COL_IMP_FICHA_NOMBRE,
+    "tipo_meta": "ficha_tipo_meta[Institucional|Grupal/Sectorial|Individual]",
+    "responsables_cumplimiento": "responsables_cumpl",
+    "objetivo_estrategico": "objetivo",
+    "indicador_principal": "indicador(*)",
+    "metodologia_calculo": "forma_calculo",
+    "fuente_informacion": "fuente(*)",
+    "valor_linea_base": "valor_base",
+    "responsables_seguimiento": "resp_seguimiento",
+    "observaciones_ficha": "ficha_observaciones",
+    "requiere_salvaguarda": "salvaguarda[SI/NO]",
+    "id_meta": "meta_id(blank_new)",
+    "descripcion_meta": COL_IMP_DESCRIPCION,
+    "unidad_medida": "unidad",
+    "valor_objetivo": COL_IMP_VALOR_OBJETIVO,
+    "sentido_cumplimiento": COL_IMP_SENTIDO,
+    "frecuencia_medicion": COL_IMP_FRECUENCIA,
+    "fecha_vencimiento": COL_IMP_VENCIMIENTO,
+    "es_hito_critico": COL_IMP_ES_HITO,
+    "ponderacion_porcentual": COL_IMP_PONDERACION,
+    "valor_alcanzado": "cumplimiento_valor",
+    "observaciones_meta": "meta_observaciones",
+}
+
+# Textos de relleno que escribe _fila_csv_horizontal cuando el dato está vacío
+VALORES_RELLENO_HORIZONTAL = [
+    "N/D", "No definido", "No definida", "No establecido", "No asignado",
+    "No especificado", "Sin nombre", "Sin descripción", "Sin observaciones",
+    "No aplica", "No calculado", "[Sin definir]"
+]
+
+PATRON_TRAMO_RANGO = r"^(-?\d+(?:[.,]\d+)?)?\s*\|\s*(-?\d+(?:[.,]\d+)?)?\s*\|\s*-?\d+(?:[.,]\d+)?$"
+
+def _decodificar_csv(upl_bytes: bytes) -> str:
+    """Decodifica el CSV subido probando utf-8 y latin-1"""
+    try:
+        return upl_bytes.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        try:
+            return upl_bytes.decode("latin-1")
+        except UnicodeDecodeError:
+            return upl_bytes.decode("utf-8", errors="replace")
+
+def _numerico_vectorizado(serie: pd.Series) -> pd.Series:
+    """Convierte una columna de texto a número (acepta coma decimal); lo inválido queda NaN"""
+    return pd.to_numeric(serie.str.strip().str.replace(",", ".", regex=False), errors="coerce")
+
+def periodo_label_vectorizado(vencimientos: pd.Series, frecuencias: pd.Series) -> pd.Series:
+    """Versión por columnas de periodo_label: ENE-2024 / T1-2024 / S1-2024 / ANUAL-2024"""
+    fechas = pd.to_datetime(vencimientos, format="%Y-%m-%d", errors="coerce")
+    fechas = fechas.fillna(pd.Timestamp(date.today()))
+    anio = fechas.dt.year.astype(str)
+    mes = fechas.dt.month
+    meses = {1: "ENE", 2: "FEB", 3: "MAR", 4: "ABR", 5: "MAY", 6: "JUN",
+             7: "JUL", 8: "AGO", 9: "SEP", 10: "OCT", 11: "NOV", 12: "DIC"}
+    
+    etiquetas = "ANUAL-" + anio
+    etiquetas = etiquetas.mask(frecuencias == "Semestral", "S" + ((mes - 1) // 6 + 1).astype(str) + "-" + anio)
+    etiquetas = etiquetas.mask(frecuencias == "Trimestral", "T" + ((mes - 1) // 3 + 1).astype(str) + "-" + anio)
+    etiquetas = etiquetas.mask(frecuencias == "Mensual", mes.map(meses) + "-" + anio)
+    return etiquetas
+
+def _normalizar_csv_horizontal(df: pd.DataFrame) -> pd.DataFrame:
+    """Traduce un CSV en formato horizontal (exportación/plantilla) a las columnas de importación"""
+    df = df.replace(VALORES_RELLENO_HORIZONTAL, "")
+    
+    # Rangos: "[min - max]" + "pct%" → "min|max|pct;..."
+    tramos = []
+    for i in range(1, 6):
+        col_int, col_pct = f"rango_{i}_intervalo", f"rango_{i}_porcentaje"
+        if col_int not in df.columns or col_pct not in df.columns:
+            continue
+        limites = df[col_int].str.extract(r"^\[\s*(.*?)\s+(?:-|→|←)\s+(.*?)\s*\]$").fillna("")
+        limites = limites.replace("∞", "")
+        pct = df[col_pct].str.strip().str.rstrip("%")
+        tramo = (limites[0] + "|" + limites[1] + "|" + pct).where(pct != "", "")
+        tramos.append(tramo)
+    rango = pd.Series("", index=df.index)
+    for tramo in tramos:
+        rango = (rango + ";" + tramo).where(tramo != "", rango)
+    
+    df = df.rename(columns=MAPEO_HORIZONTAL_IMPORTACION)
+    df[COL_IMP_RANGO] = rango.str.lstrip(";")
+    
+    # Fechas dd/mm/YYYY → YYYY-MM-DD (lo no reconocido se deja tal cual para reportarlo)
+    if COL_IMP_VENCIMIENTO in df.columns:
+        fechas = pd.to_datetime(df[COL_IMP_VENCIMIENTO], format="%d/%m/%Y", errors="coerce")
+        df[COL_IMP_VENCIMIENTO] = fechas.dt.strftime("%Y-%m-%d").where(fechas.notna(), df[COL_IMP_VENCIMIENTO])
+    if COL_IMP_PONDERACION in df.columns:
+        df[COL_IMP_PONDERACION] = df[COL_IMP_PONDERACION].str.strip().str.rstrip("%")
+    return df
+
+def _lineas_registros_csv(texto: str) -> List[int]:
+    """
+    Línea del archivo (desde 1) en la que empieza cada registro de datos del CSV.
+    
+    Omite, igual que read_csv, las líneas vacías o solo con espacios; un campo entre
+    comillas con saltos de línea ocupa varias líneas pero es un solo registro.
+    """
+    lector = csv.reader(io.StringIO(texto))
+    lineas = []
+    inicio = 1
+    for registro in lector:
+        if registro and not (len(registro) == 1 and not registro[0].strip()):
+            lineas.append(inicio)
+        inicio = lector.line_num + 1
+    return lineas[1:]  # el primer registro es el encabezado
+
+def _numerar_filas(df: pd.DataFrame, texto: Optional[str] = None) -> pd.DataFrame:
+    """
+    Pone como índice el número de fila del archivo, que es lo que muestra el reporte
+    de validación. Con `texto` (CSV) es la línea donde empieza cada registro; sin él
+    (Excel) la fila de la hoja, con el encabezado en la fila 1.
+    """
+    lineas = _lineas_registros_csv(texto) if texto is not None else []
+    if len(lineas) != len(df):  # Excel, o un CSV que csv y pandas no separan igual
+        lineas = range(2, len(df) + 2)
+    df.index = pd.Index(lineas)
+    return df
+
+def _errores_por_mascara(df: pd.DataFrame, mascara: pd.Series, columna: str,
+                         severidad: str, mensaje: str) -> pd.DataFrame:
+    """Arma las filas del reporte para las filas del archivo marcadas por la máscara (índice de _numerar_filas)"""
+    marcadas = df.loc[mascara]
+    return pd.DataFrame({
+        "fila": marcadas.index,
+        "columna": columna,
+        "valor": marcadas[columna] if columna in df.columns else "",
+        "severidad": severidad,
+        "mensaje": mensaje,
+    }, columns=COLUMNAS_REPORTE_ERRORES)
+
+def validar_importacion_csv(upl_bytes: bytes) -> tuple:
+    """
+    Dry run de la importación: carga el CSV en un DataFrame y lo valida por columnas,
+    sin tocar ningún acuerdo.
+    
+    Args:
+        upl_bytes: Bytes del archivo CSV (formato de importación u horizontal)
+        
+    Returns:
+        tuple: (DataFrame normalizado listo para importar, DataFrame de errores con
+               columnas fila/columna/valor/severidad/mensaje). Solo las filas con
+               severidad "error" bloquean la importación.
+    """
+    texto = _decodificar_csv(upl_bytes)
+    df = pd.read_csv(io.StringIO(texto), dtype=str, keep_default_na=False, skipinitialspace=True)
+    df = _numerar_filas(df, texto)
+    df.columns = [str(c).strip() for c in df.columns]
+    df = df.apply(lambda col: col.str.strip())
+    
+    if "descripcion_meta" in df.columns and "nombre_ficha" in df.columns:
+        df = _normalizar_csv_horizontal(df)
+    
+    errores: List[pd.DataFrame] = []
+    
+    # 1. Columnas obligatorias
+    faltantes = [c for c in (COL_IMP_DESCRIPCION, COL_IMP_VALOR_OBJETIVO) if c not in df.columns]
+    if COL_IMP_FICHA_ID not in df.columns and COL_IMP_FICHA_NOMBRE not in df.columns:
+        faltantes.append(f"{COL_IMP_FICHA_ID} / {COL_IMP_FICHA_NOMBRE}")
+    if faltantes:
+        reporte = pd.DataFrame([
+            {"fila": 1, "columna": c, "valor": "", "severidad": "error",
+             "mensaje": "Falta la columna obligatoria en el encabezado"}
+            for c in faltantes
+        ], columns=COLUMNAS_REPORTE_ERRORES)
+        return df, reporte
+    
+    for col in (COL_IMP_FICHA_ID, COL_IMP_FICHA_NOMBRE):
+        if col not in df.columns:
+            df[col] = ""
+    
+    # 2. Campos obligatorios
+    errores.append(_errores_por_mascara(df, (df[COL_IMP_FICHA_ID] == "") & (df[COL_IMP_FICHA_NOMBRE] == ""),
+                                        COL_IMP_FICHA_NOMBRE, "error", "La fila no identifica la ficha (id o nombre)"))
+    errores.append(_errores_por_mascara(df, df[COL_IMP_DESCRIPCION] == "", COL_IMP_DESCRIPCION,
+                                        "error", "La descripción de la meta es obligatoria"))
+    errores.append(_errores_por_mascara(df, df[COL_IMP_VALOR_OBJETIVO] == "", COL_IMP_VALOR_OBJETIVO,
+                                        "error", "El valor objetivo es obligatorio"))
+    
+    # 3. Numéricos
+    objetivo = _numerico_vectorizado(df[COL_IMP_VALOR_OBJETIVO])
+    errores.append(_errores_por_mascara(df, (df[COL_IMP_VALOR_OBJETIVO] != "") & objetivo.isna(),
+                                        COL_IMP_VALOR_OBJETIVO, "error", "El valor objetivo no es numérico"))
+    if COL_IMP_PONDERACION in df.columns:
+        ponderacion = _numerico_vectorizado(df[COL_IMP_PONDERACION])
+        errores.append(_errores_por_mascara(df, (df[COL_IMP_PONDERACION] != "") & ponderacion.isna(),
+                                            COL_IMP_PONDERACION, "error", "La ponderación no es numérica"))
+        errores.append(_errores_por_mascara(df, (ponderacion < 0) | (ponderacion > 100),
+                                            COL_IMP_PONDERACION, "error", "La ponderación debe estar entre 0 y 100"))
+        errores.append(_errores_por_mascara(df, df[COL_IMP_PONDERACION] == "", COL_IMP_PONDERACION,
+                                            "advertencia", "Ponderación vacía: se importará como 0%"))
+    else:
+        ponderacion = pd.Series(0.0, index=df.index)
+    
+    # 4. Vocabularios cerrados
+    if COL_IMP_SENTIDO in df.columns:
+        errores.append(_errores_por_mascara(df, ~df[COL_IMP_SENTIDO].isin(SENTIDOS_VALIDOS), COL_IMP_SENTIDO,
+                                            "error", "Sentido inválido (use >=, <= o ==)"))
+    if COL_IMP_FRECUENCIA in df.columns:
+        errores.append(_errores_por_mascara(df, ~df[COL_IMP_FRECUENCIA].isin(FRECUENCIAS_VALIDAS), COL_IMP_FRECUENCIA,
+                                            "error", "Frecuencia inválida (Mensual, Trimestral, Semestral o Anual)"))
+    if COL_IMP_ES_HITO in df.columns:
+        errores.append(_errores_por_mascara(df, (df[COL_IMP_ES_HITO] != "") & ~df[COL_IMP_ES_HITO].str.lower().isin(VALORES_SI_NO),
+                                            COL_IMP_ES_HITO, "advertencia", "Valor no reconocido: se importará como NO"))
+    
+    # 5. Fechas
+    if COL_IMP_VENCIMIENTO in df.columns:
+        fechas = pd.to_datetime(df[COL_IMP_VENCIMIENTO], format="%Y-%m-%d", errors="coerce")
+        errores.append(_errores_por_mascara(df, (df[COL_IMP_VENCIMIENTO] != "") & fechas.isna(), COL_IMP_VENCIMIENTO,
+                                            "error", "Fecha inválida (formato YYYY-MM-DD)"))
+        errores.append(_errores_por_mascara(df, df[COL_IMP_VENCIMIENTO] == "", COL_IMP_VENCIMIENTO,
+                                            "advertencia", "Sin vencimiento: el período se calculará con la fecha actual"))
+    
+    # 6. Sintaxis de rangos min|max|pct;...
+    if COL_IMP_RANGO in df.columns:
+        tramos = df[COL_IMP_RANGO].str.split(";").explode().str.strip()
+        tramos = tramos[tramos != ""]
+        filas_malas = tramos[~tramos.str.match(PATRON_TRAMO_RANGO)].index.unique()
+        errores.append(_errores_por_mascara(df, df.index.isin(filas_malas), COL_IMP_RANGO,
+                                            "error", "Rango mal formado (use min|max|pct;min|max|pct...)"))
+    
+    # 7. Suma de ponderaciones por ficha y período
+    if COL_IMP_PONDERACION in df.columns:
+        ficha_clave = df[COL_IMP_FICHA_ID].where(df[COL_IMP_FICHA_ID] != "", df[COL_IMP_FICHA_NOMBRE].str.lower())
+        periodos = periodo_label_vectorizado(
+            df[COL_IMP_VENCIMIENTO] if COL_IMP_VENCIMIENTO in df.columns else pd.Series("", index=df.index),
+            df[COL_IMP_FRECUENCIA] if COL_IMP_FRECUENCIA in df.columns else pd.Series("Anual", index=df.index),
+        )
+        grupos = pd.DataFrame({
+            "ficha": ficha_clave, "periodo": periodos,
+            "ponderacion": ponderacion.fillna(0.0), "fila": df.index,
+        })
+        grupos = grupos[grupos["ficha"] != ""].groupby(["ficha", "periodo"]).agg(suma=("ponderacion", "sum"), filas=("fila", list))
+        descuadrados = grupos[(grupos["suma"] - 100.0).abs() > 1e-6].reset_index()
+        if not descuadrados.empty:
+            errores.append(pd.DataFrame({
+                "fila": descuadrados["filas"].str[0],
+                "columna": COL_IMP_PONDERACION,
+                "valor": descuadrados["suma"].round(2).astype(str) + "%",
+                "severidad": "advertencia",
+                "mensaje": ("Ficha '" + descuadrados["ficha"] + "', período " + descuadrados["periodo"]
+                            + ": las ponderaciones suman " + descuadrados["suma"].round(2).astype(str)
+                            + "% (debe sumar 100%). Filas: "
+                            + descuadrados["filas"].map(lambda fs: ", ".join(map(str, fs)))),
+            }, columns=COLUMNAS_REPORTE_ERRORES))
+    
+    reporte = pd.concat([e for e in errores if not e.empty] or [pd.DataFrame(columns=COLUMNAS_REPORTE_ERRORES)],
+                        ignore_index=True)
+    reporte = reporte.sort_values(["fila", "severidad"], ascending=[True, False], kind="stable").reset_index(drop=True)
+    
+    # Normalizar decimales para que importar_csv_en_acuerdo pueda convertirlos con float()
+    df[COL_IMP_VALOR_OBJETIVO] = df[COL_IMP_VALOR_OBJETIVO].str.replace(",", ".", regex=False)
+    if COL_IMP_PONDERACION in df.columns:
+        df[COL_IMP_PONDERACION] = df[COL_IMP_PONDERACION].str.replace(",", ".", regex=False)
+    return df, reporte
+
+def mostrar_reporte_validacion(reporte: pd.DataFrame, clave: str):
+    """Muestra el reporte del dry run con opción de descarga"""
+    n_errores = int((reporte["severidad"] == "error").sum())
+    n_advertencias = int((reporte["severidad"] == "advertencia").sum())
+    
+    if n_errores:
+        st.error(f"❌ Validación fallida: {n_errores} error(es), {n_advertencias} advertencia(s). No se importó nada.")
+    elif n_advertencias:
+        st.warning(f"⚠️ Validación con {n_advertencias} advertencia(s)")
+    else:
+        st.success("✅ Validación correcta: el archivo puede importarse")
+        return
+    
+    st.dataframe(reporte, use_container_width=True, hide_index=True)
+    st.download_button(
+        "⬇️ Descargar reporte de validación (CSV)",
+        data=reporte.to_csv(index=False).encode("utf-8-sig"),
+        file_name=f"validacion_importacion_{clave}.csv",
+        mime="text/csv",
+        key=f"descargar_validacion_{clave}"
+    )
+
+def detectar_y_importar_csv(upl_bytes: bytes, agr: Dict[str, Any], solo_validar: bool = False) -> int:
     """
     Detecta y importa datos desde CSV - VERSIÓN MEJORADA
     
     Args:
         upl_bytes: Bytes del archivo CSV
         agr: Acuerdo donde importar los datos
+        solo_validar: Si es True solo ejecuta el dry run y muestra el reporte
         
     Returns:
         int: Número de registros importados
     """
     try:
-        # 🆕 DETECCIÓN MEJORADA DE CODIFICACIÓN
-        try:
-            s = upl_bytes.decode("utf-8")
-        except UnicodeDecodeError:
-            try:
-                s = upl_bytes.decode("latin-1")
-            except UnicodeDecodeError:
-                s = upl_bytes.decode("utf-8", errors="replace")
-        
         # 🆕 VERIFICAR SI EL CSV TIENE DATOS
-        lines = s.strip().split('\n')
+        lines = _decodificar_csv(upl_bytes).strip().split('\n')
         if len(lines) <= 1:
             st.warning("El archivo CSV está vacío o solo tiene encabezados")
             return 0
+        
+        # 🆕 DRY RUN: VALIDAR TODO EL ARCHIVO ANTES DE ESCRIBIR NADA
+        df, reporte = validar_importacion_csv(upl_bytes)
+        hay_errores = bool((reporte["severidad"] == "error").any())
+        if solo_validar or not reporte.empty:
+            mostrar_reporte_validacion(reporte, f"{agr['id']}_{hashlib.md5(upl_bytes).hexdigest()[:8]}")
+        if hay_errores or solo_validar:
+            return 0
             
         # 🆕 PROCESAR CSV
-        reader = csv.DictReader(io.StringIO(s))
-        imported = importar_csv_en_acuerdo(reader, agr)
+        imported = importar_csv_en_acuerdo(df.to_dict("records"), agr)
         
         if imported == 0:
             st.warning("No se pudieron importar registros. Verifique el formato del CSV.")
@@ -4221,10 +6087,15 @@ def detectar_y_importar_csv(upl_bytes: bytes, agr: Dict[str, Any]) -> int:
     except Exception as e:
         st.error(f"❌ Error procesando CSV: {str(e)}")
         # 🆕 INFORMACIÓN ADICIONAL PARA DEBUG
-        st.info("💡 Formato esperado: CSV con encabezados compatibles con export_csv_horizontal_agreement")
+        st.info("💡 Formato esperado: CSV de importación o CSV horizontal (export_csv_horizontal_agreement)")
         return 0
 
-def importar_csv_en_acuerdo(reader: csv.DictReader, agr: Dict[str,Any]) -> int:
+def importar_csv_en_acuerdo(reader: Iterable[Dict[str, Any]], agr: Dict[str,Any]) -> int:
+    # 🆕 TRABAJAR SOBRE UNA COPIA: SI UNA FILA FALLA, EL ACUERDO ORIGINAL QUEDA INTACTO
+    import copy
+    destino = agr
+    agr = copy.deepcopy(agr)
+    
     fichas_by_id = {f["id"]: f for f in agr.get("fichas",[])}
     fichas_by_name = { (f.get("nombre","") or "").lower(): f for f in agr.get("fichas",[])}
     count = 0
@@ -4311,7 +6182,9 @@ def importar_csv_en_acuerdo(reader: csv.DictReader, agr: Dict[str,Any]) -> int:
                 "observaciones": row.get("meta_observaciones", meta.get("observaciones",""))
             })
             count += 1
-            
+    
+    destino.clear()
+    destino.update(agr)
     return count
 
 def page_reportes():
@@ -4346,7 +6219,7 @@ def page_reportes():
     st.header("📊 Informes y Reportes")
     
     db = agreements_load()
-    if not db:
+    if not db and not obtener_almacen_archivo().años():
         st.info("No hay acuerdos para generar reportes.")
         return
 
@@ -4356,7 +6229,7 @@ def page_reportes():
         
         with col_config1:
             # Filtros para el informe
-            years = sorted({a.get("año", date.today().year) for a in db.values()})
+            years = años_con_acuerdos(db)
             selected_year = st.selectbox("Año del informe", options=years, index=len(years)-1, key="report_year")
             
             organismo_filter = st.text_input("Filtrar por Organismo (contiene)", key="report_org")
@@ -4381,7 +6254,7 @@ def page_reportes():
         
         # 🆕 BOTÓN PARA CREAR INFORME
         if st.button("📈 Generar Informe Personalizado", type="primary", key="generate_custom_report"):
-            generar_informe_personalizado(db, selected_year, organismo_filter, tipos_seleccionados, 
+            generar_informe_personalizado(acuerdos_del_año(db, selected_year), selected_year, organismo_filter, tipos_seleccionados, 
                                         formato_reporte, incluir_metricas, incluir_detalles)
 
     st.markdown("---")
@@ -4392,7 +6265,7 @@ def page_reportes():
     col_filtros1, col_filtros2 = st.columns(2)
     
     with col_filtros1:
-        years = sorted({a.get("año", date.today().year) for a in db.values()})
+        years = años_con_acuerdos(db)
         selected_year = st.selectbox("Año", options=years, index=len(years)-1, key="year_filter")
     
     with col_filtros2:
@@ -4405,9 +6278,9 @@ def page_reportes():
         key="type_filter"
     )
     
-    # Filtrar acuerdos
+    # Filtrar acuerdos (los archivados del año se leen de su partición)
     acuerdos_filtrados = []
-    for agr in db.values():
+    for agr in acuerdos_del_año(db, selected_year).values():
         if agr.get("año") != selected_year:
             continue
         if agr.get("tipo_compromiso") not in tipos_seleccionados:
@@ -4436,15 +6309,68 @@ def page_reportes():
             mostrar_vista_imprimible(acuerdos_filtrados, selected_year)
     
     with col_acciones4:
+        incluir_adjuntos = st.checkbox("📎 Incluir adjuntos", key="export_all_adjuntos",
+                                       help="Agrega al ZIP los archivos adjuntos de cada acuerdo")
         if st.button("📥 Exportar Todo", key="export_all"):
-            exportar_reportes_completos(acuerdos_filtrados, selected_year)
-    
+            exportar_reportes_completos(acuerdos_filtrados, selected_year, incluir_adjuntos)
+
+    # 🆕 EXPORTACIÓN CSV DEL AÑO EN FORMATO HORIZONTAL (REIMPORTABLE)
+    if st.button("🧾 Exportar CSV Horizontal del Año", key="export_csv_year"):
+        with st.spinner("Exportando metas a CSV..."):
+            ruta_csv = exportar_csv_horizontal_streaming(acuerdos_filtrados)
+            try:
+                with open(ruta_csv, "rb") as f:
+                    st.download_button(
+                        "⬇️ Descargar CSV Horizontal",
+                        data=f,
+                        file_name=f"metas_horizontal_{selected_year}.csv",
+                        mime="text/csv",
+                        key="dl_csv_year"
+                    )
+            finally:
+                os.remove(ruta_csv)
+
+    # 🆕 LOTE DE PDF (UNO POR ACUERDO) PARA EL PAQUETE DE FIRMAS DEL AÑO
+    if st.button("📚 Generar PDF por Acuerdo (ZIP)", key="export_lote_pdf"):
+        encolar_reporte("lote_pdf_acuerdos", {"año": selected_year}, acuerdos_filtrados)
+
+    # 🆕 EXPORTACIÓN COLUMNAR PARA ANÁLISIS (NOTEBOOKS / BI)
+    col_columnar1, col_columnar2 = st.columns([2, 1])
+    with col_columnar1:
+        formato_columnar = st.selectbox("Formato columnar", options=list(FORMATOS_COLUMNARES.keys()), key="formato_columnar")
+    with col_columnar2:
+        exportar_columnar = st.button("🗃️ Exportar Dataset Columnar", key="export_columnar")
+    if exportar_columnar:
+        with st.spinner("Escribiendo dataset columnar..."):
+            try:
+                carpeta = exportar_tabla_columnar(acuerdos_filtrados, formato=formato_columnar)
+            except ImportError:
+                st.error("❌ La exportación columnar requiere la librería pyarrow (pip install pyarrow)")
+            else:
+                ruta_zip = empaquetar_carpeta_zip(carpeta)
+                shutil.rmtree(carpeta, ignore_errors=True)
+                try:
+                    with open(ruta_zip, "rb") as f:
+                        st.download_button(
+                            "⬇️ Descargar Dataset (ZIP)",
+                            data=f,
+                            file_name=f"metas_{FORMATOS_COLUMNARES[formato_columnar]['formato']}_{selected_year}.zip",
+                            mime="application/zip",
+                            key="dl_columnar"
+                        )
+                finally:
+                    os.remove(ruta_zip)
+
+    # 🆕 REPORTES GENERADOS EN SEGUNDO PLANO
+    mostrar_panel_trabajos_reportes()
+
     # 🆕 SECCIÓN DE MÉTRICAS DE CUMPLIMIENTO MEJORADA
     if acuerdos_filtrados:
         st.subheader("📈 Métricas de Cumplimiento")
     
-        # Calcular métricas generales
-        metricas_totales = calcular_metricas_globales(acuerdos_filtrados)
+        # Calcular métricas generales (corte del cubo con los mismos filtros)
+        filtros_metricas = filtros_cubo(selected_year, tipos_seleccionados, organismo_filter)
+        metricas_totales = obtener_cubo_cumplimiento().metricas(filtros_metricas)
     
         # 🆕 MÉTRICAS MEJORADAS CON BARRAS DE PROGRESO
         col_metric1, col_metric2, col_metric3, col_metric4 = st.columns(4)
@@ -4513,6 +6439,12 @@ def page_reportes():
                 st.write(f"✅ **Cumplidas:** {metricas_totales['metas_cumplidas']} ({metricas_totales['porcentaje_cumplidas']:.1f}%)")
                 st.write(f"🟡 **Parciales:** {metricas_totales['metas_parciales']} ({metricas_totales['porcentaje_parciales']:.1f}%)")
                 st.write(f"🔴 **No Cumplidas:** {metricas_totales['metas_no_cumplidas']} ({metricas_totales['porcentaje_no_cumplidas']:.1f}%)")
+                
+                # 🆕 DISTRIBUCIÓN POR PERÍODO DE EVALUACIÓN
+                por_periodo = obtener_cubo_cumplimiento().distribucion("periodo_label", filtros_metricas)
+                if len(por_periodo) > 1:
+                    st.write("**Por período de evaluación:**")
+                    st.bar_chart(por_periodo[["cumplidas", "parciales", "no_cumplidas"]])
         
                 # 🆕 INDICADORES DE ESTADO
                 if metricas_totales['porcentaje_cumplidas'] >= 80:
@@ -4566,63 +6498,1702 @@ def calcular_cumplimiento_acuerdo(agr: Dict[str, Any]) -> Optional[float]:
             if meta.get("cumplimiento_calc") is None:
                 meta["cumplimiento_calc"] = calcular_cumplimiento(meta)
             
-            if meta.get("cumplimiento_calc") is not None:
-                ponderacion = float(meta.get("ponderacion", 0.0))
-                cumplimiento = meta["cumplimiento_calc"]
-                
-                total_ponderacion += ponderacion
-                total_ponderado += cumplimiento * ponderacion
-                metas_con_datos += 1
+            if meta.get("cumplimiento_calc") is not None:
+                ponderacion = float(meta.get("ponderacion", 0.0))
+                cumplimiento = meta["cumplimiento_calc"]
+                
+                total_ponderacion += ponderacion
+                total_ponderado += cumplimiento * ponderacion
+                metas_con_datos += 1
+    
+    if total_ponderacion > 0 and metas_con_datos > 0:
+        return total_ponderado / total_ponderacion
+    return None
+
+def calcular_metricas_globales(acuerdos: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Calcula métricas globales usando rangos configurables por meta"""
+    total_acuerdos = len(acuerdos)
+    total_metas = 0
+    metas_cumplidas = 0
+    metas_parciales = 0
+    metas_no_cumplidas = 0
+    cumplimientos = []
+    
+    if not acuerdos:
+        return {
+            'total_acuerdos': 0,
+            'total_metas': 0,
+            'metas_cumplidas': 0,
+            'metas_parciales': 0,
+            'metas_no_cumplidas': 0,
+            'porcentaje_cumplidas': 0,
+            'porcentaje_parciales': 0,
+            'porcentaje_no_cumplidas': 0,
+            'cumplimiento_promedio': 0
+        }
+    
+    for agr in acuerdos:
+        # Contar metas y clasificar por cumplimiento
+        for ficha in agr.get("fichas", []):
+            for meta in ficha.get("metas", []):
+                total_metas += 1
+                
+                # 🆕 CLASIFICACIÓN FLEXIBLE (REEMPLAZA LOS RANGOS FIJOS)
+                clasificacion = clasificar_cumplimiento_meta(meta, _cumplimiento_meta_efectivo(meta))
+                
+                if clasificacion == "cumplida":
+                    metas_cumplidas += 1
+                elif clasificacion == "parcial":
+                    metas_parciales += 1
+                else:
+                    metas_no_cumplidas += 1
+        
+        # Calcular cumplimiento del acuerdo
+        cumplimiento_acuerdo = calcular_cumplimiento_acuerdo(agr)
+        if cumplimiento_acuerdo is not None:
+            cumplimientos.append(cumplimiento_acuerdo)
+    
+    # 🆕 CÁLCULO SEGURO DEL PROMEDIO
+    cumplimiento_promedio = sum(cumplimientos) / len(cumplimientos) if cumplimientos else 0
+    
+    return {
+        'total_acuerdos': total_acuerdos,
+        'total_metas': total_metas,
+        'metas_cumplidas': metas_cumplidas,
+        'metas_parciales': metas_parciales,
+        'metas_no_cumplidas': metas_no_cumplidas,
+        'porcentaje_cumplidas': (metas_cumplidas / total_metas * 100) if total_metas > 0 else 0,
+        'porcentaje_parciales': (metas_parciales / total_metas * 100) if total_metas > 0 else 0,
+        'porcentaje_no_cumplidas': (metas_no_cumplidas / total_metas * 100) if total_metas > 0 else 0,
+        'cumplimiento_promedio': cumplimiento_promedio
+    }
+
+def construir_reporte_consolidado(acuerdos: List[Dict[str, Any]], año: int) -> Optional[IO[bytes]]:
+    """Construye el Excel consolidado en streaming desde la tabla plana (None si no hay metas)"""
+    filas = obtener_tabla_plana().iterar_filas(agr["id"] for agr in acuerdos)
+    primera = next(filas, None)
+    if primera is None:
+        return None
+    
+    salida = tempfile.SpooledTemporaryFile(max_size=UMBRAL_SPOOL_BYTES, prefix="consolidado_cg_", suffix=".xlsx")
+    escribir_excel_streaming(itertools.chain([primera], filas), COLUMNAS_EXCEL_CONSOLIDADO, salida)
+    salida.seek(0)
+    return salida
+
+def generar_reporte_consolidado(acuerdos: List[Dict[str, Any]], año: int):
+    """Genera un reporte consolidado de todos los acuerdos"""
+    if not acuerdos:
+        st.warning("No hay datos para generar el reporte")
+        return
+    encolar_reporte("consolidado", {"año": año}, acuerdos)
+
+def mostrar_vista_imprimible(acuerdos: List[Dict[str, Any]], año: int):
+    """Muestra una vista optimizada para impresión"""
+    st.info("🔍 **Vista para Imprimir** - Use Ctrl+P en su navegador para imprimir")
+    
+    tabla = obtener_tabla_plana().dataframe(agr["id"] for agr in acuerdos)
+    filas_por_acuerdo = dict(tuple(tabla.groupby("acuerdo_id", sort=False)))
+    
+    for agr in acuerdos:
+        st.markdown("---")
+        st.header(f"ACUERDO: {agr.get('id')}")
+        st.subheader(f"Organismo: {agr.get('organismo_nombre')}")
+        
+        filas = filas_por_acuerdo.get(agr.get("id"))
+        if filas is None:
+            continue
+        
+        cumplimiento = filas["cumplimiento_acuerdo"].iloc[0]
+        if cumplimiento and pd.notna(cumplimiento):
+            st.metric("**Cumplimiento Ponderado Total**", f"{cumplimiento:.1f}%")
+        
+        # Mostrar fichas y metas
+        for (ficha_id, ficha_nombre), metas in filas.groupby(["ficha_id", "ficha_nombre"], sort=False, dropna=False):
+            with st.expander(f"FICHA: {ficha_id} - {ficha_nombre}", expanded=True):
+                for meta in metas.itertuples(index=False):
+                    col_meta1, col_meta2, col_meta3 = st.columns([3, 1, 1])
+                    with col_meta1:
+                        st.write(f"**Meta {meta.meta_numero}:** {meta.meta_descripcion}")
+                    with col_meta2:
+                        st.write(f"Ponderación: {meta.ponderacion}%")
+                    with col_meta3:
+                        cumplimiento_meta = meta.cumplimiento_meta if pd.notna(meta.cumplimiento_meta) else 'No calc.'
+                        st.write(f"Cumplimiento: {cumplimiento_meta}%")
+
+def calcular_todos_los_cumplimientos(acuerdos: List[Dict[str, Any]]):
+    """Calcula los cumplimientos de todas las metas"""
+    with st.spinner("Calculando cumplimientos..."):
+        total_calculadas = 0
+        for agr in acuerdos:
+            for ficha in agr.get("fichas", []):
+                for meta in ficha.get("metas", []):
+                    if meta.get("cumplimiento_valor"):
+                        meta["cumplimiento_calc"] = calcular_cumplimiento(meta)
+                        if meta["cumplimiento_calc"] is not None:
+                            total_calculadas += 1
+        
+        st.success(f"✅ Se calcularon {total_calculadas} cumplimientos")
+
+def generar_informe_personalizado(db, año, organismo_filter, tipos_seleccionados, formato, incluir_metricas, incluir_detalles):
+    """Genera un informe personalizado según los filtros especificados"""
+    with st.spinner("Generando informe personalizado..."):
+        # Filtrar acuerdos
+        acuerdos_filtrados = []
+        for agr in db.values():
+            if agr.get("año") != año:
+                continue
+            if agr.get("tipo_compromiso") not in tipos_seleccionados:
+                continue
+            if organismo_filter and organismo_filter.strip().lower() not in (agr.get("organismo_nombre", "") or "").lower():
+                continue
+            acuerdos_filtrados.append(agr)
+        
+        if not acuerdos_filtrados:
+            st.warning("No hay acuerdos que coincidan con los filtros seleccionados.")
+            return
+        
+        # Generar según formato
+        if formato == "PDF":
+            generar_pdf_informe(acuerdos_filtrados, año, organismo_filter)
+        elif formato == "Excel":
+            generar_excel_informe(acuerdos_filtrados, año)
+        elif formato == "HTML":
+            generar_html_informe(acuerdos_filtrados, año)
+        else:  # Pantalla
+            mostrar_informe_pantalla(acuerdos_filtrados, año, incluir_metricas, incluir_detalles)
+
+# ==================== TABLA PLANA ACUERDO → FICHA → META ====================
+
+def _a_float(valor: Any) -> Optional[float]:
+    """Convierte a float aceptando coma decimal; devuelve None si no es numérico"""
+    if valor is None:
+        return None
+    try:
+        return float(str(valor).replace(",", ".").replace("%", "").strip())
+    except (ValueError, TypeError):
+        return None
+
+def _cumplimiento_meta_efectivo(meta: Dict[str, Any]) -> Optional[float]:
+    """Cumplimiento guardado de la meta o, si no existe, el calculado (sin modificar la meta)"""
+    calc = meta.get("cumplimiento_calc")
+    if calc is None:
+        calc = calcular_cumplimiento(meta)
+    return calc
+
+def aplanar_acuerdo(agr: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    Aplana un acuerdo en una fila por meta, con los atributos del acuerdo y de la
+    ficha desnormalizados. Es la base común de los reportes y exportaciones.
+    """
+    filas = []
+    cumplimientos = {}
+    total_ponderacion = 0.0
+    total_ponderado = 0.0
+    
+    for ficha in agr.get("fichas", []):
+        for meta in ficha.get("metas", []):
+            cumpl = _cumplimiento_meta_efectivo(meta)
+            cumplimientos[id(meta)] = cumpl
+            if cumpl is not None:
+                ponderacion = float(meta.get("ponderacion", 0.0) or 0.0)
+                total_ponderacion += ponderacion
+                total_ponderado += cumpl * ponderacion
+    
+    # Mismo criterio que calcular_cumplimiento_acuerdo
+    cumplimiento_acuerdo = total_ponderado / total_ponderacion if total_ponderacion > 0 else None
+    
+    for ficha in agr.get("fichas", []):
+        for meta in ficha.get("metas", []):
+            filas.append({
+                "año": agr.get("año"),
+                "acuerdo_id": agr.get("id"),
+                "organismo_nombre": agr.get("organismo_nombre"),
+                "organismo_tipo": agr.get("organismo_tipo"),
+                "tipo_compromiso": agr.get("tipo_compromiso"),
+                "estado": agr.get("estado"),
+                "ficha_id": ficha.get("id"),
+                "ficha_nombre": ficha.get("nombre"),
+                "tipo_meta": ficha.get("tipo_meta"),
+                "meta_id": meta.get("id"),
+                "meta_numero": meta.get("numero"),
+                "meta_descripcion": meta.get("descripcion"),
+                "estado_meta": meta.get("estado"),
+                "unidad": meta.get("unidad"),
+                "sentido": meta.get("sentido"),
+                "frecuencia": meta.get("frecuencia"),
+                "vencimiento": meta.get("vencimiento"),
+                "periodo_label": periodo_label(meta),
+                "es_hito": bool(meta.get("es_hito")),
+                "valor_objetivo": _a_float(meta.get("valor_objetivo")),
+                "ponderacion": float(meta.get("ponderacion", 0.0) or 0.0),
+                "cumplimiento_valor": _a_float(meta.get("cumplimiento_valor")),
+                "cumplimiento_meta": cumplimientos[id(meta)],
+                "clasificacion": clasificar_cumplimiento_meta(meta, cumplimientos[id(meta)]),
+                "cumplimiento_acuerdo": cumplimiento_acuerdo,
+                "rangos": [
+                    {
+                        "min": _a_float(r.get("min")),
+                        "max": _a_float(r.get("max")),
+                        "porcentaje": _a_float(r.get("porcentaje")),
+                    }
+                    for r in meta.get("rango", []) or []
+                ],
+            })
+    return filas
+
+# ==================== EXCEL EN STREAMING (xlsxwriter constant_memory) ====================
+
+# Columnas de las hojas Excel: (encabezado, columna de la tabla plana, ancho, formato)
+COLUMNAS_EXCEL_CONSOLIDADO = [
+    ("Año", "año", 6, None),
+    ("Acuerdo", "acuerdo_id", 18, None),
+    ("Organismo", "organismo_nombre", 32, None),
+    ("Tipo", "tipo_compromiso", 14, None),
+    ("Estado", "estado", 12, None),
+    ("Ficha", "ficha_id", 16, None),
+    ("Meta", "meta_descripcion", 50, "ajustado"),
+    ("Ponderación", "ponderacion", 12, "decimal"),
+    ("Cumplimiento", "cumplimiento_meta", 14, "decimal"),
+    ("Cumplimiento Acuerdo", "cumplimiento_acuerdo", 20, None),
+]
+
+# Columnas de la hoja consolidada de exportar_reportes_completos
+COLUMNAS_EXCEL_PAQUETE = [
+    ("Año", "año", 6, None),
+    ("Acuerdo_ID", "acuerdo_id", 18, None),
+    ("Organismo", "organismo_nombre", 32, None),
+    ("Tipo_Compromiso", "tipo_compromiso", 14, None),
+    ("Estado", "estado", 12, None),
+    ("Ficha_ID", "ficha_id", 16, None),
+    ("Ficha_Nombre", "ficha_nombre", 30, None),
+    ("Meta_Descripcion", "meta_descripcion", 50, "ajustado"),
+    ("Meta_Numero", "meta_numero", 12, None),
+    ("Ponderacion", "ponderacion", 12, "decimal"),
+    ("Cumplimiento_Meta", "cumplimiento_meta", 18, "decimal"),
+    ("Cumplimiento_Acuerdo", "cumplimiento_acuerdo", 20, None),
+]
+
+# Conversión de valores de la tabla plana al texto que muestran los reportes
+CONVERSIONES_EXCEL = {
+    "cumplimiento_meta": lambda v: "No calculado" if v is None else v,
+    "cumplimiento_acuerdo": lambda v: _texto_cumplimiento(v),
+}
+
+MAX_HOJAS_ORGANISMO = 200   # cada hoja abierta en constant_memory usa un archivo temporal
+CARACTERES_INVALIDOS_HOJA = str.maketrans({c: " " for c in "[]:*?/\\"})
+
+def _nombre_hoja_excel(nombre: str, usados: set) -> str:
+    """Nombre de hoja válido para Excel (31 caracteres, sin []:*?/\\) y único en el libro"""
+    base = (str(nombre or "Sin organismo").translate(CARACTERES_INVALIDOS_HOJA).strip() or "Sin organismo")[:31]
+    candidato, n = base, 2
+    while candidato.lower() in usados:
+        sufijo = f" ({n})"
+        candidato, n = base[:31 - len(sufijo)] + sufijo, n + 1
+    usados.add(candidato.lower())
+    return candidato
+
+def escribir_excel_streaming(filas: Iterable[Dict[str, Any]], columnas: List[tuple], destino,
+                             titulo_hoja: str = "Reporte Consolidado", por_organismo: bool = True) -> int:
+    """
+    Escribe un libro Excel fila a fila con xlsxwriter en modo constant_memory.
+    
+    Cada fila se vuelca a disco apenas se escribe, así que la memoria no depende de
+    la cantidad de metas. Además de la hoja principal agrega un "Resumen" y, si se
+    pide, una hoja por organismo (hasta MAX_HOJAS_ORGANISMO).
+    
+    Args:
+        filas: Filas de la tabla plana (dict por meta), p. ej. TablaPlanaMaterializada.iterar_filas
+        columnas: Lista (encabezado, clave, ancho, formato)
+        destino: Ruta o archivo binario con seek (BytesIO, SpooledTemporaryFile)
+        titulo_hoja: Nombre de la hoja principal
+        por_organismo: Si se agrega una hoja por organismo
+        
+    Returns:
+        Cantidad de filas escritas (sin encabezado)
+    """
+    import xlsxwriter
+    
+    libro = xlsxwriter.Workbook(destino, {"constant_memory": True, "nan_inf_to_errors": True})
+    formatos = {
+        "encabezado": libro.add_format({"bold": True, "bg_color": "#007BFF", "font_color": "white", "border": 1}),
+        "decimal": libro.add_format({"num_format": "0.0"}),
+        "ajustado": libro.add_format({"text_wrap": True, "valign": "top"}),
+    }
+    formatos_columna = [formatos.get(formato) for _, _, _, formato in columnas]
+    conversiones = [CONVERSIONES_EXCEL.get(clave) for _, clave, _, _ in columnas]
+    usados: set = set()
+    
+    def nueva_hoja(nombre: str):
+        hoja = libro.add_worksheet(_nombre_hoja_excel(nombre, usados))
+        for i, (encabezado, _, ancho, _) in enumerate(columnas):
+            hoja.set_column(i, i, ancho)
+            hoja.write(0, i, encabezado, formatos["encabezado"])
+        hoja.freeze_panes(1, 0)
+        return {"hoja": hoja, "fila": 0}
+    
+    # Las hojas quedan en orden de creación: resumen y principal primero
+    resumen = libro.add_worksheet(_nombre_hoja_excel("Resumen", usados))
+    principal = nueva_hoja(titulo_hoja)
+    por_hoja: Dict[str, Dict[str, Any]] = {}
+    totales: Dict[str, Dict[str, Any]] = {}
+    
+    for fila in filas:
+        valores = [
+            convertir(fila.get(clave)) if convertir else fila.get(clave)
+            for (_, clave, _, _), convertir in zip(columnas, conversiones)
+        ]
+        organismo = fila.get("organismo_nombre") or "Sin organismo"
+        destinos = [principal]
+        if por_organismo:
+            if organismo not in por_hoja and len(por_hoja) < MAX_HOJAS_ORGANISMO:
+                por_hoja[organismo] = nueva_hoja(organismo)
+            if organismo in por_hoja:
+                destinos.append(por_hoja[organismo])
+        for actual in destinos:
+            actual["fila"] += 1
+            for i, (valor, formato) in enumerate(zip(valores, formatos_columna)):
+                actual["hoja"].write(actual["fila"], i, valor, formato)
+        
+        total = totales.setdefault(organismo, {"metas": 0, "acuerdos": set(), "cumplimientos": {}})
+        total["metas"] += 1
+        total["acuerdos"].add(fila.get("acuerdo_id"))
+        if fila.get("cumplimiento_acuerdo") is not None:
+            total["cumplimientos"][fila.get("acuerdo_id")] = fila["cumplimiento_acuerdo"]
+    
+    for actual in [principal, *por_hoja.values()]:
+        actual["hoja"].autofilter(0, 0, max(actual["fila"], 1), len(columnas) - 1)
+    
+    # Resumen por organismo (se escribe al final: en constant_memory basta con filas crecientes)
+    for i, (encabezado, ancho) in enumerate([("Organismo", 40), ("Acuerdos", 10), ("Metas", 10), ("Cumplimiento promedio", 22)]):
+        resumen.set_column(i, i, ancho)
+        resumen.write(0, i, encabezado, formatos["encabezado"])
+    for n, (organismo, total) in enumerate(sorted(totales.items()), 1):
+        cumplimientos = list(total["cumplimientos"].values())
+        resumen.write_row(n, 0, [organismo, len(total["acuerdos"]), total["metas"]])
+        if cumplimientos:
+            resumen.write_number(n, 3, sum(cumplimientos) / len(cumplimientos), formatos["decimal"])
+        else:
+            resumen.write_string(n, 3, "No calculado")
+    if len(totales) > MAX_HOJAS_ORGANISMO and por_organismo:
+        resumen.write_string(len(totales) + 2, 0, f"Se crearon hojas solo para los primeros {MAX_HOJAS_ORGANISMO} organismos.")
+    
+    libro.close()
+    return principal["fila"]
+
+# ==================== TABLA PLANA MATERIALIZADA ====================
+
+# Orden de columnas de la tabla plana (claves de aplanar_acuerdo)
+COLUMNAS_TABLA_PLANA = [
+    "año", "acuerdo_id", "organismo_nombre", "organismo_tipo", "tipo_compromiso", "estado",
+    "ficha_id", "ficha_nombre", "tipo_meta",
+    "meta_id", "meta_numero", "meta_descripcion", "estado_meta", "unidad", "sentido",
+    "frecuencia", "vencimiento", "periodo_label", "es_hito", "valor_objetivo", "ponderacion",
+    "cumplimiento_valor", "cumplimiento_meta", "clasificacion", "cumplimiento_acuerdo", "rangos",
+]
+
+# Subir al cambiar cómo se calcula una columna o cómo se guardan los bloques: la tabla
+# plana y el cubo guardados con otra versión (o sin versión, el formato de un solo
+# archivo) se descartan y se reconstruyen en la próxima sincronización
+VERSION_APLANADO = 2
+
+def digest_acuerdo(agr: Dict[str, Any]) -> str:
+    """Huella del contenido de un acuerdo; cambia solo si el acuerdo cambió"""
+    contenido = json.dumps(agr, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha1(contenido.encode("utf-8")).hexdigest()
+
+def _ruta_bloque(carpeta: str, agr_id: str) -> str:
+    """Archivo del bloque de un acuerdo (nombre derivado del id, seguro para el sistema de archivos)"""
+    return os.path.join(carpeta, hashlib.sha1(agr_id.encode("utf-8")).hexdigest()[:20] + ".json")
+
+def _ids_a_revisar(db: Dict[str, Any], conocidos: Iterable[str], modificados: Optional[Iterable[str]]) -> Iterable[str]:
+    """Todos los ids de db, o solo los modificados más los que todavía no se conocen"""
+    if modificados is None:
+        return list(db)
+    return [i for i in db if i in set(modificados) or i not in conocidos]
+
+class TablaPlanaMaterializada:
+    """
+    Tabla plana (una fila por meta) guardada por columnas en TABLA_PLANA_FILE.
+    
+    Se mantiene un bloque de columnas por acuerdo junto con su digest, de modo que
+    al guardar solo se vuelven a aplanar los acuerdos nuevos o modificados. Cada
+    bloque se guarda en su propio archivo (carpeta <archivo>_bloques) y el archivo
+    principal solo lleva los digests: guardar reescribe únicamente los bloques que
+    cambiaron. Los reportes leen de aquí en lugar de recorrer acuerdo → ficha → meta.
+    Los bloques de los acuerdos archivados se conservan aunque no estén en
+    agreements.json.
+    """
+    
+    def __init__(self, archivo: str = None):
+        self.archivo = archivo or TABLA_PLANA_FILE
+        self.carpeta_bloques = os.path.splitext(self.archivo)[0] + "_bloques"
+        self.bloques: Dict[str, Dict[str, list]] = {}
+        self.digests: Dict[str, str] = {}
+        self.mtime_fuente: Optional[float] = None
+        self._columnas: Optional[Dict[str, list]] = None
+        self._lock = threading.RLock()
+        self._cargar()
+    
+    # ---------- persistencia ----------
+    def _cargar(self):
+        datos = load_json(self.archivo, {})
+        if (datos.get("columnas_def") != COLUMNAS_TABLA_PLANA
+                or datos.get("version_aplanado", 1) != VERSION_APLANADO):
+            return
+        self.mtime_fuente = datos.get("mtime_fuente")
+        for agr_id, digest in datos.get("digests", {}).items():
+            bloque = load_json(_ruta_bloque(self.carpeta_bloques, agr_id), None)
+            if bloque is not None:  # sin bloque se vuelve a aplanar al sincronizar
+                self.bloques[agr_id], self.digests[agr_id] = bloque, digest
+    
+    def _guardar(self, cambiados: Iterable[str]):
+        """Escribe los bloques de los acuerdos cambiados (borra los eliminados) y los digests"""
+        os.makedirs(self.carpeta_bloques, exist_ok=True)
+        for agr_id in set(cambiados):
+            ruta = _ruta_bloque(self.carpeta_bloques, agr_id)
+            if agr_id in self.bloques:
+                save_json(ruta, self.bloques[agr_id])
+            else:
+                try:
+                    os.remove(ruta)
+                except OSError:
+                    pass
+        save_json(self.archivo, {
+            "columnas_def": COLUMNAS_TABLA_PLANA,
+            "version_aplanado": VERSION_APLANADO,
+            "mtime_fuente": self.mtime_fuente,
+            "digests": self.digests,
+        })
+    
+    @staticmethod
+    def _mtime_agreements() -> Optional[float]:
+        try:
+            return os.path.getmtime(AGREEMENTS_FILE)
+        except OSError:
+            return None
+    
+    # ---------- mantenimiento incremental ----------
+    @staticmethod
+    def _bloque(agr: Dict[str, Any]) -> Dict[str, list]:
+        filas = aplanar_acuerdo(agr)
+        return {col: [fila.get(col) for fila in filas] for col in COLUMNAS_TABLA_PLANA}
+    
+    def sincronizar(self, db: Dict[str, Any], modificados: Optional[Iterable[str]] = None) -> List[str]:
+        """
+        Actualiza la tabla con el contenido de db (dict id → acuerdo).
+        
+        Args:
+            modificados: IDs que el llamador sabe que cambiaron; solo se calcula el
+                         digest de esos (y de los nuevos). None revisa todos.
+        
+        Returns:
+            List[str]: IDs de acuerdos nuevos, modificados o eliminados
+        """
+        archivo = obtener_almacen_archivo()
+        with self._lock:
+            cambiados = []
+            for agr_id in _ids_a_revisar(db, self.digests, modificados):
+                digest = digest_acuerdo(db[agr_id])
+                if self.digests.get(agr_id) != digest or agr_id not in self.bloques:
+                    self.bloques[agr_id], self.digests[agr_id] = self._bloque(db[agr_id]), digest
+                    cambiados.append(agr_id)
+            # Los acuerdos archivados no cambian: se conserva su bloque (o se aplanan desde la partición)
+            archivados = archivo.ids() - db.keys()
+            for agr_id in archivados - self.bloques.keys():
+                agr = archivo.acuerdo(agr_id)
+                if agr is not None:
+                    self.bloques[agr_id], self.digests[agr_id] = self._bloque(agr), digest_acuerdo(agr)
+                    cambiados.append(agr_id)
+            for agr_id in [i for i in self.digests if i not in db and i not in archivados]:
+                del self.digests[agr_id]
+                self.bloques.pop(agr_id, None)
+                cambiados.append(agr_id)
+            
+            self.mtime_fuente = self._mtime_agreements()
+            if cambiados:
+                self._columnas = None
+                self._guardar(cambiados)
+            return cambiados
+    
+    def asegurar_sincronizada(self):
+        """Resincroniza si agreements.json cambió por fuera de agreements_save"""
+        if self.mtime_fuente is None or self.mtime_fuente != self._mtime_agreements():
+            self.sincronizar(agreements_load())
+    
+    # ---------- lectura ----------
+    def columnas(self) -> Dict[str, list]:
+        """Columnas completas de la tabla (concatenación de los bloques)"""
+        with self._lock:
+            self.asegurar_sincronizada()
+            if self._columnas is None:
+                columnas = {col: [] for col in COLUMNAS_TABLA_PLANA}
+                for bloque in self.bloques.values():
+                    for col in COLUMNAS_TABLA_PLANA:
+                        columnas[col].extend(bloque.get(col, []))
+                self._columnas = columnas
+            return self._columnas
+    
+    def dataframe(self, acuerdo_ids: Optional[Iterable[str]] = None) -> pd.DataFrame:
+        """
+        DataFrame de la tabla plana, opcionalmente limitado a algunos acuerdos
+        (se respeta el orden de los acuerdos en la base).
+        """
+        df = pd.DataFrame(self.columnas(), columns=COLUMNAS_TABLA_PLANA)
+        if acuerdo_ids is not None:
+            df = df[df["acuerdo_id"].isin(list(acuerdo_ids))].reset_index(drop=True)
+        return df
+    
+    def iterar_filas(self, acuerdo_ids: Optional[Iterable[str]] = None) -> Iterator[Dict[str, Any]]:
+        """Genera las filas (dict por meta) de los acuerdos pedidos, bloque a bloque"""
+        with self._lock:
+            self.asegurar_sincronizada()
+            ids = list(self.bloques) if acuerdo_ids is None else [i for i in acuerdo_ids if i in self.bloques]
+            bloques = [self.bloques[i] for i in ids]
+        for bloque in bloques:
+            for i in range(len(bloque["acuerdo_id"])):
+                yield {col: bloque[col][i] for col in COLUMNAS_TABLA_PLANA}
+    
+    def revision_de(self, acuerdo_ids: Iterable[str]) -> str:
+        """Token de versión de un conjunto de acuerdos (respeta el orden recibido)"""
+        with self._lock:
+            self.asegurar_sincronizada()
+            base = "|".join(f"{i}:{self.digests.get(i, '')}" for i in acuerdo_ids)
+            return hashlib.sha1(base.encode("utf-8")).hexdigest()[:16]
+    
+    @property
+    def revision(self) -> str:
+        """Token de versión de los datos (cambia cuando cambia cualquier acuerdo)"""
+        with self._lock:
+            self.asegurar_sincronizada()
+            base = "|".join(f"{k}:{v}" for k, v in sorted(self.digests.items()))
+            return hashlib.sha1(base.encode("utf-8")).hexdigest()[:16]
+
+@st.cache_resource(show_spinner=False)
+def obtener_tabla_plana() -> TablaPlanaMaterializada:
+    """Instancia compartida (entre sesiones y reruns) de la tabla plana"""
+    return TablaPlanaMaterializada()
+
+# ==================== CUBO DE CUMPLIMIENTO PREAGREGADO ====================
+
+# Dimensiones del cubo. Las celdas de metas usan todas; las de acuerdos no llevan
+# período porque un acuerdo abarca metas de varios períodos.
+DIMENSIONES_CUBO = ["año", "periodo_label", "tipo_compromiso", "organismo_tipo", "organismo_nombre", "estado"]
+DIMENSIONES_ACUERDO_CUBO = [d for d in DIMENSIONES_CUBO if d != "periodo_label"]
+MEDIDAS_META_CUBO = ["metas", "cumplidas", "parciales", "no_cumplidas", "ponderacion_con_dato", "suma_ponderada"]
+MEDIDAS_ACUERDO_CUBO = ["acuerdos", "fichas", "acuerdos_con_cumplimiento", "suma_cumplimiento_acuerdo"]
+INDICE_CLASIFICACION_CUBO = {"cumplida": 1, "parcial": 2, "no_cumplida": 3}
+
+def filtros_cubo(año: Optional[int] = None, tipos: Optional[Iterable[str]] = None,
+                 organismo_contiene: Optional[str] = None, **otros) -> Dict[str, Any]:
+    """
+    Arma los filtros de CuboCumplimiento con la misma semántica que los filtros de page_reportes.
+    
+    Cada filtro es un valor exacto, una colección de valores admitidos o una función.
+    """
+    filtros: Dict[str, Any] = dict(otros)
+    if año is not None:
+        filtros["año"] = año
+    if tipos is not None:
+        filtros["tipo_compromiso"] = set(tipos)
+    if organismo_contiene and organismo_contiene.strip():
+        texto = organismo_contiene.strip().lower()
+        filtros["organismo_nombre"] = lambda valor: texto in (valor or "").lower()
+    return filtros
+
+def _coincide_celda(clave: tuple, dimensiones: List[str], filtros: Dict[str, Any]) -> bool:
+    for dimension, condicion in filtros.items():
+        if dimension not in dimensiones:
+            continue
+        valor = clave[dimensiones.index(dimension)]
+        if callable(condicion):
+            if not condicion(valor):
+                return False
+        elif isinstance(condicion, (set, frozenset, list, tuple)):
+            if valor not in condicion:
+                return False
+        elif valor != condicion:
+            return False
+    return True
+
+class CuboCumplimiento:
+    """
+    Agregados precalculados de cumplimiento (conteos, clases y sumas ponderadas).
+    
+    Se guarda el aporte de cada acuerdo al cubo: al guardar solo se resta el aporte
+    anterior de los acuerdos modificados y se suma el nuevo, sin recorrer el resto.
+    Como en la tabla plana, cada aporte tiene su archivo (carpeta <archivo>_aportes)
+    y solo se reescriben los que cambiaron.
+    Las métricas de page_reportes y del inicio se obtienen cortando el cubo.
+    """
+    
+    def __init__(self, archivo: str = None):
+        self.archivo = archivo or CUBO_FILE
+        self.carpeta_aportes = os.path.splitext(self.archivo)[0] + "_aportes"
+        self.aportes: Dict[str, Dict[str, Any]] = {}
+        self.celdas_metas: Dict[tuple, List[float]] = {}
+        self.celdas_acuerdos: Dict[tuple, List[float]] = {}
+        self._lock = threading.RLock()
+        self._cargar()
+    
+    # ---------- persistencia ----------
+    def _cargar(self):
+        datos = load_json(self.archivo, {})
+        if (datos.get("dimensiones") == DIMENSIONES_CUBO
+                and datos.get("medidas") == [MEDIDAS_META_CUBO, MEDIDAS_ACUERDO_CUBO]
+                and datos.get("version_aplanado", 1) == VERSION_APLANADO):
+            for agr_id in datos.get("ids", []):
+                aporte = load_json(_ruta_bloque(self.carpeta_aportes, agr_id), None)
+                if aporte is not None:  # sin aporte se vuelve a calcular al sincronizar
+                    self.aportes[agr_id] = aporte
+        for aporte in self.aportes.values():
+            self._sumar(aporte, 1)
+    
+    def _guardar(self, cambiados: Iterable[str]):
+        """Escribe los aportes cambiados (borra los eliminados) y la lista de ids"""
+        os.makedirs(self.carpeta_aportes, exist_ok=True)
+        for agr_id in set(cambiados):
+            ruta = _ruta_bloque(self.carpeta_aportes, agr_id)
+            if agr_id in self.aportes:
+                save_json(ruta, self.aportes[agr_id])
+            else:
+                try:
+                    os.remove(ruta)
+                except OSError:
+                    pass
+        save_json(self.archivo, {
+            "dimensiones": DIMENSIONES_CUBO,
+            "medidas": [MEDIDAS_META_CUBO, MEDIDAS_ACUERDO_CUBO],
+            "version_aplanado": VERSION_APLANADO,
+            "ids": list(self.aportes),
+        })
+    
+    # ---------- mantenimiento incremental ----------
+    @staticmethod
+    def _aporte(agr: Dict[str, Any], bloque: Dict[str, list], digest: str) -> Dict[str, Any]:
+        """Aporte de un acuerdo al cubo, a partir de su bloque de la tabla plana"""
+        metas: Dict[tuple, List[float]] = {}
+        for i in range(len(bloque["acuerdo_id"])):
+            clave = tuple(bloque[d][i] for d in DIMENSIONES_CUBO)
+            medidas = metas.setdefault(clave, [0] * len(MEDIDAS_META_CUBO))
+            medidas[0] += 1
+            medidas[INDICE_CLASIFICACION_CUBO.get(bloque["clasificacion"][i], 3)] += 1
+            cumplimiento = bloque["cumplimiento_meta"][i]
+            if cumplimiento is not None:
+                medidas[4] += bloque["ponderacion"][i]
+                medidas[5] += cumplimiento * bloque["ponderacion"][i]
+        
+        cumplimiento_acuerdo = next((c for c in bloque["cumplimiento_acuerdo"] if c is not None), None)
+        return {
+            "digest": digest,
+            "metas": [[list(clave), medidas] for clave, medidas in metas.items()],
+            "acuerdo": [
+                [agr.get(d) for d in DIMENSIONES_ACUERDO_CUBO],
+                [1, len(agr.get("fichas", [])), 0 if cumplimiento_acuerdo is None else 1, cumplimiento_acuerdo or 0.0],
+            ],
+        }
+    
+    @staticmethod
+    def _acumular(celdas: Dict[tuple, List[float]], clave: list, medidas: List[float], signo: int):
+        clave = tuple(clave)
+        celda = celdas.setdefault(clave, [0] * len(medidas))
+        for i, valor in enumerate(medidas):
+            celda[i] += signo * valor
+        if celda[0] <= 0:  # la primera medida es siempre un conteo
+            del celdas[clave]
+    
+    def _sumar(self, aporte: Dict[str, Any], signo: int):
+        for clave, medidas in aporte["metas"]:
+            self._acumular(self.celdas_metas, clave, medidas, signo)
+        clave, medidas = aporte["acuerdo"]
+        self._acumular(self.celdas_acuerdos, clave, medidas, signo)
+    
+    def sincronizar(self, db: Dict[str, Any], tabla: Optional[TablaPlanaMaterializada] = None,
+                    modificados: Optional[Iterable[str]] = None) -> List[str]:
+        """
+        Actualiza el cubo con db (dict id → acuerdo) reutilizando los bloques ya
+        aplanados de la tabla plana.
+        
+        Args:
+            modificados: IDs que cambiaron (más los nuevos); None revisa todos
+        
+        Returns:
+            List[str]: IDs de acuerdos cuyo aporte cambió
+        """
+        tabla = tabla or obtener_tabla_plana()
+        with self._lock:
+            cambiados = []
+            for agr_id in _ids_a_revisar(db, self.aportes, modificados):
+                agr = db[agr_id]
+                digest = tabla.digests.get(agr_id) or digest_acuerdo(agr)
+                if self.aportes.get(agr_id, {}).get("digest") == digest:
+                    continue
+                bloque = tabla.bloques.get(agr_id) if tabla.digests.get(agr_id) == digest else None
+                nuevo = self._aporte(agr, bloque or TablaPlanaMaterializada._bloque(agr), digest)
+                if agr_id in self.aportes:
+                    self._sumar(self.aportes[agr_id], -1)
+                self._sumar(nuevo, 1)
+                self.aportes[agr_id] = nuevo
+                cambiados.append(agr_id)
+            archivados = obtener_almacen_archivo().ids() - db.keys()
+            for agr_id in archivados - self.aportes.keys():
+                agr = obtener_almacen_archivo().acuerdo(agr_id)
+                if agr is not None and agr_id in tabla.bloques:
+                    self.aportes[agr_id] = self._aporte(agr, tabla.bloques[agr_id], tabla.digests[agr_id])
+                    self._sumar(self.aportes[agr_id], 1)
+                    cambiados.append(agr_id)
+            for agr_id in [i for i in self.aportes if i not in db and i not in archivados]:
+                self._sumar(self.aportes.pop(agr_id), -1)
+                cambiados.append(agr_id)
+            if cambiados:
+                self._guardar(cambiados)
+            return cambiados
+    
+    def asegurar_sincronizado(self):
+        """Resincroniza si la tabla plana tiene acuerdos que el cubo no refleja"""
+        tabla = obtener_tabla_plana()
+        with tabla._lock:
+            tabla.asegurar_sincronizada()
+            digests = dict(tabla.digests)
+        with self._lock:
+            al_dia = digests.keys() == self.aportes.keys() and all(
+                self.aportes[i]["digest"] == d for i, d in digests.items())
+        if not al_dia:
+            self.sincronizar(agreements_load(), tabla)
+    
+    # ---------- lectura ----------
+    def cortar(self, filtros: Optional[Dict[str, Any]] = None) -> tuple:
+        """
+        Suma las celdas que cumplen los filtros.
+        
+        Returns:
+            tuple: (dict de medidas de metas, dict de medidas de acuerdos)
+        """
+        filtros = filtros or {}
+        self.asegurar_sincronizado()
+        totales_metas = [0] * len(MEDIDAS_META_CUBO)
+        totales_acuerdos = [0] * len(MEDIDAS_ACUERDO_CUBO)
+        with self._lock:
+            for clave, medidas in self.celdas_metas.items():
+                if _coincide_celda(clave, DIMENSIONES_CUBO, filtros):
+                    totales_metas = [t + m for t, m in zip(totales_metas, medidas)]
+            for clave, medidas in self.celdas_acuerdos.items():
+                if _coincide_celda(clave, DIMENSIONES_ACUERDO_CUBO, filtros):
+                    totales_acuerdos = [t + m for t, m in zip(totales_acuerdos, medidas)]
+        return dict(zip(MEDIDAS_META_CUBO, totales_metas)), dict(zip(MEDIDAS_ACUERDO_CUBO, totales_acuerdos))
+    
+    def metricas(self, filtros: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Mismas métricas que calcular_metricas_globales (más total_fichas), desde el cubo"""
+        metas, acuerdos = self.cortar(filtros)
+        total_metas = int(metas["metas"])
+        
+        def porcentaje(cantidad):
+            return (cantidad / total_metas * 100) if total_metas > 0 else 0
+        
+        return {
+            'total_acuerdos': int(acuerdos["acuerdos"]),
+            'total_fichas': int(acuerdos["fichas"]),
+            'total_metas': total_metas,
+            'metas_cumplidas': int(metas["cumplidas"]),
+            'metas_parciales': int(metas["parciales"]),
+            'metas_no_cumplidas': int(metas["no_cumplidas"]),
+            'porcentaje_cumplidas': porcentaje(metas["cumplidas"]),
+            'porcentaje_parciales': porcentaje(metas["parciales"]),
+            'porcentaje_no_cumplidas': porcentaje(metas["no_cumplidas"]),
+            'cumplimiento_promedio': (acuerdos["suma_cumplimiento_acuerdo"] / acuerdos["acuerdos_con_cumplimiento"]
+                                      if acuerdos["acuerdos_con_cumplimiento"] else 0),
+        }
+    
+    def distribucion(self, dimension: str, filtros: Optional[Dict[str, Any]] = None) -> pd.DataFrame:
+        """Medidas de metas agrupadas por una dimensión (para gráficos de distribución)"""
+        posicion = DIMENSIONES_CUBO.index(dimension)
+        grupos: Dict[Any, List[float]] = {}
+        self.asegurar_sincronizado()
+        with self._lock:
+            for clave, medidas in self.celdas_metas.items():
+                if _coincide_celda(clave, DIMENSIONES_CUBO, filtros or {}):
+                    grupo = grupos.setdefault(clave[posicion], [0] * len(MEDIDAS_META_CUBO))
+                    for i, valor in enumerate(medidas):
+                        grupo[i] += valor
+        df = pd.DataFrame.from_dict(grupos, orient="index", columns=MEDIDAS_META_CUBO)
+        df.index.name = dimension
+        df["cumplimiento_ponderado"] = (df["suma_ponderada"] / df["ponderacion_con_dato"]).where(df["ponderacion_con_dato"] > 0)
+        return df.sort_index(key=lambda indice: indice.astype(str))
+
+@st.cache_resource(show_spinner=False)
+def obtener_cubo_cumplimiento() -> CuboCumplimiento:
+    """Instancia compartida del cubo de cumplimiento"""
+    return CuboCumplimiento()
+
+# ==================== ALMACÉN DE ADJUNTOS POR CONTENIDO ====================
+
+class AlmacenAdjuntos:
+    """
+    Adjuntos guardados una sola vez por contenido, en BLOBS_DIR/<sha[:2]>/<sha256>.
+    
+    Cada adjunto de la lista del acuerdo (adjuntos_acuerdo) referencia su blob por sha256, así el mismo
+    archivo subido a varios acuerdos ocupa disco una vez. El hash se calcula por
+    bloques mientras se copia. Los blobs que dejan de estar referenciados por algún
+    acuerdo se eliminan al guardar (conteo de referencias), y recolectar() barre los
+    huérfanos que hayan quedado de subidas interrumpidas.
+    
+    También mantiene un índice de metadatos (tamaño, tipo MIME, hash, acuerdo y
+    organismo de cada adjunto) que se rearma al guardar los acuerdos; las consultas
+    de uso de espacio salen de ahí, sin recorrer el disco.
+    """
+    
+    def __init__(self, carpeta: str = None):
+        self.carpeta = carpeta or BLOBS_DIR
+        self.conteos: Optional[Dict[str, int]] = None  # sha256 → referencias (None = aún no calculado)
+        self.metadatos: Optional[List[Dict[str, Any]]] = None  # una entrada por adjunto de cada acuerdo
+        self._lock = threading.RLock()
+        os.makedirs(self.carpeta, exist_ok=True)
+    
+    def ruta(self, sha256: str) -> str:
+        return os.path.join(self.carpeta, sha256[:2], sha256)
+    
+    def ruta_de(self, adjunto: Dict[str, Any]) -> str:
+        """Ruta en disco de un adjunto (los registros anteriores al almacén solo tienen 'path')"""
+        return self.ruta(adjunto["sha256"]) if adjunto.get("sha256") else adjunto.get("path", "")
+    
+    def guardar(self, origen: Union[bytes, IO[bytes]]) -> tuple:
+        """
+        Guarda un contenido y devuelve (sha256, tamaño, nuevo). Si el blob ya existía
+        no se escribe nada más (nuevo=False).
+        """
+        if isinstance(origen, (bytes, bytearray)):
+            origen = io.BytesIO(origen)
+        elif hasattr(origen, "seek"):
+            origen.seek(0)
+        digest = hashlib.sha256()
+        tamaño = 0
+        with tempfile.NamedTemporaryFile(dir=self.carpeta, prefix=".subida_", delete=False) as tmp:
+            for bloque in iter(functools.partial(origen.read, TAMAÑO_BLOQUE_HASH), b""):
+                digest.update(bloque)
+                tmp.write(bloque)
+                tamaño += len(bloque)
+        sha256 = digest.hexdigest()
+        destino = self.ruta(sha256)
+        if os.path.exists(destino):
+            os.remove(tmp.name)
+            return sha256, tamaño, False
+        os.makedirs(os.path.dirname(destino), exist_ok=True)
+        os.replace(tmp.name, destino)
+        return sha256, tamaño, True
+    
+    def adjunto(self, nombre: str, origen: Union[bytes, IO[bytes]]) -> Dict[str, Any]:
+        """Guarda el contenido y arma el registro para agr["attachments"]"""
+        sha256, tamaño, _ = self.guardar(origen)
+        return {
+            "name": nombre,
+            "sha256": sha256,
+            "size": tamaño,
+            "mime": self.tipo_mime(nombre),
+            "path": self.ruta(sha256),
+            "upload_time": datetime.now().isoformat(),
+        }
+    
+    @staticmethod
+    def tipo_mime(nombre: str) -> str:
+        return mimetypes.guess_type(nombre)[0] or "application/octet-stream"
+    
+    # ---------- referencias ----------
+    @staticmethod
+    def contar_referencias(db: Dict[str, Any]) -> Dict[str, int]:
+        conteos: Dict[str, int] = {}
+        for agr in acuerdos_con_archivados(db).values():
+            for adjunto in adjuntos_acuerdo(agr):
+                if adjunto.get("sha256"):
+                    conteos[adjunto["sha256"]] = conteos.get(adjunto["sha256"], 0) + 1
+        return conteos
+    
+    def migrar(self, db: Dict[str, Any]) -> List[str]:
+        """
+        Pasa al almacén los adjuntos guardados con el esquema anterior
+        (UPLOADS_DIR/<acuerdo>/<archivo>). Modifica los registros en db, pero no
+        borra los archivos viejos: eso se hace con eliminar_legados() recién cuando
+        agreements.json quedó guardado con los registros nuevos.
+        
+        Returns:
+            List[str]: Rutas de los archivos del esquema anterior ya copiados al almacén
+        """
+        legados = []
+        for agr in db.values():
+            for adjunto in agr.get("attachments", []) or []:
+                ruta = adjunto.get("path", "")
+                if adjunto.get("sha256") or not os.path.isfile(ruta):
+                    continue
+                with open(ruta, "rb") as f:
+                    sha256, tamaño, _ = self.guardar(f)
+                adjunto.update(sha256=sha256, size=tamaño, mime=self.tipo_mime(adjunto.get("name", "")),
+                               path=self.ruta(sha256))
+                legados.append(ruta)
+        return legados
+    
+    @staticmethod
+    def eliminar_legados(rutas: Iterable[str]):
+        """Borra los archivos del esquema anterior (y la carpeta del acuerdo si queda vacía)"""
+        for ruta in rutas:
+            try:
+                os.remove(ruta)
+                os.rmdir(os.path.dirname(ruta))  # solo si la carpeta del acuerdo quedó vacía
+            except OSError:
+                pass
+    
+    def _eliminar_blob(self, sha256: str) -> int:
+        ruta = self.ruta(sha256)
+        try:
+            tamaño = os.path.getsize(ruta)
+            os.remove(ruta)
+            return tamaño
+        except OSError:
+            return 0
+    
+    def liberar(self, db: Dict[str, Any]) -> List[str]:
+        """
+        Actualiza los conteos con db y elimina los blobs que quedaron sin referencias.
+        
+        Returns:
+            List[str]: sha256 de los blobs eliminados
+        """
+        with self._lock:
+            self.indexar_metadatos(db)
+            if self.conteos is None:
+                self.recolectar(db)
+                return []
+            nuevos = self.contar_referencias(db)
+            liberados = [sha256 for sha256 in self.conteos if sha256 not in nuevos]
+            for sha256 in liberados:
+                self._eliminar_blob(sha256)
+            self.conteos = nuevos
+            return liberados
+    
+    def recolectar(self, db: Dict[str, Any], gracia_segundos: int = GRACIA_RECOLECCION_BLOBS) -> tuple:
+        """
+        Barre el almacén y elimina los blobs sin referencias más viejos que la gracia
+        (la gracia protege subidas cuyo acuerdo todavía no se guardó).
+        
+        Returns:
+            tuple: (blobs eliminados, bytes liberados)
+        """
+        with self._lock:
+            self.conteos = self.contar_referencias(db)
+            limite = time.time() - gracia_segundos
+            eliminados = liberados = 0
+            for subcarpeta in os.scandir(self.carpeta):
+                if not subcarpeta.is_dir():
+                    continue
+                for entrada in os.scandir(subcarpeta.path):
+                    if entrada.name in self.conteos or entrada.stat().st_mtime > limite:
+                        continue
+                    liberados += self._eliminar_blob(entrada.name)
+                    eliminados += 1
+            # Temporales de subidas interrumpidas
+            for entrada in os.scandir(self.carpeta):
+                if entrada.is_file() and entrada.name.startswith(".subida_") and entrada.stat().st_mtime <= limite:
+                    os.remove(entrada.path)
+            return eliminados, liberados
+    
+    # ---------- índice de metadatos ----------
+    def indexar_metadatos(self, db: Dict[str, Any]):
+        """Rearma el índice de metadatos a partir de los registros de adjuntos de db"""
+        metadatos = []
+        for agr_id, agr in acuerdos_con_archivados(db).items():
+            for adjunto in adjuntos_acuerdo(agr):
+                metadatos.append({
+                    "acuerdo_id": agr_id,
+                    "organismo": agr.get("organismo_nombre") or "Sin organismo",
+                    "nombre": adjunto.get("name", ""),
+                    "sha256": adjunto.get("sha256"),
+                    "bytes": int(adjunto.get("size") or 0),
+                    "mime": adjunto.get("mime") or self.tipo_mime(adjunto.get("name", "")),
+                })
+        with self._lock:
+            self.metadatos = metadatos
+    
+    def uso(self, por: Optional[str] = None) -> Union[Dict[str, Any], pd.DataFrame]:
+        """
+        Uso de espacio de los adjuntos según el índice (no lee el disco).
+        
+        Args:
+            por: None para los totales, o "acuerdo_id" / "organismo" / "mime" para
+                 un DataFrame con archivos y bytes por grupo (de mayor a menor)
+        
+        Returns:
+            Totales: archivos, bytes (suma por adjunto), blobs y bytes_en_disco
+            (cada contenido una vez); o el DataFrame agrupado
+        """
+        with self._lock:
+            if self.metadatos is None:
+                self.indexar_metadatos(agreements_load())
+            metadatos = list(self.metadatos)
+        
+        if por is not None:
+            df = pd.DataFrame(metadatos, columns=["acuerdo_id", "organismo", "nombre", "sha256", "bytes", "mime"])
+            return (df.groupby(por).agg(archivos=("nombre", "size"), bytes=("bytes", "sum"))
+                    .sort_values("bytes", ascending=False).reset_index())
+        
+        unicos = {m["sha256"]: m["bytes"] for m in metadatos if m["sha256"]}
+        return {
+            "archivos": len(metadatos),
+            "bytes": sum(m["bytes"] for m in metadatos),
+            "blobs": len(unicos),
+            "bytes_en_disco": sum(unicos.values()),
+        }
+
+@st.cache_resource(show_spinner=False)
+def obtener_almacen_adjuntos() -> AlmacenAdjuntos:
+    """Almacén de adjuntos compartido por todas las sesiones"""
+    return AlmacenAdjuntos()
+
+def huella_adjuntos(adjuntos: Iterable[Dict[str, Any]]) -> str:
+    """Hash del conjunto de adjuntos (nombre + contenido); no depende del orden"""
+    partes = sorted(f"{a.get('name', '')}:{a.get('sha256') or a.get('path', '')}" for a in adjuntos)
+    return hashlib.sha256("\n".join(partes).encode("utf-8")).hexdigest()
+
+def construir_zip_adjuntos(adjuntos: Iterable[Dict[str, Any]], nivel_compresion: int = NIVEL_COMPRESION_ZIP) -> IO[bytes]:
+    """
+    ZIP con los adjuntos, escrito por bloques a un archivo temporal (en memoria hasta
+    UMBRAL_SPOOL_BYTES). Los formatos ya comprimidos se guardan sin recomprimir.
+    Devuelve el archivo rebobinado; quien lo recibe lo cierra.
+    """
+    almacen = obtener_almacen_adjuntos()
+    salida = tempfile.SpooledTemporaryFile(max_size=UMBRAL_SPOOL_BYTES, prefix="adjuntos_cg_", suffix=".zip")
+    with zipfile.ZipFile(salida, mode="w", compression=zipfile.ZIP_DEFLATED, compresslevel=nivel_compresion) as zf:
+        nombres = set()
+        for adjunto in sorted(adjuntos, key=lambda a: a.get("name", "")):
+            ruta = almacen.ruta_de(adjunto)
+            if adjunto["name"] in nombres or not os.path.isfile(ruta):
+                continue
+            nombres.add(adjunto["name"])
+            extension = os.path.splitext(adjunto["name"])[1].lower()
+            zf.write(ruta, adjunto["name"],
+                     compress_type=zipfile.ZIP_STORED if extension in EXTENSIONES_SIN_RECOMPRIMIR else None)
+    salida.seek(0)
+    return salida
+
+def boton_descarga_todos_adjuntos(agr: Dict[str, Any]):
+    """
+    Descarga de todos los adjuntos del acuerdo en un ZIP (mismo flujo de "Preparar").
+    El ZIP se guarda en la caché de reportes con el hash del conjunto de adjuntos
+    como revisión: volver a descargar el mismo conjunto no lo reconstruye.
+    """
+    adjuntos = adjuntos_acuerdo(agr)
+    clave = f"zip_adjuntos_preparado_{agr['id']}"
+    if st.session_state.get(clave):
+        archivo = obtener_cache_reportes().abrir_o_generar(
+            "adjuntos_zip", {}, [], lambda: construir_zip_adjuntos(adjuntos), revision=huella_adjuntos(adjuntos))
+        if archivo is None:
+            st.error("No se pudo generar el ZIP de adjuntos")
+            return
+        with archivo:
+            st.download_button(
+                "⬇️ Descargar todos los adjuntos (ZIP)", data=archivo, file_name=f"{agr['id']}_adjuntos.zip",
+                mime="application/zip", key=f"dl_zip_adjuntos_{agr['id']}",
+                on_click=lambda: st.session_state.pop(clave, None)
+            )
+    elif st.button("📦 Preparar ZIP con todos los adjuntos", key=f"prep_zip_adjuntos_{agr['id']}"):
+        st.session_state[clave] = True
+        st.rerun()
+
+def boton_descarga_adjunto(contenedor, agr_id: str, adjunto: Dict[str, Any], indice: int):
+    """
+    Descarga de un adjunto en dos pasos: "Preparar" marca el archivo y recién
+    entonces se lee del disco para el download_button. Así los reruns de la página
+    no leen ni envían los adjuntos que nadie pidió; al descargar se desmarca.
+    """
+    ruta = obtener_almacen_adjuntos().ruta_de(adjunto)
+    if not os.path.isfile(ruta):
+        contenedor.error("No encontrado")
+        return
+    
+    clave = f"adjunto_preparado_{agr_id}"
+    if st.session_state.get(clave) == adjunto["name"]:
+        with open(ruta, "rb") as f:
+            contenedor.download_button(
+                "⬇️ Descargar", data=f, file_name=adjunto["name"], key=f"dl_{agr_id}_{indice}",
+                on_click=lambda: st.session_state.pop(clave, None)
+            )
+    elif contenedor.button("📦 Preparar", key=f"prep_{agr_id}_{indice}",
+                           help=f"{(adjunto.get('size') or os.path.getsize(ruta)) / 1024 / 1024:.2f} MB"):
+        st.session_state[clave] = adjunto["name"]
+        st.rerun()
+
+# ==================== CACHÉ DE REPORTES POR VERSIÓN DE DATOS ====================
+
+class CacheReportes:
+    """
+    Caché en disco de artefactos de reportes (bytes de Excel, ZIP, HTML, CSV...).
+    
+    La clave es (tipo de reporte, filtros, revisión de los datos), donde la revisión
+    se arma con los digests de los acuerdos involucrados: un reporte nunca se sirve
+    desactualizado y editar un acuerdo solo invalida los reportes que lo incluyen.
+    Cuando se supera el tamaño máximo se descartan las entradas menos usadas (LRU).
+    Los artefactos más grandes que max_bytes_entrada no se cachean: desalojarían al
+    resto sin llegar a caber. El último uso de cada lectura se persiste en el índice
+    (a lo sumo una escritura cada INTERVALO_GUARDADO_USO_SEGUNDOS), así el orden LRU
+    sobrevive a un reinicio.
+    """
+    
+    INTERVALO_GUARDADO_USO_SEGUNDOS = 30
+    
+    def __init__(self, carpeta: str = None, max_bytes: int = 200 * 1024 * 1024, max_entradas: int = 500,
+                 max_bytes_entrada: Optional[int] = None):
+        self.carpeta = carpeta or CACHE_REPORTES_DIR
+        self.archivo_indice = os.path.join(self.carpeta, "indice.json")
+        self.max_bytes = max_bytes
+        self.max_bytes_entrada = max_bytes // 4 if max_bytes_entrada is None else max_bytes_entrada
+        self.max_entradas = max_entradas
+        self._lock = threading.RLock()
+        os.makedirs(self.carpeta, exist_ok=True)
+        self.indice: Dict[str, Dict[str, Any]] = load_json(self.archivo_indice, {})
+        self._indice_guardado_en = time.time()
+    
+    @staticmethod
+    def clave(tipo: str, filtros: Dict[str, Any], revision: str) -> str:
+        contenido = json.dumps([tipo, filtros, revision], ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha1(contenido.encode("utf-8")).hexdigest()
+    
+    def _ruta(self, clave: str) -> str:
+        return os.path.join(self.carpeta, f"{clave}.bin")
+    
+    def _guardar_indice(self):
+        save_json(self.archivo_indice, self.indice)
+        self._indice_guardado_en = time.time()
+    
+    def _registrar_uso(self, clave: str):
+        """Marca la entrada como recién usada y persiste el índice si pasó el intervalo"""
+        self.indice[clave]["ultimo_uso"] = time.time()
+        if time.time() - self._indice_guardado_en >= self.INTERVALO_GUARDADO_USO_SEGUNDOS:
+            self._guardar_indice()
+    
+    def _eliminar(self, clave: str):
+        self.indice.pop(clave, None)
+        try:
+            os.remove(self._ruta(clave))
+        except OSError:
+            pass
+    
+    def obtener(self, clave: str) -> Optional[bytes]:
+        with self._lock:
+            entrada = self.indice.get(clave)
+            if entrada is None:
+                return None
+            try:
+                with open(self._ruta(clave), "rb") as f:
+                    datos = f.read()
+            except OSError:
+                self._eliminar(clave)
+                return None
+            self._registrar_uso(clave)
+            return datos
+    
+    @staticmethod
+    def _volcar(datos: Union[bytes, IO[bytes]], ruta: str) -> int:
+        """Escribe bytes o un archivo binario (copiado por bloques) en `ruta` de forma atómica"""
+        with open(ruta + ".tmp", "wb") as f:
+            if isinstance(datos, (bytes, bytearray)):
+                f.write(datos)
+            else:
+                datos.seek(0)
+                shutil.copyfileobj(datos, f, 1024 * 1024)
+            tamaño = f.tell()
+        os.replace(ruta + ".tmp", ruta)
+        return tamaño
+    
+    @staticmethod
+    def _tamaño(datos: Union[bytes, IO[bytes]]) -> int:
+        if isinstance(datos, (bytes, bytearray)):
+            return len(datos)
+        datos.seek(0, os.SEEK_END)
+        return datos.tell()
+    
+    def guardar(self, clave: str, datos: Union[bytes, IO[bytes]], tipo: str, acuerdo_ids: List[str]) -> bool:
+        """Guarda el artefacto; False si supera max_bytes_entrada y no se cachea"""
+        if self._tamaño(datos) > self.max_bytes_entrada:
+            return False
+        with self._lock:
+            tamaño = self._volcar(datos, self._ruta(clave))
+            self.indice[clave] = {
+                "tipo": tipo,
+                "acuerdos": list(acuerdo_ids),
+                "bytes": tamaño,
+                "ultimo_uso": time.time(),
+            }
+            self._desalojar()
+            self._guardar_indice()
+            return True
+    
+    def copiar_a(self, clave: str, ruta_destino: str) -> Optional[int]:
+        """Copia el artefacto cacheado a `ruta_destino` sin cargarlo en memoria; None si no está"""
+        with self._lock:
+            entrada = self.indice.get(clave)
+            if entrada is None:
+                return None
+            try:
+                with open(self._ruta(clave), "rb") as f:
+                    tamaño = self._volcar(f, ruta_destino)
+            except OSError:
+                self._eliminar(clave)
+                return None
+            self._registrar_uso(clave)
+            return tamaño
+    
+    def _desalojar(self):
+        """Descarta las entradas menos recientemente usadas hasta respetar los límites"""
+        total = sum(e.get("bytes", 0) for e in self.indice.values())
+        por_uso = sorted(self.indice.items(), key=lambda kv: kv[1].get("ultimo_uso", 0))
+        while por_uso and (total > self.max_bytes or len(self.indice) > self.max_entradas):
+            clave, entrada = por_uso.pop(0)
+            total -= entrada.get("bytes", 0)
+            self._eliminar(clave)
+    
+    def obtener_o_generar(self, tipo: str, filtros: Dict[str, Any], acuerdo_ids: Iterable[str],
+                          generar: Callable[[], Optional[bytes]], revision: Optional[str] = None) -> Optional[bytes]:
+        """
+        Devuelve el artefacto cacheado o lo genera con `generar()` y lo guarda.
+        
+        Args:
+            tipo: Tipo de reporte ("consolidado", "paquete_completo", ...)
+            filtros: Parámetros que afectan el contenido (año, formato, ...)
+            acuerdo_ids: Acuerdos incluidos; se usan para la revisión y la invalidación
+            generar: Función sin widgets que construye los bytes (o None si no hay datos)
+            revision: Revisión explícita; por defecto la de la tabla plana para esos acuerdos
+        """
+        acuerdo_ids = list(acuerdo_ids)
+        if revision is None:
+            revision = obtener_tabla_plana().revision_de(acuerdo_ids)
+        clave = self.clave(tipo, filtros, revision)
+        
+        datos = self.obtener(clave)
+        if datos is None:
+            datos = generar()
+            if datos is not None:
+                self.guardar(clave, datos, tipo, acuerdo_ids)
+        return datos
+    
+    def volcar_o_generar(self, tipo: str, filtros: Dict[str, Any], acuerdo_ids: Iterable[str],
+                         generar: Callable[[], Optional[Union[bytes, IO[bytes]]]], ruta_destino: str,
+                         revision: Optional[str] = None) -> Optional[int]:
+        """
+        Igual que obtener_o_generar, pero deja el artefacto en `ruta_destino` y devuelve
+        su tamaño. `generar` puede devolver un archivo temporal: se copia por bloques,
+        sin pasar nunca el artefacto completo por memoria.
+        """
+        acuerdo_ids = list(acuerdo_ids)
+        if revision is None:
+            revision = obtener_tabla_plana().revision_de(acuerdo_ids)
+        clave = self.clave(tipo, filtros, revision)
+        
+        tamaño = self.copiar_a(clave, ruta_destino)
+        if tamaño is not None:
+            return tamaño
+        
+        datos = generar()
+        if datos is None:
+            return None
+        try:
+            tamaño = self._volcar(datos, ruta_destino)
+            self.guardar(clave, datos, tipo, acuerdo_ids)
+        finally:
+            if hasattr(datos, "close"):
+                datos.close()
+        return tamaño
+    
+    def abrir_o_generar(self, tipo: str, filtros: Dict[str, Any], acuerdo_ids: Iterable[str],
+                        generar: Callable[[], Optional[Union[bytes, IO[bytes]]]],
+                        revision: Optional[str] = None) -> Optional[IO[bytes]]:
+        """
+        Igual que obtener_o_generar, pero devuelve el artefacto abierto para lectura
+        (quien lo recibe lo cierra). El resultado de `generar` se vuelca a la caché por
+        bloques y se sirve desde ahí; si es demasiado grande para cachearse se
+        devuelve el propio archivo generado, rebobinado.
+        """
+        acuerdo_ids = list(acuerdo_ids)
+        if revision is None:
+            revision = obtener_tabla_plana().revision_de(acuerdo_ids)
+        clave = self.clave(tipo, filtros, revision)
+        
+        datos = None
+        with self._lock:
+            cacheado = clave in self.indice
+        if not cacheado:
+            datos = generar()
+            if datos is None:
+                return None
+            if isinstance(datos, (bytes, bytearray)):
+                datos = io.BytesIO(datos)
+            self.guardar(clave, datos, tipo, acuerdo_ids)
+        
+        archivo = self._abrir(clave)
+        if datos is None:
+            return archivo
+        if archivo is None:  # no se cacheó (o se desalojó mientras tanto): se sirve lo generado
+            datos.seek(0)
+            return datos
+        datos.close()
+        return archivo
+    
+    def _abrir(self, clave: str) -> Optional[IO[bytes]]:
+        with self._lock:
+            if clave not in self.indice:
+                return None
+            try:
+                archivo = open(self._ruta(clave), "rb")
+            except OSError:
+                self._eliminar(clave)
+                return None
+            self._registrar_uso(clave)
+            return archivo
+    
+    def invalidar(self, acuerdo_ids: Iterable[str]) -> int:
+        """Elimina las entradas que incluyen alguno de los acuerdos indicados"""
+        ids = set(acuerdo_ids)
+        if not ids:
+            return 0
+        with self._lock:
+            claves = [c for c, e in self.indice.items() if ids.intersection(e.get("acuerdos", []))]
+            for clave in claves:
+                self._eliminar(clave)
+            if claves:
+                self._guardar_indice()
+            return len(claves)
+    
+    def limpiar(self):
+        with self._lock:
+            for clave in list(self.indice):
+                self._eliminar(clave)
+            self._guardar_indice()
+
+@st.cache_resource(show_spinner=False)
+def obtener_cache_reportes() -> CacheReportes:
+    """Instancia compartida de la caché de reportes"""
+    return CacheReportes()
+
+# ==================== COLA DE TRABAJOS DE REPORTES ====================
+
+# Tipos de reporte que se generan en segundo plano.
+# "construir" recibe (acuerdos, filtros, progreso) y devuelve bytes (o un archivo
+# temporal binario) sin usar widgets.
+TIPOS_TRABAJO_REPORTE = {
+    "consolidado": {
+        "titulo": "Reporte consolidado (Excel)",
+        "extension": "xlsx",
+        "mime": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        "construir": lambda acuerdos, filtros, progreso: construir_reporte_consolidado(acuerdos, filtros["año"]),
+    },
+    "paquete_completo": {
+        "titulo": "Paquete completo (ZIP)",
+        "extension": "zip",
+        "mime": "application/zip",
+        "construir": lambda acuerdos, filtros, progreso: construir_paquete_completo(
+            acuerdos, filtros["año"], progreso, incluir_adjuntos=filtros.get("adjuntos", False)),
+    },
+    "pdf_consolidado": {
+        "titulo": "Reporte consolidado (PDF)",
+        "extension": "pdf",
+        "mime": "application/pdf",
+        "construir": lambda acuerdos, filtros, progreso: construir_pdf_consolidado(
+            acuerdos, filtros["año"], filtros.get("organismo")),
+    },
+    "lote_pdf_acuerdos": {
+        "titulo": "PDF por acuerdo (ZIP)",
+        "extension": "zip",
+        "mime": "application/zip",
+        "construir": lambda acuerdos, filtros, progreso: construir_lote_pdf_acuerdos(acuerdos, filtros["año"], progreso),
+    },
+    "informe_resumen": {
+        "titulo": "Informe resumido (HTML)",
+        "extension": "html",
+        "mime": "text/html",
+        "construir": lambda acuerdos, filtros, progreso: render_html(
+            _fragmentos_informe_resumen(acuerdos, filtros["año"], filtros.get("organismo"))).encode("utf-8"),
+    },
+    "informe_detalle": {
+        "titulo": "Informe completo (HTML)",
+        "extension": "html",
+        "mime": "text/html",
+        "construir": lambda acuerdos, filtros, progreso: render_html(
+            _fragmentos_informe_detalle(acuerdos, filtros["año"])).encode("utf-8"),
+    },
+}
+
+ESTADOS_TRABAJO_ACTIVOS = ("en_cola", "ejecutando")
+ICONOS_ESTADO_TRABAJO = {"en_cola": "⏳", "ejecutando": "⚙️", "completado": "✅", "error": "❌"}
+
+class ColaTrabajosReportes:
+    """
+    Cola local de generación de reportes sobre un pool de hilos.
+    
+    Cada trabajo guarda su estado y progreso en TRABAJOS_DIR/trabajos.json y su
+    artefacto en TRABAJOS_DIR, de modo que el usuario puede irse y volver a
+    descargarlo mientras no venza la retención. Dos pedidos idénticos (mismo tipo,
+    filtros y revisión de datos) comparten el mismo trabajo.
+    """
+    
+    def __init__(self, carpeta: str = None, max_workers: int = 2, retencion_horas: int = None):
+        self.carpeta = carpeta or TRABAJOS_DIR
+        self.archivo_indice = os.path.join(self.carpeta, "trabajos.json")
+        self.retencion_segundos = (retencion_horas or RETENCION_TRABAJOS_HORAS) * 3600
+        self._lock = threading.RLock()
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="reportes")
+        self._futuros: Dict[str, Future] = {}
+        os.makedirs(self.carpeta, exist_ok=True)
+        
+        self.trabajos: Dict[str, Dict[str, Any]] = self._leer_indice()
+        for trabajo in self.trabajos.values():
+            if trabajo.get("estado") in ESTADOS_TRABAJO_ACTIVOS:
+                trabajo.update(estado="error", error="Interrumpido por reinicio del servidor",
+                               finalizado=time.time())
+        self.purgar_vencidos()
+    
+    # ---------- persistencia (sin widgets: se usa desde los hilos del pool) ----------
+    def _leer_indice(self) -> Dict[str, Dict[str, Any]]:
+        try:
+            with open(self.archivo_indice, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+    
+    def _escribir_indice(self):
+        tmp = self.archivo_indice + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.trabajos, f, ensure_ascii=False, indent=2, default=str)
+        os.replace(tmp, self.archivo_indice)
+    
+    def _actualizar(self, trabajo_id: str, persistir: bool = True, **campos):
+        with self._lock:
+            trabajo = self.trabajos.get(trabajo_id)
+            if trabajo is None:
+                return
+            trabajo.update(campos)
+            if persistir:
+                self._escribir_indice()
+    
+    # ---------- API ----------
+    def encolar(self, tipo: str, filtros: Dict[str, Any], acuerdos: List[Dict[str, Any]],
+                usuario: str) -> Dict[str, Any]:
+        """
+        Encola un reporte (o devuelve el trabajo equivalente ya existente).
+        
+        Args:
+            tipo: Clave de TIPOS_TRABAJO_REPORTE
+            filtros: Parámetros del reporte (año, organismo...)
+            acuerdos: Acuerdos incluidos
+            usuario: Usuario que lo solicita
+        """
+        definicion = TIPOS_TRABAJO_REPORTE[tipo]
+        acuerdo_ids = [agr["id"] for agr in acuerdos]
+        revision = obtener_tabla_plana().revision_de(acuerdo_ids)
+        clave = CacheReportes.clave(tipo, filtros, revision)
+        cache = obtener_cache_reportes()
+        
+        with self._lock:
+            self.purgar_vencidos()
+            for trabajo in self.trabajos.values():
+                if trabajo["clave"] != clave:
+                    continue
+                if trabajo["estado"] in ESTADOS_TRABAJO_ACTIVOS:
+                    return trabajo
+                if trabajo["estado"] == "completado" and os.path.exists(trabajo.get("archivo") or ""):
+                    return trabajo
+            
+            trabajo_id = gen_uuid("JOB")
+            trabajo = {
+                "id": trabajo_id,
+                "tipo": tipo,
+                "titulo": definicion["titulo"],
+                "filtros": filtros,
+                "acuerdos": acuerdo_ids,
+                "clave": clave,
+                "usuario": usuario,
+                "estado": "en_cola",
+                "progreso": 0.0,
+                "mensaje": "En cola",
+                "creado": time.time(),
+                "finalizado": None,
+                "archivo": None,
+                "nombre_descarga": f"{tipo}_{filtros.get('año', '')}_{trabajo_id[-6:]}.{definicion['extension']}",
+                "mime": definicion["mime"],
+                "error": None,
+            }
+            self.trabajos[trabajo_id] = trabajo
+            self._escribir_indice()
+            self._futuros[trabajo_id] = self._pool.submit(self._ejecutar, trabajo_id, acuerdos, revision, cache)
+            return trabajo
     
-    if total_ponderacion > 0 and metas_con_datos > 0:
-        return total_ponderado / total_ponderacion
-    return None
-
-def calcular_metricas_globales(acuerdos: List[Dict[str, Any]]) -> Dict[str, Any]:
-    """Calcula métricas globales usando rangos configurables por meta"""
-    total_acuerdos = len(acuerdos)
-    total_metas = 0
-    metas_cumplidas = 0
-    metas_parciales = 0
-    metas_no_cumplidas = 0
-    cumplimientos = []
+    def _ejecutar(self, trabajo_id: str, acuerdos: List[Dict[str, Any]], revision: str, cache: "CacheReportes"):
+        trabajo = self.trabajos[trabajo_id]
+        definicion = TIPOS_TRABAJO_REPORTE[trabajo["tipo"]]
+        self._actualizar(trabajo_id, estado="ejecutando", progreso=0.05, mensaje="Generando...")
+        
+        def progreso(fraccion: float, mensaje: str = ""):
+            self._actualizar(trabajo_id, persistir=False, progreso=max(0.05, min(fraccion, 0.99)),
+                             mensaje=mensaje or trabajo.get("mensaje", ""))
+        
+        try:
+            archivo = os.path.join(self.carpeta, f"{trabajo_id}.{definicion['extension']}")
+            tamaño = cache.volcar_o_generar(
+                trabajo["tipo"], trabajo["filtros"], trabajo["acuerdos"],
+                lambda: definicion["construir"](acuerdos, trabajo["filtros"], progreso),
+                archivo, revision=revision
+            )
+            if tamaño is None:
+                raise ValueError("No hay datos para generar el reporte")
+            
+            self._actualizar(trabajo_id, estado="completado", progreso=1.0, mensaje="Listo",
+                             archivo=archivo, bytes=tamaño, finalizado=time.time())
+        except Exception as e:
+            self._actualizar(trabajo_id, estado="error", mensaje="Error", error=str(e), finalizado=time.time())
+        finally:
+            with self._lock:
+                self._futuros.pop(trabajo_id, None)
+    
+    def esperar(self, trabajo_id: str, segundos: float) -> Optional[Dict[str, Any]]:
+        """Espera hasta `segundos` a que termine el trabajo (útil para reportes chicos)"""
+        futuro = self._futuros.get(trabajo_id)
+        if futuro is not None:
+            try:
+                futuro.result(timeout=segundos)
+            except Exception:
+                pass
+        return self.trabajos.get(trabajo_id)
+    
+    def listar(self, usuario: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Trabajos (más recientes primero), opcionalmente solo los de un usuario"""
+        with self._lock:
+            trabajos = [dict(t) for t in self.trabajos.values() if usuario is None or t.get("usuario") == usuario]
+        return sorted(trabajos, key=lambda t: t.get("creado", 0), reverse=True)
+    
+    def abrir_artefacto(self, trabajo_id: str) -> Optional[IO[bytes]]:
+        """Archivo generado por el trabajo, abierto para lectura (quien lo recibe lo cierra)"""
+        trabajo = self.trabajos.get(trabajo_id)
+        if not trabajo or trabajo.get("estado") != "completado":
+            return None
+        try:
+            return open(trabajo["archivo"], "rb")
+        except OSError:
+            return None
     
-    if not acuerdos:
-        return {
-            'total_acuerdos': 0,
-            'total_metas': 0,
-            'metas_cumplidas': 0,
-            'metas_parciales': 0,
-            'metas_no_cumplidas': 0,
-            'porcentaje_cumplidas': 0,
-            'porcentaje_parciales': 0,
-            'porcentaje_no_cumplidas': 0,
-            'cumplimiento_promedio': 0
-        }
+    def eliminar(self, trabajo_id: str):
+        with self._lock:
+            trabajo = self.trabajos.get(trabajo_id)
+            if not trabajo or trabajo.get("estado") in ESTADOS_TRABAJO_ACTIVOS:
+                return
+            if trabajo.get("archivo"):
+                try:
+                    os.remove(trabajo["archivo"])
+                except OSError:
+                    pass
+            del self.trabajos[trabajo_id]
+            self._escribir_indice()
+    
+    def purgar_vencidos(self):
+        """Elimina trabajos terminados (y sus archivos) que superaron la retención"""
+        limite = time.time() - self.retencion_segundos
+        with self._lock:
+            vencidos = [
+                t["id"] for t in self.trabajos.values()
+                if t.get("estado") not in ESTADOS_TRABAJO_ACTIVOS and (t.get("finalizado") or 0) < limite
+            ]
+            for trabajo_id in vencidos:
+                self.eliminar(trabajo_id)
+
+@st.cache_resource(show_spinner=False)
+def obtener_cola_reportes() -> ColaTrabajosReportes:
+    """Cola de trabajos compartida por todas las sesiones"""
+    return ColaTrabajosReportes()
+
+def encolar_reporte(tipo: str, filtros: Dict[str, Any], acuerdos: List[Dict[str, Any]], espera_segundos: float = 3):
+    """
+    Encola un reporte y, si termina en pocos segundos, ofrece la descarga en el momento.
+    Si no, informa que puede descargarse luego desde el panel de trabajos.
+    """
+    cola = obtener_cola_reportes()
+    trabajo = cola.encolar(tipo, filtros, acuerdos, st.session_state.user["username"])
+    trabajo = cola.esperar(trabajo["id"], espera_segundos) or trabajo
     
-    for agr in acuerdos:
-        # Contar metas y clasificar por cumplimiento
-        for ficha in agr.get("fichas", []):
-            for meta in ficha.get("metas", []):
-                total_metas += 1
-                
-                # 🆕 CLASIFICACIÓN FLEXIBLE (REEMPLAZA LOS RANGOS FIJOS)
-                clasificacion = clasificar_cumplimiento_meta(meta)
-                
-                if clasificacion == "cumplida":
-                    metas_cumplidas += 1
-                elif clasificacion == "parcial":
-                    metas_parciales += 1
+    archivo = cola.abrir_artefacto(trabajo["id"]) if trabajo["estado"] == "completado" else None
+    if archivo is not None:
+        with archivo:
+            st.download_button(
+                f"📥 Descargar {trabajo['titulo']}",
+                data=archivo,
+                file_name=trabajo["nombre_descarga"],
+                mime=trabajo["mime"],
+                key=f"dl_inmediato_{trabajo['id']}"
+            )
+    elif trabajo["estado"] == "error":
+        st.warning(f"⚠️ {trabajo['error']}")
+    else:
+        st.info(f"⏳ {trabajo['titulo']} en preparación. Puede seguir trabajando y descargarlo "
+                f"desde **🗂️ Trabajos de Reportes**.")
+    return trabajo
+
+def mostrar_panel_trabajos_reportes():
+    """Panel con el estado, progreso y descarga de los reportes en segundo plano"""
+    cola = obtener_cola_reportes()
+    usuario = st.session_state.user
+    trabajos = cola.listar(None if usuario.get("role") == "Administrador" else usuario["username"])
+    
+    with st.expander(f"🗂️ Trabajos de Reportes ({len(trabajos)})", expanded=any(
+            t["estado"] in ESTADOS_TRABAJO_ACTIVOS for t in trabajos)):
+        if not trabajos:
+            st.caption("No hay trabajos recientes.")
+            return
+        
+        if st.button("🔄 Actualizar estado", key="refrescar_trabajos"):
+            st.rerun()
+        
+        preparado = st.session_state.get("trabajo_preparado")
+        for trabajo in trabajos[:20]:
+            col_t1, col_t2, col_t3 = st.columns([3, 2, 1])
+            with col_t1:
+                creado = datetime.fromtimestamp(trabajo["creado"]).strftime('%d/%m/%Y %H:%M')
+                st.write(f"{ICONOS_ESTADO_TRABAJO.get(trabajo['estado'], '')} **{trabajo['titulo']}** "
+                         f"· {trabajo['filtros'].get('año', '')} · {len(trabajo['acuerdos'])} acuerdos · {creado}")
+            with col_t2:
+                if trabajo["estado"] in ESTADOS_TRABAJO_ACTIVOS:
+                    st.progress(float(trabajo.get("progreso", 0)), text=trabajo.get("mensaje", ""))
+                elif trabajo["estado"] == "completado":
+                    # 🆕 Solo se abre el archivo del trabajo que el usuario prepara
+                    archivo = cola.abrir_artefacto(trabajo["id"]) if preparado == trabajo["id"] else None
+                    if archivo is not None:
+                        with archivo:
+                            st.download_button(
+                                "⬇️ Descargar",
+                                data=archivo,
+                                file_name=trabajo["nombre_descarga"],
+                                mime=trabajo["mime"],
+                                key=f"dl_trabajo_{trabajo['id']}",
+                                on_click=lambda: st.session_state.pop("trabajo_preparado", None)
+                            )
+                    elif st.button("📦 Preparar", key=f"prep_trabajo_{trabajo['id']}"):
+                        st.session_state["trabajo_preparado"] = trabajo["id"]
+                        st.rerun()
                 else:
-                    metas_no_cumplidas += 1
+                    st.error(trabajo.get("error") or "Error")
+            with col_t3:
+                if trabajo["estado"] not in ESTADOS_TRABAJO_ACTIVOS:
+                    if st.button("🗑️", key=f"del_trabajo_{trabajo['id']}", help="Eliminar trabajo"):
+                        cola.eliminar(trabajo["id"])
+                        st.rerun()
         
-        # Calcular cumplimiento del acuerdo
-        cumplimiento_acuerdo = calcular_cumplimiento_acuerdo(agr)
-        if cumplimiento_acuerdo is not None:
-            cumplimientos.append(cumplimiento_acuerdo)
+        st.caption(f"Los archivos generados se conservan {RETENCION_TRABAJOS_HORAS} horas.")
+
+def _texto_cumplimiento(valor: Any) -> str:
+    """Formato '85.0%' o 'No calculado' usado por los reportes"""
+    return f"{valor:.1f}%" if valor and pd.notna(valor) else "No calculado"
+
+def metricas_desde_tabla(df: pd.DataFrame, total_acuerdos: int) -> Dict[str, Any]:
+    """Mismo resultado que calcular_metricas_globales, calculado sobre la tabla plana"""
+    total_metas = len(df)
+    conteo = df["clasificacion"].value_counts() if total_metas else pd.Series(dtype=int)
+    metas_cumplidas = int(conteo.get("cumplida", 0))
+    metas_parciales = int(conteo.get("parcial", 0))
+    metas_no_cumplidas = total_metas - metas_cumplidas - metas_parciales
     
-    # 🆕 CÁLCULO SEGURO DEL PROMEDIO
-    cumplimiento_promedio = sum(cumplimientos) / len(cumplimientos) if cumplimientos else 0
+    por_acuerdo = df.drop_duplicates("acuerdo_id")["cumplimiento_acuerdo"].dropna() if total_metas else pd.Series(dtype=float)
+    cumplimiento_promedio = float(por_acuerdo.mean()) if not por_acuerdo.empty else 0
     
     return {
         'total_acuerdos': total_acuerdos,
@@ -4636,193 +8207,609 @@ def calcular_metricas_globales(acuerdos: List[Dict[str, Any]]) -> Dict[str, Any]
         'cumplimiento_promedio': cumplimiento_promedio
     }
 
-@st.cache_data(ttl=60, show_spinner=False)
-def generar_reporte_consolidado(acuerdos: List[Dict[str, Any]], año: int):
-    """Genera un reporte consolidado de todos los acuerdos"""
-    with st.spinner("Generando reporte consolidado..."):
-        # Crear datos para Excel
-        datos_excel = []
-        
-        for agr in acuerdos:
-            cumplimiento = calcular_cumplimiento_acuerdo(agr)
-            
-            for ficha in agr.get("fichas", []):
-                for meta in ficha.get("metas", []):
-                    datos_excel.append({
-                        'Año': año,
-                        'Acuerdo': agr.get('id'),
-                        'Organismo': agr.get('organismo_nombre'),
-                        'Tipo': agr.get('tipo_compromiso'),
-                        'Estado': agr.get('estado'),
-                        'Ficha': ficha.get('id'),
-                        'Meta': meta.get('descripcion'),
-                        'Ponderación': meta.get('ponderacion', 0),
-                        'Cumplimiento': meta.get('cumplimiento_calc', 'No calculado'),
-                        'Cumplimiento Acuerdo': f"{cumplimiento:.1f}%" if cumplimiento else "No calculado"
-                    })
-        
-        if datos_excel:
-            df = pd.DataFrame(datos_excel)
-            
-            # Crear archivo Excel
-            output = io.BytesIO()
-            with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-                df.to_excel(writer, sheet_name='Reporte Consolidado', index=False)
-                
-                # Formato
-                workbook = writer.book
-                worksheet = writer.sheets['Reporte Consolidado']
-                format_header = workbook.add_format({'bold': True, 'bg_color': '#007BFF', 'color': 'white'})
-                
-                for col_num, value in enumerate(df.columns.values):
-                    worksheet.write(0, col_num, value, format_header)
+# Extensiones que ya vienen comprimidas: se guardan en el ZIP sin recomprimir
+EXTENSIONES_SIN_RECOMPRIMIR = {
+    ".zip", ".gz", ".7z", ".rar", ".xlsx", ".docx", ".pptx", ".odt", ".ods",
+    ".pdf", ".png", ".jpg", ".jpeg", ".gif", ".webp", ".mp4", ".mp3",
+}
+
+def _adjuntos_en_disco(agr: Dict[str, Any]) -> Iterator[tuple]:
+    """(nombre, ruta) de los adjuntos del acuerdo que existen en disco (orden estable)"""
+    almacen = obtener_almacen_adjuntos()
+    for adjunto in sorted(adjuntos_acuerdo(agr), key=lambda a: a.get("name", "")):
+        ruta = almacen.ruta_de(adjunto)
+        if os.path.isfile(ruta):
+            yield adjunto["name"], ruta
+
+def construir_paquete_completo(acuerdos, año, progreso: Optional[Callable[[float, str], None]] = None,
+                               incluir_adjuntos: bool = False,
+                               nivel_compresion: int = NIVEL_COMPRESION_ZIP) -> IO[bytes]:
+    """
+    Construye el ZIP con el Excel consolidado, los JSON de cada acuerdo, el resumen y,
+    opcionalmente, los adjuntos de cada acuerdo.
+    
+    Las entradas se escriben de a una en un archivo temporal (en memoria hasta
+    UMBRAL_SPOOL_BYTES, luego en disco), así que la memoria pico no depende del
+    tamaño del paquete. Devuelve el archivo rebobinado; quien lo recibe lo cierra.
+    """
+    salida = tempfile.SpooledTemporaryFile(max_size=UMBRAL_SPOOL_BYTES, prefix="paquete_cg_", suffix=".zip")
+    
+    with zipfile.ZipFile(salida, mode='w', compression=zipfile.ZIP_DEFLATED,
+                         compresslevel=nivel_compresion) as zf:
+        # 1. Reporte consolidado Excel (en streaming desde la tabla plana materializada)
+        cumplimientos: Dict[str, Any] = {}
+        
+        def filas_tabla():
+            for fila in obtener_tabla_plana().iterar_filas(agr["id"] for agr in acuerdos):
+                cumplimientos.setdefault(fila["acuerdo_id"], fila["cumplimiento_acuerdo"])
+                yield fila
+        
+        with tempfile.SpooledTemporaryFile(max_size=UMBRAL_SPOOL_BYTES) as excel_tmp:
+            total_metas = escribir_excel_streaming(filas_tabla(), COLUMNAS_EXCEL_PAQUETE, excel_tmp,
+                                                   titulo_hoja="Reporte_Consolidado")
+            if total_metas:
+                excel_tmp.seek(0)
+                # El xlsx ya es un ZIP: se guarda tal cual
+                info = zipfile.ZipInfo(f"reporte_consolidado_{año}.xlsx",
+                                       date_time=datetime.now().timetuple()[:6])
+                info.compress_type = zipfile.ZIP_STORED
+                with zf.open(info, "w") as destino:
+                    shutil.copyfileobj(excel_tmp, destino, 1024 * 1024)
+        if progreso:
+            progreso(0.3, "Reporte consolidado listo")
+        
+        # 2. Reportes individuales en JSON (+ adjuntos)
+        total_adjuntos = 0
+        for i, agr in enumerate(acuerdos, 1):
+            with zf.open(f"{agr['id']}_completo.json", "w") as destino:
+                with io.TextIOWrapper(destino, encoding="utf-8") as texto:
+                    json.dump(agr, texto, ensure_ascii=False, indent=2, default=str)
             
-            output.seek(0)
+            if incluir_adjuntos:
+                for nombre, ruta in _adjuntos_en_disco(agr):
+                    extension = os.path.splitext(nombre)[1].lower()
+                    zf.write(ruta, f"adjuntos/{agr['id']}/{nombre}",
+                             compress_type=zipfile.ZIP_STORED if extension in EXTENSIONES_SIN_RECOMPRIMIR else None)
+                    total_adjuntos += 1
             
-            st.download_button(
-                "📥 Descargar Reporte Consolidado (Excel)",
-                data=output.getvalue(),
-                file_name=f"reporte_consolidado_{año}.xlsx",
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-            )
-        else:
-            st.warning("No hay datos para generar el reporte")
-
-def mostrar_vista_imprimible(acuerdos: List[Dict[str, Any]], año: int):
-    """Muestra una vista optimizada para impresión"""
-    st.info("🔍 **Vista para Imprimir** - Use Ctrl+P en su navegador para imprimir")
+            if progreso:
+                progreso(0.3 + 0.6 * i / len(acuerdos), f"Acuerdo {i} de {len(acuerdos)}")
+        
+        # 3. Archivo de resumen
+        resumen = f"""RESUMEN DE REPORTES - AÑO {año}
+Fecha de generación: {datetime.now().strftime('%d/%m/%Y %H:%M')}
+Total acuerdos: {len(acuerdos)}
+Total fichas: {sum(len(agr.get('fichas', [])) for agr in acuerdos)}
+Total metas: {total_metas}
+"""
+        if incluir_adjuntos:
+            resumen += f"Total adjuntos: {total_adjuntos}\n"
+        resumen += "\nAcuerdos incluidos:\n"
+        for agr in acuerdos:
+            cumplimiento = cumplimientos.get(agr['id'])
+            resumen += f"- {agr['id']}: {agr.get('organismo_nombre')} (Cumplimiento: {_texto_cumplimiento(cumplimiento)})\n"
+        
+        zf.writestr("RESUMEN.txt", resumen)
+    
+    salida.seek(0)
+    return salida
+
+def exportar_reportes_completos(acuerdos, año, incluir_adjuntos: bool = False):
+    """Exporta todos los reportes en un paquete ZIP (se genera en segundo plano)"""
+    filtros = {"año": año, "adjuntos": incluir_adjuntos}
+    if incluir_adjuntos:
+        # los adjuntos no forman parte del documento del acuerdo: su huella entra en la clave de caché
+        filtros["huella_adjuntos"] = huella_adjuntos(a for agr in acuerdos for a in adjuntos_acuerdo(agr))
+    encolar_reporte("paquete_completo", filtros, acuerdos)
+
+# ==================== EXPORTACIÓN COLUMNAR (PARQUET / ARROW) ====================
+
+# "diccionarios": los strings repetidos se codifican como diccionario. Un archivo Arrow
+# IPC admite un solo diccionario por campo y cada RecordBatch arma el suyo, así que
+# con más de un lote por partición la escritura fallaría: en IPC van como string.
+FORMATOS_COLUMNARES = {
+    "Parquet": {"formato": "parquet", "extension": "parquet", "diccionarios": True},
+    "Arrow IPC": {"formato": "ipc", "extension": "arrow", "diccionarios": False},
+}
+
+def _esquema_tabla_columnar(diccionarios: bool = True):
+    """Esquema Arrow de la tabla plana (tipos explícitos; strings repetidos como diccionario si se pide)"""
+    import pyarrow as pa
+    
+    categoria = pa.dictionary(pa.int32(), pa.string()) if diccionarios else pa.string()
+    return pa.schema([
+        ("año", pa.int32()),
+        ("acuerdo_id", pa.string()),
+        ("organismo_nombre", categoria),
+        ("organismo_tipo", categoria),
+        ("tipo_compromiso", categoria),
+        ("estado", categoria),
+        ("ficha_id", pa.string()),
+        ("ficha_nombre", pa.string()),
+        ("tipo_meta", categoria),
+        ("meta_id", pa.string()),
+        ("meta_numero", pa.int32()),
+        ("meta_descripcion", pa.string()),
+        ("estado_meta", categoria),
+        ("unidad", categoria),
+        ("sentido", categoria),
+        ("frecuencia", categoria),
+        ("vencimiento", pa.date32()),
+        ("periodo_label", categoria),
+        ("es_hito", pa.bool_()),
+        ("valor_objetivo", pa.float64()),
+        ("ponderacion", pa.float64()),
+        ("cumplimiento_valor", pa.float64()),
+        ("cumplimiento_meta", pa.float64()),
+        ("clasificacion", categoria),
+        ("cumplimiento_acuerdo", pa.float64()),
+        ("rangos", pa.list_(pa.struct([
+            ("min", pa.float64()),
+            ("max", pa.float64()),
+            ("porcentaje", pa.float64()),
+        ]))),
+    ])
+
+def _fila_para_arrow(fila: Dict[str, Any]) -> Dict[str, Any]:
+    """Normaliza los valores de una fila plana a los tipos del esquema Arrow"""
+    fila = dict(fila)
+    try:
+        fila["año"] = int(fila["año"]) if fila.get("año") is not None else None
+    except (ValueError, TypeError):
+        fila["año"] = None
+    try:
+        fila["meta_numero"] = int(fila["meta_numero"]) if fila.get("meta_numero") is not None else None
+    except (ValueError, TypeError):
+        fila["meta_numero"] = None
+    fila["vencimiento"] = dt_parse(fila.get("vencimiento") or "")
+    return fila
+
+def _lotes_arrow(filas: Iterable[Dict[str, Any]], esquema, filas_por_lote: int):
+    """Agrupa filas planas en RecordBatch de tamaño fijo"""
+    import pyarrow as pa
+    
+    lote = []
+    for fila in filas:
+        lote.append(_fila_para_arrow(fila))
+        if len(lote) >= filas_por_lote:
+            yield pa.RecordBatch.from_pylist(lote, schema=esquema)
+            lote = []
+    if lote:
+        yield pa.RecordBatch.from_pylist(lote, schema=esquema)
+
+def exportar_tabla_columnar(acuerdos: Iterable[Dict[str, Any]], destino: Optional[str] = None,
+                            formato: str = "Parquet", filas_por_lote: int = 10000) -> str:
+    """
+    🗃️ Escribe la tabla plana acuerdo/ficha/meta/rango como dataset Parquet o Arrow IPC
+    particionado por año (estilo hive: año=2025/...).
     
-    for agr in acuerdos:
-        st.markdown("---")
-        st.header(f"ACUERDO: {agr.get('id')}")
-        st.subheader(f"Organismo: {agr.get('organismo_nombre')}")
+    Lee las filas de la tabla plana materializada (la misma que usa
+    exportar_reportes_completos) y escribe por lotes.
+    
+    Args:
+        acuerdos: Iterable de acuerdos a exportar
+        destino: Carpeta del dataset; si es None se crea una temporal
+        formato: "Parquet" o "Arrow IPC"
+        filas_por_lote: Tamaño de cada RecordBatch
         
-        cumplimiento = calcular_cumplimiento_acuerdo(agr)
-        if cumplimiento:
-            st.metric("**Cumplimiento Ponderado Total**", f"{cumplimiento:.1f}%")
+    Returns:
+        str: Carpeta raíz del dataset escrito
         
-        # Mostrar fichas y metas
-        for ficha in agr.get("fichas", []):
-            with st.expander(f"FICHA: {ficha.get('id')} - {ficha.get('nombre')}", expanded=True):
-                for meta in ficha.get("metas", []):
-                    col_meta1, col_meta2, col_meta3 = st.columns([3, 1, 1])
-                    with col_meta1:
-                        st.write(f"**Meta {meta.get('numero')}:** {meta.get('descripcion')}")
-                    with col_meta2:
-                        st.write(f"Ponderación: {meta.get('ponderacion')}%")
-                    with col_meta3:
-                        cumplimiento_meta = meta.get('cumplimiento_calc', 'No calc.')
-                        st.write(f"Cumplimiento: {cumplimiento_meta}%")
+    Raises:
+        ImportError: Si pyarrow no está instalado
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    
+    config = FORMATOS_COLUMNARES[formato]
+    esquema = _esquema_tabla_columnar(config["diccionarios"])
+    if destino is None:
+        destino = tempfile.mkdtemp(prefix="export_cg_columnar_")
+    
+    ds.write_dataset(
+        _lotes_arrow(obtener_tabla_plana().iterar_filas(agr["id"] for agr in acuerdos), esquema, filas_por_lote),
+        destino,
+        schema=esquema,
+        format=config["formato"],
+        partitioning=ds.partitioning(pa.schema([("año", pa.int32())]), flavor="hive"),
+        basename_template="metas-{i}." + config["extension"],
+        existing_data_behavior="overwrite_or_ignore",
+    )
+    return destino
+
+def empaquetar_carpeta_zip(carpeta: str) -> str:
+    """Empaqueta una carpeta en un ZIP temporal (sin recomprimir) y devuelve su ruta"""
+    fd, ruta_zip = tempfile.mkstemp(prefix="export_cg_", suffix=".zip")
+    os.close(fd)
+    with zipfile.ZipFile(ruta_zip, mode="w", compression=zipfile.ZIP_STORED) as zf:
+        for dirpath, dirnames, filenames in os.walk(carpeta):
+            for nombre in filenames:
+                ruta = os.path.join(dirpath, nombre)
+                zf.write(ruta, os.path.relpath(ruta, carpeta))
+    return ruta_zip
+
+# En la caché el HTML imprimible lleva esta marca en lugar de la fecha de generación,
+# que se pone al servirlo (si no, se mostraría la fecha en que se cacheó)
+MARCA_FECHA_GENERACION = "<!--fecha_generacion-->"
+
+def html_imprimible_cacheado(agr: Dict[str, Any]) -> bytes:
+    """HTML imprimible de un acuerdo (bytes utf-8), cacheado por contenido del acuerdo"""
+    datos = obtener_cache_reportes().obtener_o_generar(
+        "html_imprimible", {"fecha": "al_servir"}, [agr["id"]],
+        lambda: exportar_html_imprimible(agr, generado=MARCA_FECHA_GENERACION).encode('utf-8'),
+        revision=digest_acuerdo(agr)
+    )
+    return datos.replace(MARCA_FECHA_GENERACION.encode('utf-8'),
+                         datetime.now().strftime('%d/%m/%Y %H:%M').encode('utf-8'))
 
-def calcular_todos_los_cumplimientos(acuerdos: List[Dict[str, Any]]):
-    """Calcula los cumplimientos de todas las metas"""
-    with st.spinner("Calculando cumplimientos..."):
-        total_calculadas = 0
-        for agr in acuerdos:
-            for ficha in agr.get("fichas", []):
-                for meta in ficha.get("metas", []):
-                    if meta.get("cumplimiento_valor"):
-                        meta["cumplimiento_calc"] = calcular_cumplimiento(meta)
-                        if meta["cumplimiento_calc"] is not None:
-                            total_calculadas += 1
-        
-        st.success(f"✅ Se calcularon {total_calculadas} cumplimientos")
+# ==================== RENDERIZADO PDF (fpdf2) ====================
 
-@st.cache_data(ttl=60, show_spinner=False)
-def generar_informe_personalizado(db, año, organismo_filter, tipos_seleccionados, formato, incluir_metricas, incluir_detalles):
-    """Genera un informe personalizado según los filtros especificados"""
-    with st.spinner("Generando informe personalizado..."):
-        # Filtrar acuerdos
-        acuerdos_filtrados = []
-        for agr in db.values():
-            if agr.get("año") != año:
-                continue
-            if agr.get("tipo_compromiso") not in tipos_seleccionados:
-                continue
-            if organismo_filter and organismo_filter.strip().lower() not in (agr.get("organismo_nombre", "") or "").lower():
-                continue
-            acuerdos_filtrados.append(agr)
-        
-        if not acuerdos_filtrados:
-            st.warning("No hay acuerdos que coincidan con los filtros seleccionados.")
-            return
-        
-        # Generar según formato
-        if formato == "PDF":
-            generar_pdf_informe(acuerdos_filtrados, año, organismo_filter)
-        elif formato == "Excel":
-            generar_excel_informe(acuerdos_filtrados, año)
-        elif formato == "HTML":
-            generar_html_informe(acuerdos_filtrados, año)
-        else:  # Pantalla
-            mostrar_informe_pantalla(acuerdos_filtrados, año, incluir_metricas, incluir_detalles)
+# Fuentes TrueType con soporte Unicode (se usa el primer par que exista). Sin
+# ninguna se usa Helvetica y el texto se reduce a latin-1.
+FUENTES_PDF = [
+    ("fonts/DejaVuSans.ttf", "fonts/DejaVuSans-Bold.ttf"),
+    ("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf"),
+    ("C:/Windows/Fonts/arial.ttf", "C:/Windows/Fonts/arialbd.ttf"),
+]
+PROCESOS_PDF = max(1, min(4, os.cpu_count() or 1))
+ESPERA_MAXIMA_PDF_SEGUNDOS = 120  # sin ningún PDF terminado en este lapso, los pendientes siguen con hilos
+COLOR_PDF_PRIMARIO = (0, 123, 255)
+
+# Columnas de la tabla del PDF consolidado: (encabezado, columna de la tabla plana, ancho relativo)
+COLUMNAS_PDF_CONSOLIDADO = [
+    ("Acuerdo", "acuerdo_id", 14),
+    ("Organismo", "organismo_nombre", 22),
+    ("Tipo", "tipo_compromiso", 10),
+    ("Ficha", "ficha_id", 11),
+    ("Meta", "meta_descripcion", 33),
+    ("Pond.", "ponderacion", 6),
+    ("Cumpl.", "cumplimiento_meta", 7),
+    ("Cumpl. acuerdo", "cumplimiento_acuerdo", 9),
+]
 
-def exportar_reportes_completos(acuerdos, año):
-    """Exporta todos los reportes en un paquete ZIP"""
-    with st.spinner("Preparando paquete de exportación..."):
-        # Crear archivo en memoria
-        mem_zip = io.BytesIO()
-        
-        with zipfile.ZipFile(mem_zip, mode='w') as zf:
-            # 1. Reporte consolidado Excel
-            datos_excel = []
-            for agr in acuerdos:
-                cumplimiento = calcular_cumplimiento_acuerdo(agr)
-                for ficha in agr.get("fichas", []):
-                    for meta in ficha.get("metas", []):
-                        datos_excel.append({
-                            'Año': año,
-                            'Acuerdo_ID': agr.get('id'),
-                            'Organismo': agr.get('organismo_nombre'),
-                            'Tipo_Compromiso': agr.get('tipo_compromiso'),
-                            'Estado': agr.get('estado'),
-                            'Ficha_ID': ficha.get('id'),
-                            'Ficha_Nombre': ficha.get('nombre'),
-                            'Meta_Descripcion': meta.get('descripcion'),
-                            'Meta_Numero': meta.get('numero'),
-                            'Ponderacion': meta.get('ponderacion', 0),
-                            'Cumplimiento_Meta': meta.get('cumplimiento_calc', 'No calculado'),
-                            'Cumplimiento_Acuerdo': f"{cumplimiento:.1f}%" if cumplimiento else "No calculado"
-                        })
-            
-            if datos_excel:
-                df_excel = pd.DataFrame(datos_excel)
-                excel_buffer = io.BytesIO()
-                with pd.ExcelWriter(excel_buffer, engine='xlsxwriter') as writer:
-                    df_excel.to_excel(writer, sheet_name='Reporte_Consolidado', index=False)
-                excel_buffer.seek(0)
-                zf.writestr(f"reporte_consolidado_{año}.xlsx", excel_buffer.getvalue())
-            
-            # 2. Reportes individuales en JSON
-            for agr in acuerdos:
-                json_data = json.dumps(agr, ensure_ascii=False, indent=2, default=str)
-                zf.writestr(f"{agr['id']}_completo.json", json_data)
-            
-            # 3. Archivo de resumen
-            resumen = f"""RESUMEN DE REPORTES - AÑO {año}
-Fecha de generación: {datetime.now().strftime('%d/%m/%Y %H:%M')}
-Total acuerdos: {len(acuerdos)}
-Total fichas: {sum(len(agr.get('fichas', [])) for agr in acuerdos)}
-Total metas: {sum(len(ficha.get('metas', [])) for agr in acuerdos for ficha in agr.get('fichas', []))}
+@functools.lru_cache(maxsize=1)
+def _recursos_pdf() -> Dict[str, Any]:
+    """Rutas de fuente y bytes del logo (se resuelven una vez por proceso)"""
+    fuente = next(((normal, negrita) for normal, negrita in FUENTES_PDF
+                   if os.path.exists(normal) and os.path.exists(negrita)), None)
+    return {"fuente": fuente, "logo": try_load_logo()}
 
-Acuerdos incluidos:
-"""
-            for agr in acuerdos:
-                cumplimiento = calcular_cumplimiento_acuerdo(agr)
-                resumen += f"- {agr['id']}: {agr.get('organismo_nombre')} (Cumplimiento: {cumplimiento:.1f}%)\n"
+@functools.lru_cache(maxsize=1)
+def _clase_documento_pdf():
+    """
+    Clase FPDF con encabezado (logo + título), pie numerado y helpers de sección.
+    
+    fpdf2 se importa recién aquí para que la app funcione sin la librería.
+    
+    Raises:
+        ImportError: Si fpdf2 no está instalado
+    """
+    try:
+        from fpdf import FPDF
+    except ImportError as e:
+        raise ImportError("La generación de PDF requiere la librería fpdf2 (pip install fpdf2)") from e
+    
+    class DocumentoPDF(FPDF):
+        def __init__(self, titulo: str, orientacion: str = "P"):
+            super().__init__(orientation=orientacion, unit="mm", format="A4")
+            recursos = _recursos_pdf()
+            self.titulo_documento = titulo
+            self.unicode = recursos["fuente"] is not None
+            if self.unicode:
+                self.add_font("CG", "", recursos["fuente"][0])
+                self.add_font("CG", "B", recursos["fuente"][1])
+                self.familia = "CG"
+            else:
+                self.familia = "Helvetica"
+            self.logo = io.BytesIO(recursos["logo"]) if recursos["logo"] else None
+            self.set_title(self.texto(titulo))
+            self.set_creator(APP_TITLE)
+            self.set_auto_page_break(True, margin=15)
+            self.add_page()
+        
+        def texto(self, valor: Any) -> str:
+            texto = "" if valor is None else str(valor)
+            return texto if self.unicode else texto.encode("latin-1", "replace").decode("latin-1")
+        
+        def header(self):
+            if self.logo:
+                self.image(self.logo, x=self.l_margin, y=8, h=12)
+            self.set_font(self.familia, "B", 10)
+            self.set_text_color(*COLOR_PDF_PRIMARIO)
+            self.cell(0, 12, self.texto(self.titulo_documento), align="R", new_x="LMARGIN", new_y="NEXT")
+            self.set_draw_color(*COLOR_PDF_PRIMARIO)
+            self.line(self.l_margin, self.get_y(), self.w - self.r_margin, self.get_y())
+            self.ln(4)
+            self.set_text_color(0, 0, 0)
+        
+        def footer(self):
+            # Sin fecha de generación: los PDF se cachean por contenido y se sirven
+            # más tarde (la fecha de creación queda en los metadatos del archivo)
+            self.set_y(-12)
+            self.set_font(self.familia, "", 8)
+            self.set_text_color(120, 120, 120)
+            self.cell(0, 8, self.texto(f"{APP_TITLE} - Página {self.page_no()}/{{nb}}"), align="C")
+        
+        def titulo(self, texto: str, subtitulo: str = ""):
+            self.set_font(self.familia, "B", 16)
+            self.multi_cell(0, 8, self.texto(texto), align="C", new_x="LMARGIN", new_y="NEXT")
+            if subtitulo:
+                self.set_font(self.familia, "", 11)
+                self.multi_cell(0, 6, self.texto(subtitulo), align="C", new_x="LMARGIN", new_y="NEXT")
+            self.ln(4)
+        
+        def seccion(self, titulo: str, nivel: int = 1):
+            self.ln(2)
+            self.set_font(self.familia, "B", 12 if nivel == 1 else 10)
+            self.set_fill_color(*((233, 236, 239) if nivel == 1 else (248, 249, 250)))
+            self.multi_cell(0, 7, self.texto(titulo), fill=True, new_x="LMARGIN", new_y="NEXT")
+            self.ln(1)
+        
+        def parrafo(self, texto: Any, tamaño: int = 10):
+            self.set_font(self.familia, "", tamaño)
+            self.multi_cell(0, 5, self.texto(texto), new_x="LMARGIN", new_y="NEXT")
+            self.ln(1)
+        
+        def pares(self, filas: List[tuple]):
+            """Tabla de dos columnas etiqueta / valor"""
+            self.set_font(self.familia, "", 9)
+            with self.table(col_widths=(30, 70), first_row_as_headings=False, line_height=5) as tabla:
+                for etiqueta, valor in filas:
+                    fila = tabla.row()
+                    fila.cell(self.texto(etiqueta), style=self._negrita())
+                    fila.cell(self.texto(valor))
+            self.ln(2)
+        
+        def tabla(self, encabezados: List[str], filas: Iterable[List[Any]], anchos: List[int], tamaño: int = 8):
+            self.set_font(self.familia, "", tamaño)
+            with self.table(col_widths=anchos, line_height=4, headings_style=self._negrita()) as tabla:
+                tabla.row([self.texto(e) for e in encabezados])
+                for valores in filas:
+                    tabla.row([self.texto(v) for v in valores])
+            self.ln(2)
+        
+        def _negrita(self):
+            from fpdf.fonts import FontFace
+            return FontFace(emphasis="BOLD", fill_color=(233, 236, 239))
+    
+    return DocumentoPDF
+
+def construir_pdf_acuerdo(agr: Dict[str, Any]) -> bytes:
+    """PDF del documento imprimible de un acuerdo (mismo contenido que exportar_html_imprimible)"""
+    organismo = agr.get('organismo_nombre', 'No especificado')
+    pdf = _clase_documento_pdf()(f"Acuerdo {agr.get('id', 'Sin código')} - {organismo}")
+    
+    pdf.titulo("COMPROMISO DE GESTIÓN", f"{agr.get('id', 'Sin código')} · {organismo} · Año {agr.get('año', '')}")
+    
+    # INFORMACIÓN GENERAL
+    pdf.seccion("INFORMACIÓN GENERAL")
+    pdf.pares([
+        ("Organismo", organismo),
+        ("Tipo de organismo", agr.get('organismo_tipo', 'No especificado')),
+        ("Naturaleza jurídica", agr.get('naturaleza_juridica', 'No especificado')),
+        ("Año", agr.get('año', 'No especificado')),
+        ("Vigencia", f"{agr.get('vigencia_desde', '')} al {agr.get('vigencia_hasta', '')}"),
+        ("Estado", agr.get('estado', 'No especificado')),
+        ("Enlace", agr.get('organismo_enlace', 'No especificado')),
+        ("Tipo de compromiso", agr.get('tipo_compromiso', 'No especificado')),
+    ])
+    
+    # OBJETO, PARTES Y CLÁUSULAS
+    if agr.get('objeto'):
+        pdf.seccion("OBJETO DEL ACUERDO")
+        pdf.parrafo(agr.get('objeto'))
+    if agr.get('partes_firmantes'):
+        pdf.seccion("PARTES FIRMANTES")
+        pdf.parrafo(agr.get('partes_firmantes'))
+    clausulas_no_vacias = [c for c in agr.get('clausulas', []) or [] if c.strip()]
+    if clausulas_no_vacias:
+        pdf.seccion("CLÁUSULAS DEL ACUERDO")
+        for i, clausula in enumerate(clausulas_no_vacias, 1):
+            pdf.parrafo(f"{i}. {clausula}")
+    
+    # FICHAS Y METAS
+    if agr.get('fichas'):
+        pdf.seccion("FICHAS DE COMPROMISO")
+        for ficha in agr.get('fichas', []):
+            pdf.seccion(f"{ficha.get('id', '')} - {ficha.get('nombre', 'Sin nombre')}", nivel=2)
+            filas = [
+                ("Tipo de meta", ficha.get('tipo_meta', 'No especificado')),
+                ("Responsables de cumplimiento", ficha.get('responsables_cumpl', 'No especificado')),
+                ("Objetivo", ficha.get('objetivo', 'No especificado')),
+                ("Indicador", ficha.get('indicador', 'No especificado')),
+                ("Forma de cálculo", ficha.get('forma_calculo', 'No especificado')),
+                ("Fuente de información", ficha.get('fuente', 'No especificado')),
+                ("Valor base", ficha.get('valor_base', 'No especificado')),
+                ("Responsables de seguimiento", ficha.get('responsables_seguimiento', 'No especificado')),
+                ("Observaciones", ficha.get('observaciones', 'No especificado')),
+                ("Cláusula de salvaguarda", "SÍ" if ficha.get('salvaguarda_flag') else "NO"),
+            ]
+            if ficha.get('salvaguarda_flag'):
+                filas.append(("Texto de salvaguarda", ficha.get('salvaguarda_text', '')))
+            pdf.pares(filas)
             
-            zf.writestr("RESUMEN.txt", resumen)
-        
-        mem_zip.seek(0)
-        
+            for meta in ficha.get('metas', []):
+                cumplimiento = meta.get('cumplimiento_calc')
+                _, estado_texto = _estado_meta_imprimible(cumplimiento)
+                pdf.set_font(pdf.familia, "B", 9)
+                pdf.multi_cell(0, 5, pdf.texto(f"Meta {meta.get('numero', '')}: {meta.get('descripcion', 'Sin descripción')} [{estado_texto}]"),
+                               new_x="LMARGIN", new_y="NEXT")
+                pdf.tabla(
+                    ["Unidad", "Valor objetivo", "Sentido", "Frecuencia", "Vencimiento", "Hito", "Pond.", "Cumplimiento"],
+                    [[meta.get('unidad', ''), meta.get('valor_objetivo', ''), meta.get('sentido', ''),
+                      meta.get('frecuencia', ''), meta.get('vencimiento', ''), "SÍ" if meta.get('es_hito') else "NO",
+                      meta.get('ponderacion', 0),
+                      f"{cumplimiento:.2f}%" if cumplimiento is not None else "No calculado"]],
+                    [12, 14, 9, 12, 14, 7, 8, 14]
+                )
+                if meta.get('rango'):
+                    pdf.tabla(["Mínimo", "Máximo", "Porcentaje"],
+                              [[r.get('min', '-'), r.get('max', '-'), r.get('porcentaje', '-')] for r in meta['rango']],
+                              [1, 1, 1])
+    
+    # FIRMAS (siempre en página aparte, como en el HTML imprimible)
+    pdf.add_page()
+    pdf.seccion("FIRMAS DEL ACUERDO")
+    pdf.ln(30)
+    ancho = (pdf.epw - 20) / 2
+    pdf.set_font(pdf.familia, "", 10)
+    for izquierda, derecha in (("_" * 35, "_" * 35), ("CONTRAPARTE", "INSTITUCIÓN")):
+        pdf.cell(ancho, 6, pdf.texto(izquierda), align="C")
+        pdf.cell(20, 6, "")
+        pdf.cell(ancho, 6, pdf.texto(derecha), align="C", new_x="LMARGIN", new_y="NEXT")
+    pdf.ln(20)
+    pdf.cell(0, 6, pdf.texto("FECHA DE FIRMA: _________________________ (dd/mm/aaaa)"), align="C")
+    
+    return bytes(pdf.output())
+
+def construir_pdf_consolidado(acuerdos: List[Dict[str, Any]], año: int,
+                              filtro_organismo: Optional[str] = None) -> Optional[bytes]:
+    """PDF del reporte consolidado (métricas + tabla de metas) desde la tabla plana; None si no hay metas"""
+    tabla = obtener_tabla_plana().dataframe(agr["id"] for agr in acuerdos)
+    if tabla.empty:
+        return None
+    
+    metricas = metricas_desde_tabla(tabla, len(acuerdos))
+    pdf = _clase_documento_pdf()(f"Reporte consolidado {año}", orientacion="L")
+    subtitulo = f"Año {año}" + (f" · Organismo: {filtro_organismo}" if filtro_organismo else "")
+    pdf.titulo("REPORTE CONSOLIDADO DE COMPROMISOS DE GESTIÓN", subtitulo)
+    
+    pdf.seccion("MÉTRICAS DE CUMPLIMIENTO")
+    pdf.tabla(
+        ["Acuerdos", "Metas", "Cumplidas", "Parciales", "No cumplidas", "Cumplimiento promedio"],
+        [[metricas['total_acuerdos'], metricas['total_metas'],
+          f"{metricas['metas_cumplidas']} ({metricas['porcentaje_cumplidas']:.1f}%)",
+          f"{metricas['metas_parciales']} ({metricas['porcentaje_parciales']:.1f}%)",
+          f"{metricas['metas_no_cumplidas']} ({metricas['porcentaje_no_cumplidas']:.1f}%)",
+          f"{metricas['cumplimiento_promedio']:.1f}%"]],
+        [1, 1, 1, 1, 1, 1], tamaño=9
+    )
+    
+    pdf.seccion("DETALLE DE METAS")
+    columnas = [col for _, col, _ in COLUMNAS_PDF_CONSOLIDADO]
+    vista = tabla[columnas].astype(object).where(tabla[columnas].notna(), "")
+    vista["cumplimiento_meta"] = tabla["cumplimiento_meta"].map(_texto_cumplimiento)
+    vista["cumplimiento_acuerdo"] = tabla["cumplimiento_acuerdo"].map(_texto_cumplimiento)
+    pdf.tabla([titulo for titulo, _, _ in COLUMNAS_PDF_CONSOLIDADO],
+              vista.itertuples(index=False, name=None),
+              [ancho for _, _, ancho in COLUMNAS_PDF_CONSOLIDADO], tamaño=7)
+    
+    return bytes(pdf.output())
+
+def pdf_imprimible_cacheado(agr: Dict[str, Any]) -> bytes:
+    """PDF imprimible de un acuerdo, cacheado por contenido del acuerdo"""
+    return obtener_cache_reportes().obtener_o_generar(
+        "pdf_imprimible", {}, [agr["id"]],
+        lambda: construir_pdf_acuerdo(agr),
+        revision=digest_acuerdo(agr)
+    )
+
+def boton_descarga_pdf_acuerdo(agr: Dict[str, Any]):
+    """
+    Descarga del PDF del acuerdo en dos pasos, como boton_descarga_adjunto: los
+    reruns de la página no renderizan ni leen el PDF hasta que se pide "Preparar".
+    """
+    clave = f"pdf_preparado_{agr['id']}"
+    if st.session_state.get(clave):
+        try:
+            datos = pdf_imprimible_cacheado(agr)
+        except ImportError as e:
+            st.session_state.pop(clave, None)
+            st.caption(f"⚠️ {e}")
+            return
         st.download_button(
-            "📦 Descargar Paquete Completo (ZIP)",
-            data=mem_zip.getvalue(),
-            file_name=f"reportes_completos_{año}.zip",
-            mime="application/zip"
+            "📄 Descargar PDF", data=datos, file_name=f"{agr['id']}.pdf", mime="application/pdf",
+            key=f"dl_pdf_{agr['id']}", on_click=lambda: st.session_state.pop(clave, None)
         )
+    elif st.button("📄 Preparar PDF", key=f"prep_pdf_{agr['id']}"):
+        st.session_state[clave] = True
+        st.rerun()
+
+def _pdf_acuerdo_en_proceso(agr: Dict[str, Any]) -> tuple:
+    """Tarea del pool: función de módulo para poder enviarla a otro proceso"""
+    return agr["id"], construir_pdf_acuerdo(agr)
+
+@st.cache_resource(show_spinner=False)
+def _tarea_pdf_importable() -> Callable[[Dict[str, Any]], tuple]:
+    """
+    _pdf_acuerdo_en_proceso tal como la puede enviar pickle a otro proceso.
+    
+    Con `streamlit run` este archivo se ejecuta como __main__ (uno nuevo en cada
+    rerun) y pickle no encuentra la función por nombre. Se registra una sola vez un
+    módulo con el nombre del archivo que la contiene: el proceso hijo importa ese
+    archivo de verdad (sin correr main(), que exige __name__ == "__main__") y la
+    resuelve ahí.
+    """
+    tarea = _pdf_acuerdo_en_proceso
+    if tarea.__module__ != "__main__":
+        return tarea  # el archivo ya se importó como módulo
+    nombre = os.path.splitext(os.path.basename(__file__))[0]
+    carpeta = os.path.dirname(os.path.abspath(__file__))
+    if carpeta not in sys.path:
+        sys.path.append(carpeta)  # los procesos hijos reciben este sys.path
+    modulo = sys.modules.get(nombre)
+    if modulo is None:
+        modulo = sys.modules[nombre] = types.ModuleType(nombre)
+        modulo.__file__ = __file__
+    tarea.__module__ = nombre
+    modulo._pdf_acuerdo_en_proceso = tarea
+    return tarea
+
+def _pdfs_en_paralelo(acuerdos: List[Dict[str, Any]]) -> Iterator[tuple]:
+    """
+    Renderiza un PDF por acuerdo y los entrega (id, bytes) a medida que terminan.
+    
+    Usa un pool de procesos con forkserver (o spawn): se llama desde un hilo de la
+    cola de reportes dentro del servidor multihilo, donde hacer fork puede dejar al
+    hijo bloqueado en un lock tomado por otro hilo. Si el pool no puede arrancar,
+    falla, o pasan ESPERA_MAXIMA_PDF_SEGUNDOS sin que termine ningún PDF, continúa
+    con hilos los pendientes (y lo deja anotado en la consola del servidor).
+    """
+    _clase_documento_pdf()
+    _recursos_pdf()
+    pendientes = {agr["id"]: agr for agr in acuerdos}
+    
+    pool = None
+    try:
+        metodo = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        pool = ProcessPoolExecutor(max_workers=PROCESOS_PDF, mp_context=multiprocessing.get_context(metodo))
+        tarea = _tarea_pdf_importable()
+        futuros = {pool.submit(tarea, agr) for agr in acuerdos}
+        while futuros:
+            listos, futuros = wait(futuros, timeout=ESPERA_MAXIMA_PDF_SEGUNDOS, return_when=FIRST_COMPLETED)
+            if not listos:
+                print(f"⚠️ PDF: el pool de procesos no terminó ningún PDF en {ESPERA_MAXIMA_PDF_SEGUNDOS} s; "
+                      f"{len(pendientes)} pendiente(s) siguen con hilos")
+                break  # el pool no avanza
+            for futuro in listos:
+                acuerdo_id, datos = futuro.result()
+                pendientes.pop(acuerdo_id, None)
+                yield acuerdo_id, datos
+    except (ValueError, OSError, BrokenProcessPool, pickle.PicklingError, AttributeError, ImportError) as e:
+        print(f"⚠️ PDF: pool de procesos no disponible ({type(e).__name__}: {e}); "
+              f"{len(pendientes)} pendiente(s) siguen con hilos")
+    finally:
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+    
+    if pendientes:
+        with ThreadPoolExecutor(max_workers=PROCESOS_PDF, thread_name_prefix="pdf") as pool:
+            futuros = [pool.submit(_pdf_acuerdo_en_proceso, agr) for agr in pendientes.values()]
+            for futuro in as_completed(futuros):
+                yield futuro.result()
+
+def construir_lote_pdf_acuerdos(acuerdos: List[Dict[str, Any]], año: int,
+                                progreso: Optional[Callable[[float, str], None]] = None) -> IO[bytes]:
+    """ZIP con un PDF por acuerdo (escrito a un archivo temporal a medida que llegan)"""
+    salida = tempfile.SpooledTemporaryFile(max_size=UMBRAL_SPOOL_BYTES, prefix="pdfs_cg_", suffix=".zip")
+    with zipfile.ZipFile(salida, mode="w", compression=zipfile.ZIP_STORED) as zf:
+        for i, (acuerdo_id, datos) in enumerate(_pdfs_en_paralelo(acuerdos), 1):
+            zf.writestr(f"{año}/{acuerdo_id}.pdf", datos)
+            if progreso:
+                progreso(i / len(acuerdos), f"PDF {i} de {len(acuerdos)}")
+    salida.seek(0)
+    return salida
 
-@st.cache_data(ttl=60, show_spinner=False)
 def generar_reporte_individual(agr):
     """Genera un reporte individual para un acuerdo específico"""
     with st.spinner(f"Generando reporte para {agr['id']}..."):
@@ -4831,7 +8818,7 @@ def generar_reporte_individual(agr):
         
         with col1:
             # JSON completo
-            json_data = json.dumps(agr, ensure_ascii=False, indent=2, default=str)
+            json_data = json.dumps(obtener_almacen_historial().completar(agr), ensure_ascii=False, indent=2, default=str)
             st.download_button(
                 "📄 JSON Completo",
                 data=json_data.encode('utf-8'),
@@ -4841,20 +8828,23 @@ def generar_reporte_individual(agr):
         
         with col2:
             # CSV horizontal
-            csv_data = export_csv_horizontal_agreement(agr)
+            csv_data = obtener_cache_reportes().obtener_o_generar(
+                "csv_horizontal", {}, [agr["id"]],
+                lambda: export_csv_horizontal_agreement(agr).encode('utf-8'),
+                revision=digest_acuerdo(agr)
+            )
             st.download_button(
                 "📊 CSV Horizontal",
-                data=csv_data.encode('utf-8'),
+                data=csv_data,
                 file_name=f"{agr['id']}.csv",
                 mime="text/csv"
             )
         
         with col3:
             # HTML imprimible
-            html_data = exportar_html_imprimible(agr)
             st.download_button(
                 "🌐 HTML Imprimible",
-                data=html_data.encode('utf-8'),
+                data=html_imprimible_cacheado(agr),
                 file_name=f"{agr['id']}.html",
                 mime="text/html"
             )
@@ -4877,12 +8867,12 @@ def generar_reporte_individual(agr):
             st.write(f"**Metas:** {sum(len(f.get('metas', [])) for f in agr.get('fichas', []))}")
             st.write(f"**Año:** {agr.get('año')}")
 
-@st.cache_data(ttl=60, show_spinner=False)
 def generar_vista_imprimible_individual(agr):
     """Genera vista optimizada para impresión de un acuerdo individual"""
     
-    # 🆕 GENERAR EL HTML MEJORADO
-    html_content = exportar_html_imprimible(agr)
+    # 🆕 HTML MEJORADO DESDE LA CACHÉ DE REPORTES (mismos bytes para ambas descargas)
+    html_bytes = html_imprimible_cacheado(agr)
+    html_content = html_bytes.decode('utf-8')
     
     # 🆕 BOTONES DE ACCIÓN PRINCIPALES
     st.info("**📄 Vista Optimizada para Impresión** - Descargue el HTML y ábralo en su navegador para imprimir (Ctrl+P)")
@@ -4892,7 +8882,7 @@ def generar_vista_imprimible_individual(agr):
     with col1:
         st.download_button(
             "💾 Descargar HTML Completo",
-            data=html_content.encode('utf-8'),
+            data=html_bytes,
             file_name=f"{agr['id']}_completo.html",
             mime="text/html",
             help="Descargue y abra en su navegador para mejor calidad de impresión"
@@ -4901,7 +8891,7 @@ def generar_vista_imprimible_individual(agr):
     with col2:
         st.download_button(
             "🖨️ Versión para Imprimir",
-            data=html_content.encode('utf-8'),
+            data=html_bytes,
             file_name=f"{agr['id']}_imprimir.html",
             mime="text/html",
             help="Optimizado específicamente para impresión"
@@ -5071,115 +9061,70 @@ def generar_vista_imprimible_individual(agr):
                 st.metric("Cumplimiento General", "No calculado")
 
 # FUNCIONES AUXILIARES PARA FORMATOS ESPECÍFICOS
-@st.cache_data(ttl=60, show_spinner=False)
-def generar_pdf_informe(acuerdos, año, filtro_organismo):
-    """Genera informe en formato PDF (simulado)"""
-    # Nota: Para PDF real necesitarías librerías como reportlab o weasyprint
-    # Esta es una simulación que genera un HTML mejorado
-    
-    html_content = f"""
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <meta charset="UTF-8">
-        <title>Reporte PDF - Año {año}</title>
-        <style>
-            body {{ font-family: Arial, sans-serif; margin: 20px; }}
-            .header {{ text-align: center; border-bottom: 2px solid #333; padding-bottom: 10px; }}
-            .acuerdo {{ margin: 20px 0; padding: 15px; border: 1px solid #ddd; }}
-            .metricas {{ background: #f5f5f5; padding: 10px; margin: 10px 0; }}
-        </style>
-    </head>
-    <body>
-        <div class="header">
-            <h1>REPORTE DE COMPROMISOS DE GESTIÓN</h1>
-            <h2>Año: {año}</h2>
-            <p>Filtro organismo: {filtro_organismo or 'Todos'}</p>
-            <p>Generado: {datetime.now().strftime('%d/%m/%Y %H:%M')}</p>
-        </div>
-    """
-    
-    for agr in acuerdos:
-        cumplimiento = calcular_cumplimiento_acuerdo(agr)
-        html_content += f"""
-        <div class="acuerdo">
-            <h3>{agr.get('id')} - {agr.get('organismo_nombre')}</h3>
-            <div class="metricas">
-                <strong>Cumplimiento: {cumplimiento:.1f}% si está disponible</strong> |
-                Fichas: {len(agr.get('fichas', []))} | 
-                Metas: {sum(len(f.get('metas', [])) for f in agr.get('fichas', []))}
-            </div>
-        </div>
-        """
-    
-    html_content += "</body></html>"
-    
-    st.download_button(
-        "📄 Descargar PDF (HTML)",
-        data=html_content.encode('utf-8'),
-        file_name=f"reporte_{año}.html",
-        mime="text/html",
-        help="Para PDF real, se necesita configuración adicional del servidor"
+def _fragmentos_informe_resumen(acuerdos, año, filtro_organismo) -> Iterator[str]:
+    """Fragmentos del informe resumido (una tarjeta por acuerdo)"""
+    tabla = obtener_tabla_plana().dataframe(agr["id"] for agr in acuerdos)
+    resumen = tabla.groupby("acuerdo_id", sort=False).agg(
+        cumplimiento=("cumplimiento_acuerdo", "first"), metas=("meta_id", "size"))
+    
+    yield PLANTILLA_APERTURA_HTML.substitute(titulo=f"Reporte PDF - Año {_h(año)}", css=CSS_INFORME_RESUMEN)
+    yield PLANTILLA_INFORME_RESUMEN_ENCABEZADO.substitute(
+        anio=_h(año),
+        filtro=_h(filtro_organismo or 'Todos'),
+        generado=datetime.now().strftime('%d/%m/%Y %H:%M'),
     )
+    for agr in acuerdos:
+        yield PLANTILLA_INFORME_RESUMEN_ACUERDO.substitute(
+            acuerdo_id=_h(agr.get('id')),
+            organismo=_h(agr.get('organismo_nombre')),
+            cumplimiento=_texto_cumplimiento(resumen["cumplimiento"].get(agr.get("id"))),
+            fichas=len(agr.get('fichas', [])),
+            metas=int(resumen["metas"].get(agr.get("id"), 0)),
+        )
+    yield CIERRE_HTML
+
+def _fragmentos_informe_detalle(acuerdos, año) -> Iterator[str]:
+    """Fragmentos del informe completo acuerdo → ficha → meta (desde la tabla plana)"""
+    tabla = obtener_tabla_plana().dataframe(agr["id"] for agr in acuerdos)
+    
+    yield PLANTILLA_APERTURA_HTML.substitute(titulo=f"Reporte Completo - Año {_h(año)}", css=CSS_INFORME_DETALLE)
+    yield f"    <h1>Reporte Completo - Año {_h(año)}</h1>\n"
+    for (agr_id, organismo), filas in tabla.groupby(["acuerdo_id", "organismo_nombre"], sort=False, dropna=False):
+        yield f"<div class='acuerdo'><h2>{_h(agr_id)} - {_h(organismo)}</h2>"
+        for (_, ficha_nombre), metas in filas.groupby(["ficha_id", "ficha_nombre"], sort=False, dropna=False):
+            yield f"<div class='ficha'><h3>Ficha: {_h(ficha_nombre)}</h3>"
+            for meta in metas.itertuples(index=False):
+                yield PLANTILLA_INFORME_DETALLE_META.substitute(
+                    numero=_h(meta.meta_numero),
+                    descripcion=_h(meta.meta_descripcion),
+                    ponderacion=_h(meta.ponderacion),
+                    cumplimiento=_h(meta.cumplimiento_meta if pd.notna(meta.cumplimiento_meta) else 'N/A'),
+                )
+            yield "</div>"
+        yield "</div>"
+    yield CIERRE_HTML
+
+def generar_pdf_informe(acuerdos, año, filtro_organismo):
+    """Genera informe en formato PDF (fpdf2, en segundo plano)"""
+    encolar_reporte("pdf_consolidado", {"año": año, "organismo": filtro_organismo}, acuerdos)
 
-@st.cache_data(ttl=60, show_spinner=False)
 def generar_excel_informe(acuerdos, año):
     """Genera informe en formato Excel"""
     # Reutilizar la función de exportación existente
     exportar_reportes_completos(acuerdos, año)
 
-@st.cache_data(ttl=60, show_spinner=False)
 def generar_html_informe(acuerdos, año):
     """Genera informe en formato HTML"""
-    html_content = f"""
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <meta charset="UTF-8">
-        <title>Reporte Completo - Año {año}</title>
-        <style>
-            body {{ font-family: Arial, sans-serif; margin: 40px; }}
-            .acuerdo {{ page-break-inside: avoid; margin: 30px 0; }}
-            .ficha {{ background: #f9f9f9; padding: 15px; margin: 10px 0; }}
-            .meta {{ border-left: 3px solid #007cba; padding-left: 10px; }}
-        </style>
-    </head>
-    <body>
-        <h1>Reporte Completo - Año {año}</h1>
-    """
-    
-    for agr in acuerdos:
-        html_content += f"<div class='acuerdo'><h2>{agr.get('id')} - {agr.get('organismo_nombre')}</h2>"
-        
-        for ficha in agr.get("fichas", []):
-            html_content += f"<div class='ficha'><h3>Ficha: {ficha.get('nombre')}</h3>"
-            
-            for meta in ficha.get("metas", []):
-                html_content += f"""
-                <div class='meta'>
-                    <h4>Meta {meta.get('numero')}: {meta.get('descripcion')}</h4>
-                    <p>Ponderación: {meta.get('ponderacion')}% | Cumplimiento: {meta.get('cumplimiento_calc', 'N/A')}%</p>
-                </div>
-                """
-            
-            html_content += "</div>"
-        html_content += "</div>"
-    
-    html_content += "</body></html>"
-    
-    st.download_button(
-        "🌐 Descargar HTML Completo",
-        data=html_content.encode('utf-8'),
-        file_name=f"reporte_completo_{año}.html",
-        mime="text/html"
-    )
+    encolar_reporte("informe_detalle", {"año": año}, acuerdos)
 
 def mostrar_informe_pantalla(acuerdos, año, incluir_metricas, incluir_detalles):
     """Muestra el informe directamente en pantalla"""
     st.success(f"📊 Informe generado para {len(acuerdos)} acuerdos del año {año}")
     
+    tabla = obtener_tabla_plana().dataframe(agr["id"] for agr in acuerdos)
+    
     if incluir_metricas:
-        metricas = calcular_metricas_globales(acuerdos)
+        metricas = metricas_desde_tabla(tabla, len(acuerdos))
         col1, col2, col3, col4 = st.columns(4)
         col1.metric("Acuerdos", metricas['total_acuerdos'])
         col2.metric("Metas", metricas['total_metas'])
@@ -5187,12 +9132,13 @@ def mostrar_informe_pantalla(acuerdos, año, incluir_metricas, incluir_detalles)
         col4.metric("Cumplimiento Prom.", f"{metricas['cumplimiento_promedio']:.1f}%")
     
     if incluir_detalles:
+        resumen = tabla.groupby("acuerdo_id", sort=False).agg(
+            cumplimiento=("cumplimiento_acuerdo", "first"), metas=("meta_id", "size"))
         for agr in acuerdos:
             with st.expander(f"{agr.get('id')} - {agr.get('organismo_nombre')}"):
-                cumplimiento = calcular_cumplimiento_acuerdo(agr)
-                st.write(f"**Cumplimiento:** {cumplimiento:.1f}% si está disponible")
+                st.write(f"**Cumplimiento:** {_texto_cumplimiento(resumen['cumplimiento'].get(agr.get('id')))}")
                 st.write(f"**Fichas:** {len(agr.get('fichas', []))}")
-                st.write(f"**Metas:** {sum(len(f.get('metas', [])) for f in agr.get('fichas', []))}")
+                st.write(f"**Metas:** {int(resumen['metas'].get(agr.get('id'), 0))}")
 def sidebar():
     st.sidebar.title("Menú")
     if st.session_state.user:
@@ -5301,14 +9247,11 @@ def page_home():
     with col1:
         st.markdown("### 📊 Estado del Sistema")
         try:
-            db = agreements_load()
-            total_acuerdos = len(db)
-            total_fichas = sum(len(agr.get("fichas", [])) for agr in db.values())
-            total_metas = sum(len(ficha.get("metas", [])) for agr in db.values() for ficha in agr.get("fichas", []))
+            totales = obtener_cubo_cumplimiento().metricas()
             
-            st.metric("📋 Acuerdos Activos", total_acuerdos)
-            st.metric("📝 Fichas Creadas", total_fichas) 
-            st.metric("🎯 Metas Registradas", total_metas)
+            st.metric("📋 Acuerdos Activos", totales['total_acuerdos'])
+            st.metric("📝 Fichas Creadas", totales['total_fichas']) 
+            st.metric("🎯 Metas Registradas", totales['total_metas'])
             
         except Exception as e:
             st.error(f"Error cargando datos: {e}")